@@ -1,124 +1,290 @@
+"""How geographically diverse are each individual's sightings?
+
+Works on the columnar annotation index of final_model (no per-annotation
+Python objects): sightings are grouped by individual once, and per-individual
+sighting counts, centroids (mean of unit vectors on the sphere) and spreads
+are computed with grouped numpy reductions. Distances are great-circle
+(haversine) meters, so they are correct away from the equator.
+
+The spread of an individual is the largest distance between two of its
+sightings. It is exact for individuals with up to --exact-max-sightings GPS
+sightings; above that a double sweep (farthest point from the centroid, then
+farthest point from that) is used, which is only a lower bound (up to ~14%
+short of the exact spread on synthetic ranges).
+
+Writes geodiversity.png, geo_spread.csv (per-individual statistics) and the
+geodiverse_zebras.csv / geosimilar_zebras.csv individual lists. With
+--geo-split it also writes split index files in which train, val and test
+individuals come from disjoint map cells (by centroid).
+
+Usage:
+    python dataset_geo_diversity.py -j customSplit_test.json -o out/
+    python dataset_geo_diversity.py -j instances_train2020.json -o out/ \
+        --geo-split 0.7 0.1 0.2 --geo-cell-size 5000
+"""
+
 import argparse
-import json
 import pathlib
+import sys
 
 import numpy as np
 import pandas as pd
-import geopandas
-from pycocotools.coco import COCO
 
 import seaborn as sns
 import matplotlib.pyplot as plt
 
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parents[1].joinpath('final_model')))
+import annotation_index  # noqa: E402
+from geo_index import METERS_PER_DEGREE, haversine  # noqa: E402
+from train_val_test_data_split import individual_strata, write_split_index  # noqa: E402
+
 
 def parse_args():
     parser = argparse.ArgumentParser(description='Find geographic diversity of images')
     parser.add_argument('-j', '--json', type=pathlib.Path,
             default='/media/data/ComputerVisionCourse/zebragiraffe/annotations/customSplit_test.json',
-            help='Annotations JSON file in COCO-format')
+            help='Annotations JSON file in COCO-format (or split index .npz)')
     parser.add_argument('-c', '--category-id-list', type=int,
             nargs='+',
             default=[1],
             help='Which animal categories to include')
-    parser.add_argument('-m', '--meters-per-degree', type=float,
-            default=111320,
-            help='Rough conversion of latitude/longitu degrees to meters')
-    parser.add_argument('-t', '--threshold-degrees', type=float,
-            default=3e-3,
-            help='Threshold (in lat/lon degrees) of distance to consider "different place"')
+    parser.add_argument('-t', '--threshold-meters', type=float,
+            default=3e-3 * METERS_PER_DEGREE,
+            help='Spread (meters) above which an individual counts as seen in "different places"')
+    parser.add_argument('--exact-max-sightings', type=int,
+            default=20000,
+            help='Compute the exact max pairwise distance for individuals with up to this many GPS sightings')
+    parser.add_argument('--geo-split', type=float, nargs=3, default=None,
+            metavar=('TRAIN', 'VAL', 'TEST'),
+            help='Also write geo-disjoint split index files with these fractions of individuals')
+    parser.add_argument('--geo-cell-size', type=float,
+            default=5000,
+            help='Map cell size (meters) for --geo-split; whole cells go to one split')
+    parser.add_argument('-s', '--seed', type=int, default=21,
+            help='random seed for --geo-split')
     parser.add_argument('-o', '--output-folder', type=pathlib.Path,
-            default='.', help='Output folder for plots and csv')
+            default='.', help='Output folder for plots, csv and split files')
 
     return parser.parse_args()
 
 
-def main():
-    args  = parse_args()
+def group_sum(values, offsets):
+    """Sum of values over each group values[offsets[g]:offsets[g + 1]] (groups are non-empty)."""
+    return np.add.reduceat(values, offsets[:-1], axis=0)
+
+
+def group_max(values, offsets):
+    return np.maximum.reduceat(values, offsets[:-1], axis=0)
+
+
+def centroids(lat, lon, valid, offsets):
+    """Per-group spherical centroid (degrees) of the valid points, NaN if none."""
+    lat_r, lon_r = np.radians(np.where(valid, lat, 0)), np.radians(np.where(valid, lon, 0))
+    xyz = np.stack([np.cos(lat_r) * np.cos(lon_r), np.cos(lat_r) * np.sin(lon_r), np.sin(lat_r)], axis=1)
+    xyz = group_sum(xyz * valid[:, None], offsets)
+    with np.errstate(invalid='ignore'):
+        centroid_lat = np.degrees(np.arctan2(xyz[:, 2], np.hypot(xyz[:, 0], xyz[:, 1])))
+        centroid_lon = np.degrees(np.arctan2(xyz[:, 1], xyz[:, 0]))
+    empty = group_sum(valid.astype(np.int64), offsets) == 0
+    centroid_lat[empty] = np.nan
+    centroid_lon[empty] = np.nan
+    return centroid_lat, centroid_lon
+
+
+def group_argmax(values, offsets):
+    """Position (in values) of the first maximum of each group."""
+    is_max = values == np.repeat(group_max(values, offsets), np.diff(offsets))
+    positions = np.flatnonzero(is_max)
+    groups = np.searchsorted(offsets, positions, side='right') - 1
+    return positions[np.unique(groups, return_index=True)[1]]
+
 
-    # Load in COCO-format annotations
-    coco = COCO(args.json)
+def exact_spreads(lat, lon, offsets, max_elements=2 ** 22):
+    """Exact per-group max pairwise distance, for groups of at least 2 points.
 
-    # Filter for zebras
-    # loop over standard annotations
-    zebra_ann_ids = coco.getAnnIds(catIds=args.category_id_list)
+    Groups are padded to the next power of two of their size, and each size
+    class is done in batches of [groups, width, width] matrices (at most
+    max_elements entries) of unit vector dot products: the farthest pair has
+    the smallest one, and its haversine distance is the spread. Groups too
+    large for one matrix are done alone, max_elements entries at a time.
+    """
+    sizes = np.diff(offsets)
+    spread = np.empty(len(sizes))
+    lat_r, lon_r = np.radians(lat), np.radians(lon)
+    xyz = np.stack([np.cos(lat_r) * np.cos(lon_r), np.cos(lat_r) * np.sin(lon_r), np.sin(lat_r)], axis=1)
+    widths = 2 ** np.ceil(np.log2(sizes)).astype(np.int64)
+    for g in np.flatnonzero(widths * widths > max_elements):
+        vectors = xyz[offsets[g]:offsets[g + 1]]
+        rows = max(1, max_elements // len(vectors))
+        best, pair = np.inf, (0, 0)
+        for start in range(0, len(vectors), rows):
+            dots = vectors[start:start + rows] @ vectors.T
+            farthest = np.unravel_index(np.argmin(dots), dots.shape)
+            if dots[farthest] < best:
+                best, pair = dots[farthest], (start + farthest[0], farthest[1])
+        i, j = offsets[g] + pair[0], offsets[g] + pair[1]
+        spread[g] = haversine(lat[i], lon[i], lat[j], lon[j])
+    for width in np.unique(widths[widths * widths <= max_elements]):
+        groups = np.flatnonzero(widths == width)
+        columns = np.arange(width)
+        padding = columns >= sizes[groups][:, None]
+        positions = np.where(padding, offsets[groups][:, None], offsets[groups][:, None] + columns)
+        step = max(1, max_elements // (width * width))
+        for start in range(0, len(groups), step):
+            batch = positions[start:start + step]
+            vectors = xyz[batch]
+            # Padding repeats a group's first point, which never lowers the minimum
+            dots = (vectors @ vectors.transpose(0, 2, 1)).reshape(len(batch), -1)
+            farthest = np.argmin(dots, axis=1)
+            i = batch[np.arange(len(batch)), farthest // width]
+            j = batch[np.arange(len(batch)), farthest % width]
+            spread[groups[start:start + step]] = haversine(lat[i], lon[i], lat[j], lon[j])
+    return spread
 
-    # Collect annotations into Dataframe for easier analysis
-    annotations_list = []
 
-    # Grab geographic info for each annotation
-    for ann_id in zebra_ann_ids:
-        ann = coco.anns[ann_id]
-        zebra_name = ann['name']
-        img_id = ann['image_id']
-        img_info = coco.imgs[img_id]
+def double_sweep_spreads(lat, lon, offsets, centroid_lat, centroid_lon):
+    """Per-group lower bound of the spread: farthest point from the centroid, then farthest from that."""
+    sizes = np.diff(offsets)
+    p = group_argmax(haversine(np.repeat(centroid_lat, sizes), np.repeat(centroid_lon, sizes), lat, lon), offsets)
+    q = group_argmax(haversine(np.repeat(lat[p], sizes), np.repeat(lon[p], sizes), lat, lon), offsets)
+    return group_max(haversine(np.repeat(lat[q], sizes), np.repeat(lon[q], sizes), lat, lon), offsets)
 
-        # Weird encoding of negative NaN values
-        lat = float(img_info['gps_lat_captured'])
-        if lat == -1:
-            lat = np.nan
-        lon = float(img_info['gps_lon_captured'])
-        if lon == -1:
-            lon = np.nan
 
-        # Collect in list to turn into a dataframe
-        annotations_list.append({
-            'image_id': img_id,
-            'annotation_id': ann_id,
-            'zebra_name': zebra_name,
-            'latitude': lat,
-            'longitude': lon,
-        })
+def max_pairwise_spread(lat, lon, valid, offsets, centroid_lat, centroid_lon, exact_max_sightings):
+    """Per-group max distance (meters) between two valid points, NaN with fewer than 2."""
+    gps_counts = group_sum(valid.astype(np.int64), offsets)
+    spread = np.full(len(gps_counts), np.nan)
+    # Valid points only, grouped as before
+    lat, lon = lat[valid], lon[valid]
+    gps_offsets = np.append(0, np.cumsum(gps_counts))
+    for groups in (np.flatnonzero((gps_counts >= 2) & (gps_counts <= exact_max_sightings)),
+                   np.flatnonzero(gps_counts > exact_max_sightings)):
+        if not len(groups):
+            continue
+        # The selected groups' points, regrouped contiguously
+        sizes = gps_counts[groups]
+        positions = np.repeat(gps_offsets[groups], sizes) + np.arange(sizes.sum()) - np.repeat(
+            np.cumsum(sizes) - sizes, sizes)
+        offsets_selected = np.append(0, np.cumsum(sizes))
+        if gps_counts[groups[0]] <= exact_max_sightings:
+            spread[groups] = exact_spreads(lat[positions], lon[positions], offsets_selected)
+        else:
+            spread[groups] = double_sweep_spreads(lat[positions], lon[positions], offsets_selected,
+                                                  centroid_lat[groups], centroid_lon[groups])
+    return spread
 
-    df = pd.DataFrame(annotations_list)
 
-    # Convert degrees to meters (alternatively, could use pint units package)
-    df[['latitude', 'longitude']] = df[['latitude', 'longitude']] * args.meters_per_degree
+def source_json(path):
+    """The COCO JSON behind an annotation file (itself, or the source of a split index)."""
+    path = pathlib.Path(path)
+    if path.suffix != '.npz':
+        return path
+    with np.load(path) as split:
+        return path.parent / str(split['source'])
 
-    # gdf = geopandas.GeoDataFrame(
-    #     df, geometry=geopandas.points_from_xy(df.longitude, df.latitude))
 
-    # Make a violin plot of these standard-deviations...
+def individual_statistics(index, category_ids, exact_max_sightings):
+    """Per-individual sighting counts, centroid, distance from it and max pairwise spread."""
+    _, offsets, order = individual_strata(index, category_ids)
+    lat, lon = index.ann_lat[order], index.ann_lon[order]
+    valid = np.isfinite(lat) & np.isfinite(lon)
 
-    threshold_same_location_m = args.threshold_degrees * args.meters_per_degree
+    centroid_lat, centroid_lon = centroids(lat, lon, valid, offsets)
+    group_sizes = np.diff(offsets)
+    from_centroid = haversine(np.repeat(centroid_lat, group_sizes), np.repeat(centroid_lon, group_sizes), lat, lon)
+    max_from_centroid = group_max(np.where(valid, from_centroid, -np.inf), offsets)
+    max_from_centroid[np.isneginf(max_from_centroid)] = np.nan
 
-    geo_spread = df.groupby('zebra_name')[['latitude', 'longitude']].std()
-    geo_spread = geo_spread.dropna('index')
+    stats = pd.DataFrame({
+        'zebra_name': [index.name(row) for row in order[offsets[:-1]]],
+        'category_id': np.asarray(index.ann_category)[order[offsets[:-1]]],
+        'sightings': group_sizes,
+        'gps_sightings': group_sum(valid.astype(np.int64), offsets),
+        'centroid_lat': centroid_lat,
+        'centroid_lon': centroid_lon,
+        'max_from_centroid_m': max_from_centroid,
+        'spread_m': max_pairwise_spread(lat, lon, valid, offsets, centroid_lat, centroid_lon, exact_max_sightings),
+    })
+    return stats, offsets, order
+
+
+def geo_disjoint_assignment(centroid_lat, centroid_lon, fractions, cell_size_m, rng):
+    """Split per individual (0 train, 1 val, 2 test, -1 no GPS), whole map cells at a time."""
+    located = np.isfinite(centroid_lat) & np.isfinite(centroid_lon)
+    cell_deg = cell_size_m / METERS_PER_DEGREE
+    max_abs_lat = np.max(np.abs(centroid_lat[located])) if located.any() else 0.0
+    cell_lon_deg = cell_deg / np.cos(np.radians(min(max_abs_lat, 89.0)))
+    cells = np.stack([np.floor(centroid_lat[located] / cell_deg), np.floor(centroid_lon[located] / cell_lon_deg)], axis=1)
+    _, cell_of, cell_counts = np.unique(cells, axis=0, return_inverse=True, return_counts=True)
+    cell_of = cell_of.ravel()
+
+    # Fill train, then val, then test with randomly ordered cells
+    cell_order = rng.permutation(len(cell_counts))
+    filled_before = np.cumsum(cell_counts[cell_order]) - cell_counts[cell_order]
+    boundaries = np.cumsum(fractions[:2]) * located.sum()
+    cell_split = np.empty(len(cell_counts), dtype=np.int64)
+    cell_split[cell_order] = np.searchsorted(boundaries, filled_before, side='right')
+
+    split = np.full(len(centroid_lat), -1, dtype=np.int64)
+    split[located] = cell_split[cell_of]
+    return split
+
+
+def main():
+    args  = parse_args()
+    args.output_folder.mkdir(parents=True, exist_ok=True)
+
+    index = annotation_index.open_annotations(args.json)
+    stats, offsets, order = individual_statistics(index, args.category_id_list, args.exact_max_sightings)
+    stats.to_csv(args.output_folder.joinpath('geo_spread.csv'), index=False)
+
+    threshold_same_location_m = args.threshold_meters
+    geo_spread = stats.set_index('zebra_name')[['max_from_centroid_m', 'spread_m']].dropna()
 
     # Plot some figures
     fig, ax = plt.subplots(figsize=(9, 9))
     sns.boxplot(data=geo_spread, ax=ax)
-    ax.set_title(f'How geographically diverse is each zebra\'s sightings?\nSpread of sigma for n={len(geo_spread)} individuals (that had >=2 sightings with lat/lon data)\n{args.json.name}')
-    ax.set_ylabel('std (meters)')
+    ax.set_title(f'How geographically diverse is each zebra\'s sightings?\nSpread for n={len(geo_spread)} individuals (that had >=2 sightings with lat/lon data)\n{args.json.name}')
+    ax.set_ylabel('distance (meters)')
     ax.axhline(
         threshold_same_location_m,
         color='black',
         linestyle='dashed',
-        label=f'{args.threshold_degrees} deg',
+        label=f'{threshold_same_location_m:.0f} m',
     )
     ax.set_yscale('log')
     ax.legend()
     fig.savefig(args.output_folder.joinpath('geodiversity.png'))
 
-    print('Number of zebras with at least threshold lat/lon standard deviation:')
-    print((geo_spread > threshold_same_location_m).sum())
-    print('Number of zebras with that surpass the threshold for either lat OR lon:',
-          (geo_spread > threshold_same_location_m).any('columns').sum())
-
+    geodiverse = geo_spread['spread_m'] > threshold_same_location_m
+    print('Number of zebras with a spread of at least {:.0f} m: {} of {}'.format(
+        threshold_same_location_m, geodiverse.sum(), len(geo_spread)))
 
-    plt.ion()
-    plt.pause(0.001)
-
-    geodiverse_zebras = geo_spread.loc[(geo_spread > threshold_same_location_m).any('columns')]
+    geodiverse_zebras = geo_spread.loc[geodiverse]
     num_zebras = len(geodiverse_zebras)
 
     # Get the same number of zebras individuals for the other dataset
-    geosimilar_zebras = geo_spread.mean(axis='columns').sort_values().iloc[:num_zebras]
+    geosimilar_zebras = geo_spread['spread_m'].sort_values(kind='stable').iloc[:num_zebras]
 
     # Save these out, index only
     geodiverse_zebras.to_csv(args.output_folder.joinpath('geodiverse_zebras.csv'),
                              columns=[])
-    geosimilar_zebras.to_csv(args.output_folder.joinpath('geosimilar_zebras.csv'),
-                             columns=[])
+    geosimilar_zebras.to_frame().to_csv(args.output_folder.joinpath('geosimilar_zebras.csv'),
+                                        columns=[])
+
+    if args.geo_split:
+        assert abs(sum(args.geo_split) - 1.0) < 1e-6, 'fractions should sum to 1'
+        split = geo_disjoint_assignment(stats['centroid_lat'].to_numpy(), stats['centroid_lon'].to_numpy(),
+                                        args.geo_split, args.geo_cell_size, np.random.RandomState(args.seed))
+        sightings_split = np.repeat(split, np.diff(offsets))
+        for s, name in enumerate(['train', 'val', 'test']):
+            rows = np.sort(order[sightings_split == s])
+            path = args.output_folder.joinpath('geoSplit_{}.npz'.format(name))
+            write_split_index(path, index, rows, source_json(args.json),
+                              split=name, seed=args.seed, fractions=args.geo_split,
+                              geo_cell_size=args.geo_cell_size, category_ids=args.category_id_list)
+            print('{}: {} individuals, {} annotations -> {}'.format(name, (split == s).sum(), len(rows), path))
+        print('individuals without GPS (left out):', (split == -1).sum())
 
     print('Saved out files to:', args.output_folder)
 
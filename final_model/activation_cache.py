@@ -0,0 +1,232 @@
+"""Memory-mapped float16 cache of frozen-prefix feature maps.
+
+When only the top of DenseNet-201 trains and images are not augmented, the
+output of the frozen prefix for an annotation never changes, so it only has
+to be computed once. ActivationCache keeps those feature maps (float16) in a
+fixed-size memory-mapped slab with an LRU index on top: once the size budget
+is reached the least recently used entries are evicted, a few at a time, and
+the on-disk index is rewritten without them before their slots are reused, so
+a run killed mid-epoch never leaves a key pointing at another key's data.
+
+A cache directory is tied to a fingerprint of everything that determines the
+cached values (the frozen weights up to the cut, the cut itself and the
+preprocessing); opening it with a different fingerprint starts it empty.
+
+Running this module measures, for several cut points, the epoch time with a
+cold and a warm cache against no cache, and the disk footprint.
+
+Usage:
+    python denseNet201_v6_augs.py --unfreeze-blocks 1 --activation-cache /scratch/act_cache \
+        --cache-cut denseblock4 --cache-size-gb 20 ...
+    python activation_cache.py --cuts denseblock2 denseblock3 denseblock4 --unfreeze-blocks 1
+"""
+
+import argparse
+import collections
+import hashlib
+import json
+import os
+import pathlib
+import shutil
+import tempfile
+import time
+
+import numpy as np
+import torch
+
+CACHE_VERSION = 1
+
+
+def prefix_fingerprint(model, cut, extra=''):
+    """sha1 of the frozen weights/buffers before stage cut, the cut and extra (e.g. preprocessing)."""
+    sha1 = hashlib.sha1('{}|{}|{}'.format(CACHE_VERSION, cut, extra).encode('utf-8'))
+    for i, (name, module) in enumerate(model.features.named_children()):
+        if i >= model.stage_index(cut):
+            break
+        for key, tensor in module.state_dict().items():
+            sha1.update('{}.{}'.format(name, key).encode('utf-8'))
+            sha1.update(tensor.detach().cpu().contiguous().numpy().tobytes())
+    return sha1.hexdigest()
+
+
+class ActivationCache:
+    """LRU cache of float16 feature maps of one shape, keyed by integer ids.
+
+    Args:
+        path: cache directory.
+        entry_shape: shape of one feature map, e.g. (896, 7, 7).
+        capacity_bytes: size budget of the slab file.
+        fingerprint: see prefix_fingerprint; a mismatch resets the cache.
+    """
+    def __init__(self, path, entry_shape, capacity_bytes, fingerprint):
+        self.path = pathlib.Path(path)
+        self.path.mkdir(parents=True, exist_ok=True)
+        self.entry_shape = tuple(int(d) for d in entry_shape)
+        self.entry_bytes = int(np.prod(self.entry_shape)) * 2
+        self.num_slots = max(1, int(capacity_bytes // self.entry_bytes))
+        meta = {'version': CACHE_VERSION, 'entry_shape': list(self.entry_shape),
+                'num_slots': self.num_slots, 'fingerprint': fingerprint}
+
+        meta_path = self.path / 'meta.json'
+        fresh = True
+        if meta_path.exists():
+            with open(meta_path) as f:
+                fresh = json.load(f) != meta
+        # A new slab file is sparse: disk use grows with the entries written
+        self.slots = np.lib.format.open_memmap(self.path / 'slots.npy', mode='w+' if fresh else 'r+',
+                                               dtype=np.float16, shape=(self.num_slots,) + self.entry_shape)
+        self.lru = collections.OrderedDict()  # key -> slot, least recently used first
+        if fresh:
+            (self.path / 'index.npz').unlink(missing_ok=True)
+            self._write_atomic('meta.json', lambda f: f.write(json.dumps(meta).encode('utf-8')))
+        elif (self.path / 'index.npz').exists():
+            with np.load(self.path / 'index.npz') as index:
+                self.lru.update(zip(index['keys'].tolist(), index['slots'].tolist()))
+        used = np.zeros(self.num_slots, dtype=bool)
+        used[list(self.lru.values())] = True
+        self.free = np.flatnonzero(~used).tolist()[::-1]
+        self.hits = 0
+        self.misses = 0
+
+    def _write_atomic(self, name, write):
+        fd, tmp_path = tempfile.mkstemp(prefix=name + '.', dir=self.path)
+        with os.fdopen(fd, 'wb') as f:
+            write(f)
+        os.replace(tmp_path, self.path / name)
+
+    def __len__(self):
+        return len(self.lru)
+
+    def get(self, keys):
+        """(found mask, float16 array of the found entries in key order)."""
+        found = np.zeros(len(keys), dtype=bool)
+        slots = []
+        for i, key in enumerate(keys.tolist()):
+            slot = self.lru.get(key)
+            if slot is not None:
+                self.lru.move_to_end(key)
+                found[i] = True
+                slots.append(slot)
+        self.hits += len(slots)
+        self.misses += len(keys) - len(slots)
+        return found, self.slots[np.asarray(slots)] if slots else None
+
+    def put(self, keys, values):
+        """Stores float16 feature maps, evicting least recently used entries when full."""
+        keys = keys.tolist()
+        for i, (key, value) in enumerate(zip(keys, values)):
+            slot = self.lru.pop(key, None)
+            if slot is None:
+                if not self.free:
+                    self._evict(max(len(keys) - i, self.num_slots // 64))
+                slot = self.free.pop()
+            self.slots[slot] = value
+            self.lru[key] = slot
+
+    def _evict(self, count):
+        """Frees the count least recently used slots; the index on disk drops them before they are reused."""
+        for _ in range(min(count, len(self.lru))):
+            self.free.append(self.lru.popitem(last=False)[1])
+        self.flush()
+
+    def flush(self):
+        """Writes the slab and the LRU index to disk (call at the end of an epoch)."""
+        self.slots.flush()
+        keys = np.fromiter(self.lru.keys(), dtype=np.int64, count=len(self.lru))
+        slots = np.fromiter(self.lru.values(), dtype=np.int64, count=len(self.lru))
+        self._write_atomic('index.npz', lambda f: np.savez(f, keys=keys, slots=slots))
+
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def disk_bytes(self):
+        """Bytes actually allocated for the slab file (it is sparse)."""
+        return os.stat(self.path / 'slots.npy').st_blocks * 512
+
+
+def open_for_model(model, path, cut, size_gb, image_size, extra=''):
+    """Opens (or resets) the cache for model's frozen prefix and attaches it."""
+    cut_index = model.trainable_from if cut is None else model.stage_index(cut)
+    cut = 'head' if cut_index == len(model.stage_names) else model.stage_names[cut_index]
+    with torch.no_grad():
+        was_training = model.training
+        model.eval()
+        probe = torch.zeros(1, 3, image_size, image_size, device=next(model.parameters()).device)
+        entry_shape = model.prefix(probe, stop=cut_index).shape[1:]
+        model.train(was_training)
+    fingerprint = prefix_fingerprint(model, cut, '{}|{}'.format(image_size, extra))
+    cache = ActivationCache(path, entry_shape, size_gb * 1024 ** 3, fingerprint)
+    model.attach_cache(cache, cut)
+    return cache
+
+
+def time_epochs(model, images, batch_size, epochs, rng):
+    """Seconds per epoch of triplet training steps over a bank of distinct images."""
+    optimizer = torch.optim.Adam([p for p in model.parameters() if p.requires_grad], lr=1e-4)
+    model.train()
+    keys = torch.arange(len(images))
+    seconds = []
+    for _ in range(epochs):
+        start = time.perf_counter()
+        for _ in range(len(images) // batch_size):
+            triplet_keys = torch.from_numpy(rng.randint(0, len(images), size=3 * batch_size))
+            optimizer.zero_grad()
+            embeddings = model(images[triplet_keys], keys=keys[triplet_keys])
+            anchor, positive, negative = embeddings.chunk(3)
+            torch.nn.functional.triplet_margin_loss(anchor, positive, negative).backward()
+            optimizer.step()
+        if model.activation_cache is not None:
+            model.activation_cache.flush()
+        seconds.append(time.perf_counter() - start)
+    return seconds
+
+
+def main():
+    from backbone import PartiallyFrozenDenseNet
+    from denseNet201_v6_augs import initialize_model
+
+    parser = argparse.ArgumentParser(description='Measure activation cache epoch speedup and disk footprint')
+    parser.add_argument('--cuts', nargs='+', default=['denseblock2', 'denseblock3', 'denseblock4'],
+                        help='stages the cached forward pass starts from')
+    parser.add_argument('--unfreeze-blocks', type=int, default=1,
+                        help='trailing dense blocks that train')
+    parser.add_argument('--num-annotations', type=int, default=256,
+                        help='distinct images per epoch')
+    parser.add_argument('--batch-size', type=int, default=16)
+    parser.add_argument('--image-size', type=int, default=224)
+    parser.add_argument('--epochs', type=int, default=2, help='first epoch is cold, the rest warm')
+    parser.add_argument('--cache-size-gb', type=float, default=4)
+    parser.add_argument('--cache-dir', type=pathlib.Path, default=None,
+                        help='scratch folder for the caches (default: a temporary folder)')
+    args = parser.parse_args()
+
+    torch.manual_seed(0)
+    images = torch.randn(args.num_annotations, 3, args.image_size, args.image_size)
+    model = initialize_model(use_pretrained=False, unfreeze_blocks=args.unfreeze_blocks)
+    if not isinstance(model, PartiallyFrozenDenseNet):
+        model = PartiallyFrozenDenseNet(model, 0)
+
+    baseline = time_epochs(model, images, args.batch_size, 1, np.random.RandomState(0))[0]
+    print({'cut': None, 'epoch_seconds': baseline})
+    scratch = pathlib.Path(tempfile.mkdtemp(dir=args.cache_dir))
+    try:
+        for cut in args.cuts:
+            cache = open_for_model(model, scratch / cut, cut, args.cache_size_gb, args.image_size)
+            seconds = time_epochs(model, images, args.batch_size, args.epochs, np.random.RandomState(0))
+            print({
+                'cut': cut,
+                'entry_kb': cache.entry_bytes / 1024,
+                'disk_mb': cache.disk_bytes() / 1024 ** 2,
+                'cold_epoch_seconds': seconds[0],
+                'warm_epoch_seconds': float(np.mean(seconds[1:])) if len(seconds) > 1 else None,
+                'warm_speedup': baseline / np.mean(seconds[1:]) if len(seconds) > 1 else None,
+                'hit_rate': cache.hit_rate(),
+            })
+            model.activation_cache = None
+    finally:
+        shutil.rmtree(scratch, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,537 @@
+"""Compact, memory-mapped annotation index built from a COCO-format JSON.
+
+Parsing the full COCO JSON (and building pycocotools' dict-of-dicts) for every
+loader is slow and every DataLoader worker ends up holding its own copy. This
+module converts the JSON once into a directory of columnar .npy arrays that
+loaders open with ``mmap_mode='r'``:
+
+    ann_id, ann_image_id, ann_image_row, ann_name, ann_category   (one row per annotation)
+    ann_bbox, ann_maskrcnn_bbox                                    (float32, [N, 4])
+    ann_rle_size, ann_rle_offsets, rle_counts                      (maskrcnn_mask_rle, if present)
+    img_id, img_width, img_height, img_path_offsets, img_path_blob (one row per image)
+    img_lat, img_lon, img_time                                     (GPS degrees / unix seconds, NaN if unknown)
+    ann_span, img_span                                             (byte range of each record in the JSON)
+    name_offsets, name_blob                                        (individual-name string table)
+
+Annotation rows are sorted by annotation id, image rows by image id, and the
+name table is sorted, so lookups are ``np.searchsorted``. ``meta.json`` records
+the source JSON's size, mtime and sha1 so a stale index is rebuilt, plus the
+categories. The JSON is read with a streaming parser that notes where every
+record starts and ends, so split writers can copy records out of the source
+file without parsing it again.
+
+Split index files (.npz of annotation ids, see train_val_test_data_split.py)
+are opened with open_annotations as a subset of their source JSON's index.
+
+Usage:
+    python annotation_index.py -j customSplit_train.json
+"""
+
+import array
+import codecs
+import datetime
+import hashlib
+import json
+import os
+import pathlib
+import re
+import shutil
+import tempfile
+
+import numpy as np
+
+INDEX_VERSION = 3
+INDEX_SUFFIX = '.index'
+
+
+class StringTable:
+    """Read-only table of strings stored as utf-8 bytes plus offsets."""
+    def __init__(self, offsets, blob):
+        self.offsets = offsets
+        self.blob = blob
+
+    def __getitem__(self, i):
+        start, stop = self.offsets[i], self.offsets[i + 1]
+        return bytes(self.blob[start:stop]).decode('utf-8')
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def tolist(self):
+        return [self[i] for i in range(len(self))]
+
+    @staticmethod
+    def encode(strings):
+        """Returns (offsets, blob) arrays for a list of strings."""
+        encoded = [s.encode('utf-8') for s in strings]
+        offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum([len(b) for b in encoded])
+        blob = np.frombuffer(b''.join(encoded), dtype=np.uint8)
+        return offsets, blob
+
+
+def json_fingerprint(json_path, with_hash=True):
+    """Size, mtime and (optionally) sha1 of the annotation JSON."""
+    stat = os.stat(json_path)
+    fingerprint = {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+    if with_hash:
+        sha1 = hashlib.sha1()
+        with open(json_path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                sha1.update(chunk)
+        fingerprint['sha1'] = sha1.hexdigest()
+    return fingerprint
+
+
+def default_index_dir(json_path):
+    """Index lives next to the JSON, or in a user cache if that isn't writable."""
+    json_path = pathlib.Path(json_path)
+    index_dir = json_path.with_name(json_path.name + INDEX_SUFFIX)
+    if os.access(json_path.parent, os.W_OK) or index_dir.exists():
+        return index_dir
+    cache_root = pathlib.Path(os.environ.get('ANNOTATION_INDEX_CACHE',
+                                             pathlib.Path.home() / '.cache' / 'animal-reid'))
+    path_key = hashlib.sha1(str(json_path.resolve()).encode('utf-8')).hexdigest()[:16]
+    return cache_root / (json_path.name + '.' + path_key + INDEX_SUFFIX)
+
+
+def _bbox_array(annotations, key):
+    bboxes = np.full((len(annotations), 4), np.nan, dtype=np.float32)
+    for i, ann in enumerate(annotations):
+        bbox = ann.get(key)
+        if bbox is not None and len(bbox) == 4:
+            bboxes[i] = bbox
+    return bboxes
+
+
+def _gps(value):
+    """GPS degrees as float; the dataset encodes missing values as -1."""
+    try:
+        value = float(value)
+    except (TypeError, ValueError):
+        return np.nan
+    return np.nan if value == -1 else value
+
+
+def _capture_time(img):
+    """'date_captured' as unix seconds (naive times taken as UTC), NaN if unknown."""
+    value = img.get('date_captured')
+    if value in (None, '', -1):
+        return np.nan
+    if isinstance(value, (int, float)):
+        return float(value)
+    for fmt in ('%Y-%m-%d %H:%M:%S', '%Y-%m-%dT%H:%M:%S', '%Y:%m:%d %H:%M:%S', '%Y-%m-%d'):
+        try:
+            parsed = datetime.datetime.strptime(value.strip(), fmt)
+        except ValueError:
+            continue
+        return parsed.replace(tzinfo=datetime.timezone.utc).timestamp()
+    return np.nan
+
+
+class JsonRecordReader:
+    """Streams the elements of a JSON object's top-level arrays with their byte ranges.
+
+    records() yields (key, value, start, end) for every element of every
+    top-level array (other top-level values whole); start:end is the value's
+    byte range in the file. Only a read-ahead chunk is buffered.
+    """
+    WHITESPACE = re.compile(r'[ \t\n\r]*')
+
+    def __init__(self, f, chunk_size=1 << 20):
+        self.f = f
+        self.chunk_size = chunk_size
+        self.decoder = json.JSONDecoder()
+        self.utf8 = codecs.getincrementaldecoder('utf-8')()
+        self.buf = ''
+        self.ascii = True  # characters are bytes in the buffer
+        self.pos = 0
+        self.offset = 0  # byte offset of buf[pos] in the file
+        self.eof = False
+
+    def _fill(self):
+        """Appends the next chunk to the buffer; False at the end of the file."""
+        if self.eof:
+            return False
+        chunk = self.f.read(self.chunk_size)
+        self.eof = not chunk
+        self.buf = self.buf[self.pos:] + self.utf8.decode(chunk, final=self.eof)
+        self.ascii = self.buf.isascii()
+        self.pos = 0
+        return not self.eof
+
+    def _advance(self, end):
+        self.offset += end - self.pos if self.ascii else len(self.buf[self.pos:end].encode('utf-8'))
+        self.pos = end
+
+    def _peek(self):
+        """Next non-whitespace character ('' at the end of the file)."""
+        if self.pos < len(self.buf) and self.buf[self.pos] not in ' \t\n\r':
+            return self.buf[self.pos]
+        while True:
+            self._advance(self.WHITESPACE.match(self.buf, self.pos).end())
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if not self._fill():
+                return ''
+
+    def _expect(self, chars):
+        char = self._peek()
+        if not char or char not in chars:
+            raise ValueError('expected one of {!r} at byte {}, got {!r}'.format(chars, self.offset, char))
+        self._advance(self.pos + 1)
+        return char
+
+    def _value(self):
+        self._peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buf, self.pos)
+            except json.JSONDecodeError:
+                if self._fill():
+                    continue
+                raise
+            # A number at the end of the buffer may continue in the next chunk
+            if end < len(self.buf) or self.eof:
+                break
+            self._fill()
+        start = self.offset
+        self._advance(end)
+        return value, start, self.offset
+
+    def records(self):
+        self._expect('{')
+        if self._peek() == '}':
+            return
+        while True:
+            key, _, _ = self._value()
+            self._expect(':')
+            if self._peek() != '[':
+                yield (key,) + self._value()
+            else:
+                self._advance(self.pos + 1)
+                if self._peek() == ']':
+                    self._advance(self.pos + 1)
+                else:
+                    while True:
+                        yield (key,) + self._value()
+                        if self._expect(',]') == ']':
+                            break
+            if self._expect(',}') == '}':
+                return
+
+
+# Record fields build_columns reads; the index build drops the rest (e.g. segmentations) while streaming
+INDEX_FIELDS = {
+    'images': ('id', 'file_name', 'width', 'height', 'gps_lat_captured', 'gps_lon_captured', 'date_captured'),
+    'annotations': ('id', 'image_id', 'name', 'category_id', 'bbox', 'maskrcnn_bbox', 'maskrcnn_mask_rle'),
+    'categories': None,
+}
+
+
+def load_coco(json_path, fields=INDEX_FIELDS):
+    """Streams a COCO JSON: (data, spans) with spans[key] the [n, 2] byte ranges of data[key]'s records.
+
+    Only the top-level arrays named in fields are kept, each record reduced
+    to the listed keys (None keeps it whole).
+    """
+    data = {key: [] for key in fields}
+    spans = {key: array.array('q') for key in fields}
+    with open(json_path, 'rb') as f:
+        for key, record, start, end in JsonRecordReader(f).records():
+            if key in fields:
+                if fields[key] is not None:
+                    record = {name: record[name] for name in fields[key] if name in record}
+                data[key].append(record)
+                spans[key].extend((start, end))
+    return data, {key: np.frombuffer(s, dtype=np.int64).reshape(-1, 2) for key, s in spans.items()}
+
+
+def build_columns(data, spans):
+    """Builds the index columns from COCO-format data and its record spans (see load_coco)."""
+    image_order = sorted(range(len(data['images'])), key=lambda i: data['images'][i]['id'])
+    images = [data['images'][i] for i in image_order]
+    img_id = np.array([img['id'] for img in images], dtype=np.int64)
+    img_path_offsets, img_path_blob = StringTable.encode([img['file_name'] for img in images])
+
+    ann_order = sorted(range(len(data['annotations'])), key=lambda i: data['annotations'][i]['id'])
+    annotations = [data['annotations'][i] for i in ann_order]
+    ann_image_id = np.array([ann['image_id'] for ann in annotations], dtype=np.int64)
+    ann_image_row = np.searchsorted(img_id, ann_image_id).astype(np.int32)
+    missing_image = (ann_image_row >= len(img_id)) | (img_id[np.minimum(ann_image_row, len(img_id) - 1)] != ann_image_id)
+    ann_image_row[missing_image] = -1
+
+    names = [str(ann.get('name', '')) for ann in annotations]
+    unique_names, ann_name = np.unique(np.array(names, dtype=object), return_inverse=True)
+    name_offsets, name_blob = StringTable.encode(unique_names.tolist())
+
+    # maskrcnn_mask_rle counts are compressed COCO strings; keep them as one byte blob
+    rles = [ann.get('maskrcnn_mask_rle') for ann in annotations]
+    ann_rle_size = np.array([rle['size'] if rle else (0, 0) for rle in rles], dtype=np.int32).reshape(-1, 2)
+    counts = [rle['counts'] if rle else '' for rle in rles]
+    counts = [c if isinstance(c, str) else c.decode('utf-8') for c in counts]
+    ann_rle_offsets, rle_counts = StringTable.encode(counts)
+
+    return {
+        'ann_id': np.array([ann['id'] for ann in annotations], dtype=np.int64),
+        'ann_image_id': ann_image_id,
+        'ann_image_row': ann_image_row,
+        'ann_name': ann_name.astype(np.int32),
+        'ann_category': np.array([ann.get('category_id', -1) for ann in annotations], dtype=np.int32),
+        'ann_bbox': _bbox_array(annotations, 'bbox'),
+        'ann_maskrcnn_bbox': _bbox_array(annotations, 'maskrcnn_bbox'),
+        'ann_rle_size': ann_rle_size,
+        'ann_span': spans['annotations'][ann_order],
+        'ann_rle_offsets': ann_rle_offsets,
+        'rle_counts': rle_counts,
+        'img_id': img_id,
+        'img_width': np.array([img.get('width', -1) for img in images], dtype=np.int32),
+        'img_height': np.array([img.get('height', -1) for img in images], dtype=np.int32),
+        'img_path_offsets': img_path_offsets,
+        'img_path_blob': img_path_blob,
+        'img_lat': np.array([_gps(img.get('gps_lat_captured')) for img in images], dtype=np.float64),
+        'img_lon': np.array([_gps(img.get('gps_lon_captured')) for img in images], dtype=np.float64),
+        'img_time': np.array([_capture_time(img) for img in images], dtype=np.float64),
+        'img_span': spans['images'][image_order],
+        'name_offsets': name_offsets,
+        'name_blob': name_blob,
+    }
+
+
+def build_index(json_path, index_dir=None):
+    """Streams the COCO JSON once and writes the columnar index.
+
+    The index is written to a temporary directory and renamed into place so
+    concurrent readers never see a half-written index.
+    """
+    json_path = pathlib.Path(json_path)
+    index_dir = pathlib.Path(index_dir) if index_dir else default_index_dir(json_path)
+    fingerprint = json_fingerprint(json_path)
+    data, spans = load_coco(json_path)
+    columns = build_columns(data, spans)
+    categories = data['categories']
+    del data
+
+    index_dir.parent.mkdir(parents=True, exist_ok=True)
+    tmp_dir = pathlib.Path(tempfile.mkdtemp(prefix=index_dir.name + '.', dir=index_dir.parent))
+    for name, column in columns.items():
+        np.save(tmp_dir / (name + '.npy'), column)
+    meta = {
+        'version': INDEX_VERSION,
+        'source': str(json_path.resolve()),
+        'num_annotations': int(len(columns['ann_id'])),
+        'num_images': int(len(columns['img_id'])),
+        'fingerprint': fingerprint,
+        'categories': categories,
+    }
+    with open(tmp_dir / 'meta.json', 'w') as f:
+        json.dump(meta, f)
+    # Move a stale index aside rather than deleting it in place, so readers
+    # never see a half-deleted directory; it is removed once replaced
+    stale_dir = None
+    if index_dir.exists():
+        stale_dir = tmp_dir.with_name(tmp_dir.name + '.stale')
+        try:
+            os.rename(index_dir, stale_dir)
+        except OSError:
+            stale_dir = None  # another process already moved it
+    try:
+        os.rename(tmp_dir, index_dir)
+    except OSError:
+        # Another process won the race; use its index
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+    if stale_dir is not None:
+        shutil.rmtree(stale_dir, ignore_errors=True)
+    return index_dir
+
+
+def index_is_current(json_path, index_dir):
+    """Cheap size/mtime check first, sha1 only if those changed."""
+    meta_path = pathlib.Path(index_dir) / 'meta.json'
+    if not meta_path.exists():
+        return False
+    with open(meta_path) as f:
+        meta = json.load(f)
+    if meta.get('version') != INDEX_VERSION:
+        return False
+    recorded = meta['fingerprint']
+    current = json_fingerprint(json_path, with_hash=False)
+    if current['size'] == recorded['size'] and current['mtime_ns'] == recorded['mtime_ns']:
+        return True
+    # Touched (e.g. re-copied from S3) but possibly identical content
+    if current['size'] != recorded['size'] or json_fingerprint(json_path)['sha1'] != recorded['sha1']:
+        return False
+    # Same content: record the new mtime so the next check is cheap again
+    meta['fingerprint'].update(current)
+    try:
+        with open(meta_path, 'w') as f:
+            json.dump(meta, f)
+    except OSError:
+        pass
+    return True
+
+
+class AnnotationIndex:
+    """Memory-mapped view of the columnar annotation index.
+
+    Args:
+        index_dir: directory written by build_index.
+        rows: optional annotation rows to restrict to (e.g. one species or split).
+    """
+    def __init__(self, index_dir, rows=None):
+        self.index_dir = pathlib.Path(index_dir)
+        self.rows = None if rows is None else np.asarray(rows, dtype=np.int64)
+        with open(self.index_dir / 'meta.json') as f:
+            self.meta = json.load(f)
+
+        def load(name):
+            return np.load(self.index_dir / (name + '.npy'), mmap_mode='r')
+
+        ann_columns = ['ann_id', 'ann_image_id', 'ann_image_row', 'ann_name', 'ann_category',
+                       'ann_bbox', 'ann_maskrcnn_bbox', 'ann_rle_size', 'ann_span']
+        for name in ann_columns:
+            column = load(name)
+            setattr(self, name, column if self.rows is None else np.ascontiguousarray(column[self.rows]))
+        # rle offsets are N + 1 long; keep the full table and index through ann_rle_row
+        self.ann_rle_row = np.arange(len(load('ann_id'))) if self.rows is None else self.rows
+        # The full index is sorted by annotation id; a subset may not be
+        self._id_order = None if self.rows is None else np.argsort(self.ann_id, kind='stable')
+        self._sorted_ids = self.ann_id if self.rows is None else self.ann_id[self._id_order]
+        self.rle_counts = StringTable(load('ann_rle_offsets'), load('rle_counts'))
+
+        self.img_id = load('img_id')
+        self.img_width = load('img_width')
+        self.img_height = load('img_height')
+        self.img_lat = load('img_lat')
+        self.img_lon = load('img_lon')
+        self.img_time = load('img_time')
+        self.img_span = load('img_span')
+        self.img_paths = StringTable(load('img_path_offsets'), load('img_path_blob'))
+        self.names = StringTable(load('name_offsets'), load('name_blob'))
+
+    def __getstate__(self):
+        # Don't pickle mmapped arrays into spawned workers; reopen them instead
+        return {'index_dir': self.index_dir, 'rows': self.rows}
+
+    def __setstate__(self, state):
+        self.__init__(state['index_dir'], state['rows'])
+
+    def __len__(self):
+        return len(self.ann_id)
+
+    def subset(self, rows):
+        """Returns an index restricted to the given rows of this index."""
+        rows = np.asarray(rows, dtype=np.int64)
+        if self.rows is not None:
+            rows = self.rows[rows]
+        return AnnotationIndex(self.index_dir, rows)
+
+    def rows_for_categories(self, category_ids):
+        return np.flatnonzero(np.isin(self.ann_category, category_ids))
+
+    def row_of(self, annotation_ids):
+        """Row(s) for annotation id(s); raises KeyError for unknown ids."""
+        positions = np.minimum(np.searchsorted(self._sorted_ids, annotation_ids), len(self._sorted_ids) - 1)
+        rows = positions if self._id_order is None else self._id_order[positions]
+        if not np.all(self.ann_id[rows] == annotation_ids):
+            raise KeyError(annotation_ids)
+        return rows
+
+    def _image_column(self, column):
+        """Per-annotation view of an image column (NaN for annotations without an image)."""
+        rows = np.asarray(self.ann_image_row)
+        values = np.asarray(column)[np.maximum(rows, 0)].astype(np.float64)
+        values[rows < 0] = np.nan
+        return values
+
+    @property
+    def ann_lat(self):
+        return self._image_column(self.img_lat)
+
+    @property
+    def ann_lon(self):
+        return self._image_column(self.img_lon)
+
+    @property
+    def ann_time(self):
+        return self._image_column(self.img_time)
+
+    def name(self, row):
+        return self.names[self.ann_name[row]]
+
+    def image_path(self, row):
+        return self.img_paths[self.ann_image_row[row]]
+
+    def mask_rle(self, row):
+        """maskrcnn_mask_rle in the form pycocotools.mask.decode expects."""
+        height, width = self.ann_rle_size[row]
+        counts = self.rle_counts[self.ann_rle_row[row]]
+        if not counts:
+            raise KeyError('annotation {} has no maskrcnn_mask_rle'.format(self.ann_id[row]))
+        return {'size': [int(height), int(width)], 'counts': counts.encode('utf-8')}
+
+    def individual_groups(self, rows=None):
+        """Groups rows by individual name in one pass.
+
+        Returns:
+            name_ids: unique name ids (indices into self.names)
+            offsets: group g is order[offsets[g]:offsets[g + 1]]
+            order: rows sorted by name
+        """
+        rows = np.arange(len(self)) if rows is None else np.asarray(rows)
+        order = rows[np.argsort(self.ann_name[rows], kind='stable')]
+        name_ids, starts = np.unique(self.ann_name[order], return_index=True)
+        offsets = np.append(starts, len(order)).astype(np.int64)
+        return name_ids, offsets, order
+
+
+def load_index(json_path, index_dir=None, rebuild=False):
+    """Opens the index for json_path, (re)building it if missing or stale."""
+    index_dir = pathlib.Path(index_dir) if index_dir else default_index_dir(json_path)
+    if rebuild or not index_is_current(json_path, index_dir):
+        build_index(json_path, index_dir)
+    return AnnotationIndex(index_dir)
+
+
+def open_annotations(path):
+    """Opens a COCO JSON (through its index) or a split index file (.npz).
+
+    Split index files are written by train_val_test_data_split.py and hold
+    the annotation ids of one split plus the path of their source JSON.
+    """
+    path = pathlib.Path(path)
+    if path.suffix != '.npz':
+        return load_index(path)
+    with np.load(path) as split:
+        source = path.parent / str(split['source'])
+        annotation_ids = split['annotation_ids']
+    index = load_index(source)
+    return index.subset(np.sort(index.row_of(annotation_ids)))
+
+
+def main():
+    import argparse
+    import time
+
+    parser = argparse.ArgumentParser(description='Build the compact annotation index for a COCO JSON')
+    parser.add_argument('-j', '--json', type=pathlib.Path, required=True, nargs='+',
+                        help='Annotations JSON file(s) in COCO-format')
+    parser.add_argument('-o', '--index-dir', type=pathlib.Path, default=None,
+                        help='Output directory (default: <json>.index next to the JSON)')
+    parser.add_argument('-f', '--force', action='store_true', default=False,
+                        help='Rebuild even if the index is current')
+    args = parser.parse_args()
+
+    for json_path in args.json:
+        start = time.perf_counter()
+        index = load_index(json_path, args.index_dir if len(args.json) == 1 else None, rebuild=args.force)
+        built = time.perf_counter() - start
+        start = time.perf_counter()
+        AnnotationIndex(index.index_dir)
+        opened = time.perf_counter() - start
+        print('{}: {} annotations, {} images -> {} (build/check {:.2f}s, open {:.1f}ms)'.format(
+            json_path, len(index), len(index.img_id), index.index_dir, built, 1000 * opened))
+
+
+if __name__ == '__main__':
+    main()
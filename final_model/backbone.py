@@ -0,0 +1,145 @@
+"""DenseNet-201 with only its last dense blocks trainable.
+
+PartiallyFrozenDenseNet keeps the `features` / `classifier` attributes of the
+torchvision model, so its state_dict keys are unchanged and checkpoints load
+into either model. The frozen prefix of `features` runs under no_grad and
+always in inference mode (batch norm uses its running statistics and never
+updates them), so its output for an image is fixed; the trainable dense
+blocks can use activation checkpointing per dense layer, which keeps only the
+layer inputs and recomputes the bottleneck activations during backward.
+
+Passing keys (e.g. annotation ids) to forward runs the frozen prefix once per
+distinct key, so an annotation that appears in several triplets of a batch
+is only pushed through the prefix once. With an ActivationCache attached
+(see activation_cache.py), prefix outputs at the cut are also reused across
+batches and epochs, and the forward pass starts from the cut for every hit.
+"""
+
+import numpy as np
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from torch.utils.checkpoint import checkpoint
+
+NUM_DENSE_BLOCKS = 4
+
+
+def checkpointed_dense_block(block, init_features):
+    """_DenseBlock.forward with every dense layer checkpointed."""
+    features = [init_features]
+    for layer in block.values():
+        features.append(checkpoint(lambda *inputs, layer=layer: layer(list(inputs)), *features,
+                                   use_reentrant=False))
+    return torch.cat(features, 1)
+
+
+def first_occurrences(keys):
+    """(first index of every distinct key, inverse mapping back to all rows)."""
+    unique, inverse = torch.unique(keys, return_inverse=True)
+    positions = torch.arange(len(keys), device=keys.device)
+    first = torch.full((len(unique),), len(keys), dtype=positions.dtype, device=keys.device)
+    first.scatter_reduce_(0, inverse, positions, reduce='amin')
+    return first, inverse
+
+
+class PartiallyFrozenDenseNet(nn.Module):
+    """DenseNet whose last unfreeze_blocks dense blocks (and everything after them) train.
+
+    Args:
+        densenet: torchvision DenseNet with its classifier already replaced.
+        unfreeze_blocks: number of trailing dense blocks to train (0 = head only).
+        checkpointing: checkpoint the trainable dense blocks while training.
+    """
+    def __init__(self, densenet, unfreeze_blocks=1, checkpointing=True):
+        super().__init__()
+        assert 0 <= unfreeze_blocks <= NUM_DENSE_BLOCKS, 'DenseNet has {} dense blocks'.format(NUM_DENSE_BLOCKS)
+        self.features = densenet.features
+        self.classifier = densenet.classifier
+        self.unfreeze_blocks = unfreeze_blocks
+        self.checkpointing = checkpointing
+        self.stage_names = [name for name, _ in self.features.named_children()]
+        if unfreeze_blocks:
+            self.trainable_from = self.stage_index('denseblock{}'.format(NUM_DENSE_BLOCKS + 1 - unfreeze_blocks))
+        else:
+            self.trainable_from = len(self.stage_names)
+
+        for i, module in enumerate(self.features.children()):
+            for param in module.parameters():
+                param.requires_grad = i >= self.trainable_from
+        for param in self.classifier.parameters():
+            param.requires_grad = True
+        self.activation_cache = None
+        self.cache_cut = None
+
+    def attach_cache(self, cache, cut=None):
+        """Caches frozen prefix outputs before stage cut (a stage name, default the first trainable one)."""
+        cut = self.trainable_from if cut is None else self.stage_index(cut)
+        assert cut <= self.trainable_from, 'the cache cut must be in the frozen prefix'
+        self.activation_cache = cache
+        self.cache_cut = cut
+
+    def stage_index(self, name):
+        """Position of a `features` child (e.g. 'transition2') in the forward order; 'head' is the end."""
+        return len(self.stage_names) if name == 'head' else self.stage_names.index(name)
+
+    def train(self, mode=True):
+        super().train(mode)
+        for module in list(self.features.children())[:self.trainable_from]:
+            module.eval()
+        return self
+
+    def run_stages(self, h, start, stop):
+        """Runs features children [start, stop) on h."""
+        for i, module in enumerate(list(self.features.children())[start:stop], start):
+            trainable = i >= self.trainable_from
+            if trainable and self.checkpointing and self.training and self.stage_names[i].startswith('denseblock'):
+                h = checkpointed_dense_block(module, h)
+            else:
+                h = module(h)
+        return h
+
+    def prefix(self, x, stop=None, keys=None):
+        """Frozen features up to stage stop (default: the first trainable stage), without grad."""
+        stop = self.trainable_from if stop is None else stop
+        with torch.no_grad():
+            if keys is None:
+                return self.run_stages(x, 0, stop)
+            first, inverse = first_occurrences(keys)
+            return self.run_stages(x[first], 0, stop)[inverse]
+
+    def cached_prefix(self, x, keys):
+        """Frozen features before the cache cut, from the cache where possible."""
+        first, inverse = first_occurrences(keys)
+        unique_keys = keys[first].cpu().numpy()
+        found, cached = self.activation_cache.get(unique_keys)
+        missing = np.flatnonzero(~found)
+        h = None
+        if len(missing):
+            computed = self.prefix(x[first[torch.from_numpy(missing).to(first.device)]], stop=self.cache_cut)
+            computed = computed.to(torch.float16)
+            self.activation_cache.put(unique_keys[missing], computed.cpu().numpy())
+            h = x.new_empty((len(unique_keys),) + computed.shape[1:])
+            h[torch.from_numpy(missing).to(x.device)] = computed.to(x.dtype)
+        if found.any():
+            cached = torch.from_numpy(cached).to(x.device, x.dtype)
+            if h is None:
+                h = x.new_empty((len(unique_keys),) + cached.shape[1:])
+            h[torch.from_numpy(np.flatnonzero(found)).to(x.device)] = cached
+        return h[inverse]
+
+    def head(self, h, start):
+        """Embeddings from the output of stage start - 1 (start = index of the next stage)."""
+        if start < self.trainable_from:
+            with torch.no_grad():
+                h = self.run_stages(h, start, self.trainable_from)
+            start = self.trainable_from
+        h = self.run_stages(h, start, len(self.stage_names))
+        out = F.relu(h)
+        out = F.adaptive_avg_pool2d(out, (1, 1))
+        out = torch.flatten(out, 1)
+        return self.classifier(out)
+
+    def forward(self, x, keys=None):
+        if self.activation_cache is not None and keys is not None:
+            return self.head(self.cached_prefix(x, keys), self.cache_cut)
+        return self.head(self.prefix(x, keys=keys), self.trainable_from)
@@ -0,0 +1,253 @@
+"""Batched, vectorized training augmentation on collated uint8 image tensors.
+
+The PIL pipeline of the training script (RandomChoice of affine, hue jitter,
+perspective and Gaussian blur, then ToTensor, Normalize and RandomErasing)
+ran per sample in the loader workers. BatchAugment does the same on a whole
+uint8 batch [N, 3, H, W] after collation (on the training device), with
+random parameters per sample:
+
+    affine, perspective: one homography per sample, a single grid_sample
+    hue:                 batched RGB -> HSV -> RGB with a per-sample shift
+    blur:                separable grouped convolution, per-sample sigma
+    erasing:             vectorized rectangle masks
+
+Workers then only decode, crop and resize, and the same seed always gives
+the same augmentations. Given per-image keys (counter_rng.triplet_keys of
+the batch's annotation ids, see transform_triplets) the parameters of an
+image are a function of (seed, epoch, key) alone, so they don't depend on
+the batch it lands in or on the number of loader workers.
+
+Running this module times the per-sample PIL pipeline against BatchAugment.
+
+Usage:
+    python denseNet201_v6_augs.py --apply-augmentation True ...
+    python batch_augment.py --batch-size 64 --image-size 224
+"""
+
+import argparse
+import math
+import time
+
+import torch
+import torch.nn.functional as F
+
+import counter_rng
+
+IMAGENET_MEAN = (0.485, 0.456, 0.406)
+IMAGENET_STD = (0.229, 0.224, 0.225)
+AFFINE, HUE, PERSPECTIVE, BLUR = range(4)
+# Uniforms per image: choice, angle, translate (2), shear, distortion (8), hue, sigma, erasing (5)
+NUM_UNIFORMS = 20
+
+
+def normalize(images):
+    """uint8 [N, 3, H, W] (or float in [0, 1], normalized in place) -> ImageNet-normalized float."""
+    if images.dtype == torch.uint8:
+        images = images.float().div_(255)
+    mean = torch.tensor(IMAGENET_MEAN, device=images.device).view(1, 3, 1, 1)
+    std = torch.tensor(IMAGENET_STD, device=images.device).view(1, 3, 1, 1)
+    return images.sub_(mean).div_(std)
+
+
+def transform_triplets(transform, images, annotation_ids):
+    """transform of stacked triplet images; a BatchAugment is keyed by the triplets' annotation ids."""
+    if isinstance(transform, BatchAugment):
+        return transform(images, counter_rng.triplet_keys(annotation_ids))
+    return transform(images)
+
+
+def rgb_to_hsv(images):
+    """[N, 3, H, W] RGB in [0, 1] -> hue, saturation, value, each [N, H, W] in [0, 1]."""
+    r, g, b = images.unbind(1)
+    maxc, _ = images.max(1)
+    minc, _ = images.min(1)
+    delta = maxc - minc
+    saturation = torch.where(maxc > 0, delta / maxc.clamp_min(1e-12), torch.zeros_like(maxc))
+    safe_delta = delta.clamp_min(1e-12)
+    rc, gc, bc = ((maxc - c) / safe_delta for c in (r, g, b))
+    hue = torch.where(maxc == r, bc - gc, torch.where(maxc == g, 2.0 + rc - bc, 4.0 + gc - rc))
+    hue = torch.where(delta > 0, (hue / 6.0) % 1.0, torch.zeros_like(hue))
+    return hue, saturation, maxc
+
+
+def hsv_to_rgb(hue, saturation, value):
+    """Inverse of rgb_to_hsv."""
+    chroma = value * saturation
+    channels = []
+    for n in (5.0, 3.0, 1.0):
+        k = (hue * 6.0 + n) % 6.0
+        channels.append(value - chroma * torch.clamp(torch.minimum(k, 4.0 - k), 0.0, 1.0))
+    return torch.stack(channels, dim=1)
+
+
+def affine_matrices(angle, translate, shear):
+    """Forward affine maps in normalized coordinates [N, 3, 3] (degrees; translate in [-1, 1] units)."""
+    rot = torch.deg2rad(angle)
+    shear_x = torch.tan(torch.deg2rad(shear))
+    matrices = torch.zeros(len(angle), 3, 3)
+    matrices[:, 0, 0] = torch.cos(rot)
+    matrices[:, 0, 1] = -torch.cos(rot) * shear_x - torch.sin(rot)
+    matrices[:, 1, 0] = torch.sin(rot)
+    matrices[:, 1, 1] = -torch.sin(rot) * shear_x + torch.cos(rot)
+    matrices[:, :2, 2] = translate
+    matrices[:, 2, 2] = 1.0
+    return matrices
+
+
+def homographies(src, dst):
+    """[N, 3, 3] homographies mapping the 4 points src [N, 4, 2] onto dst [N, 4, 2]."""
+    x, y = src.unbind(-1)
+    u, v = dst.unbind(-1)
+    zeros, ones = torch.zeros_like(x), torch.ones_like(x)
+    rows_u = torch.stack([x, y, ones, zeros, zeros, zeros, -u * x, -u * y], dim=-1)
+    rows_v = torch.stack([zeros, zeros, zeros, x, y, ones, -v * x, -v * y], dim=-1)
+    system = torch.cat([rows_u, rows_v], dim=1)
+    coefficients = torch.linalg.solve(system, torch.cat([u, v], dim=1))
+    return torch.cat([coefficients, ones[:, :1]], dim=1).view(-1, 3, 3)
+
+
+class BatchAugment:
+    """The training augmentation on collated uint8 batches; returns normalized float images.
+
+    Args:
+        seed: seed of all augmentation parameters.
+        degrees, translate, shear: RandomAffine ranges.
+        hue: ColorJitter hue range (+-).
+        distortion_scale: RandomPerspective distortion.
+        blur_kernel, blur_sigma: GaussianBlur kernel size and sigma range.
+        erase_p, erase_scale, erase_ratio: RandomErasing probability, area and aspect ranges.
+    """
+    def __init__(self, seed=0, degrees=10, translate=0.05, shear=10, hue=0.1, distortion_scale=0.2,
+                 blur_kernel=5, blur_sigma=(0.1, 1.5), erase_p=0.5, erase_scale=(0.02, 0.10),
+                 erase_ratio=(0.3, 3.3)):
+        self.seed = seed
+        self.epoch = 0
+        self.generator = torch.Generator().manual_seed(seed)
+        self.degrees = degrees
+        self.translate = translate
+        self.shear = shear
+        self.hue = hue
+        self.distortion_scale = distortion_scale
+        self.blur_kernel = blur_kernel
+        self.blur_sigma = blur_sigma
+        self.erase_p = erase_p
+        self.erase_scale = erase_scale
+        self.erase_ratio = erase_ratio
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def __call__(self, images, keys=None):
+        """Augments uint8 images [N, 3, H, W]; keys (uint64 [N]) key each image's parameters."""
+        n, _, height, width = images.shape
+        device = images.device
+        if keys is None:
+            # Drawn for the whole batch, so the stream only depends on the seed
+            u = torch.rand(n, NUM_UNIFORMS, generator=self.generator)
+        else:
+            u = torch.from_numpy(counter_rng.uniform(counter_rng.key(self.seed, self.epoch, keys), NUM_UNIFORMS)).float()
+
+        def scale(column, low, high):
+            return low + (high - low) * column
+
+        choice = (u[:, 0] * 4).long().clamp(max=3)
+        affine = affine_matrices(scale(u[:, 1], -self.degrees, self.degrees),
+                                 scale(u[:, 2:4], -2 * self.translate, 2 * self.translate),
+                                 scale(u[:, 4], -self.shear, self.shear))
+        corners = torch.tensor([[-1.0, -1.0], [1.0, -1.0], [1.0, 1.0], [-1.0, 1.0]]).expand(n, 4, 2)
+        distorted = corners - corners.sign() * scale(u[:, 5:13].reshape(n, 4, 2), 0, self.distortion_scale)
+        hue_shift = scale(u[:, 13], -self.hue, self.hue)
+        sigma = scale(u[:, 14], *self.blur_sigma)
+        erase = u[:, 15] < self.erase_p
+        erase_area = scale(u[:, 16], *self.erase_scale) * height * width
+        erase_aspect = torch.exp(scale(u[:, 17], math.log(self.erase_ratio[0]), math.log(self.erase_ratio[1])))
+        erase_h = torch.sqrt(erase_area * erase_aspect).round().clamp(1, height)
+        erase_w = torch.sqrt(erase_area / erase_aspect).round().clamp(1, width)
+        erase_top = torch.floor(u[:, 18] * (height - erase_h + 1))
+        erase_left = torch.floor(u[:, 19] * (width - erase_w + 1))
+
+        images = images.float().div_(255)
+
+        # Affine and perspective: output pixel -> input pixel homography, one grid_sample
+        geometric = torch.nonzero((choice == AFFINE) | (choice == PERSPECTIVE)).flatten()
+        if len(geometric):
+            inverse = torch.where((choice[geometric] == AFFINE)[:, None, None],
+                                  torch.linalg.inv(affine[geometric]),
+                                  homographies(distorted[geometric], corners[geometric]))
+            ys = (2 * torch.arange(height, device=device) + 1) / height - 1
+            xs = (2 * torch.arange(width, device=device) + 1) / width - 1
+            grid_y, grid_x = torch.meshgrid(ys, xs, indexing='ij')
+            points = torch.stack([grid_x, grid_y, torch.ones_like(grid_x)], dim=-1).view(1, -1, 3)
+            mapped = points @ inverse.to(device).transpose(1, 2)
+            grid = (mapped[..., :2] / mapped[..., 2:]).view(-1, height, width, 2)
+            images[geometric] = F.grid_sample(images[geometric], grid, mode='bilinear', padding_mode='zeros',
+                                              align_corners=False)
+
+        rows = torch.nonzero(choice == HUE).flatten()
+        if len(rows):
+            hue, saturation, value = rgb_to_hsv(images[rows])
+            hue = (hue + hue_shift[rows].to(device)[:, None, None]) % 1.0
+            images[rows] = hsv_to_rgb(hue, saturation, value)
+
+        rows = torch.nonzero(choice == BLUR).flatten()
+        if len(rows):
+            offsets = torch.arange(self.blur_kernel) - (self.blur_kernel - 1) / 2
+            kernels = torch.exp(-offsets[None] ** 2 / (2 * sigma[rows, None] ** 2))
+            kernels = (kernels / kernels.sum(1, keepdim=True)).repeat_interleave(3, dim=0).to(device)
+            pad = self.blur_kernel // 2
+            blurred = F.pad(images[rows].reshape(1, -1, height, width), (pad, pad, pad, pad), mode='reflect')
+            blurred = F.conv2d(blurred, kernels[:, None, None, :], groups=len(kernels))
+            blurred = F.conv2d(blurred, kernels[:, None, :, None], groups=len(kernels))
+            images[rows] = blurred.view(len(rows), 3, height, width)
+
+        images = normalize(images)
+
+        # Erasing after normalization fills with 0, as RandomErasing(value=0) did
+        ys = torch.arange(height, device=device).view(1, -1, 1)
+        xs = torch.arange(width, device=device).view(1, 1, -1)
+        top, bottom = erase_top.to(device).view(-1, 1, 1), (erase_top + erase_h).to(device).view(-1, 1, 1)
+        left, right = erase_left.to(device).view(-1, 1, 1), (erase_left + erase_w).to(device).view(-1, 1, 1)
+        mask = erase.to(device).view(-1, 1, 1) & (ys >= top) & (ys < bottom) & (xs >= left) & (xs < right)
+        return images.masked_fill(mask[:, None], 0.0)
+
+
+def main():
+    import numpy as np
+    import torchvision
+    from PIL import Image
+
+    parser = argparse.ArgumentParser(description='Time per-sample PIL augmentation against BatchAugment')
+    parser.add_argument('--batch-size', type=int, default=64)
+    parser.add_argument('--image-size', type=int, default=224)
+    parser.add_argument('--batches', type=int, default=5)
+    args = parser.parse_args()
+
+    pil_augment = torchvision.transforms.Compose([
+        torchvision.transforms.RandomChoice([
+            torchvision.transforms.RandomAffine(degrees=10, translate=(0.05, 0.05), shear=10),
+            torchvision.transforms.ColorJitter(brightness=(1, 1), contrast=(1, 1), saturation=(1, 1),
+                                               hue=(-0.1, 0.1)),
+            torchvision.transforms.RandomPerspective(distortion_scale=0.20, p=1),
+            torchvision.transforms.GaussianBlur(5, sigma=(0.1, 1.5))]),
+        torchvision.transforms.ToTensor(),
+        torchvision.transforms.Normalize(mean=IMAGENET_MEAN, std=IMAGENET_STD),
+        torchvision.transforms.RandomErasing(p=0.5, scale=(0.02, 0.10), ratio=(0.3, 3.3), value=0),
+    ])
+    rng = np.random.RandomState(0)
+    pixels = rng.randint(0, 256, size=(args.batch_size, args.image_size, args.image_size, 3), dtype=np.uint8)
+    images = [Image.fromarray(p) for p in pixels]
+    batch = torch.from_numpy(pixels).permute(0, 3, 1, 2).contiguous()
+    batch_augment = BatchAugment(seed=0)
+
+    for name, run in [('pil_per_sample', lambda: torch.stack([pil_augment(image) for image in images])),
+                      ('batched', lambda: batch_augment(batch))]:
+        run()
+        start = time.perf_counter()
+        for _ in range(args.batches):
+            run()
+        seconds = (time.perf_counter() - start) / args.batches
+        print({'pipeline': name, 'ms_per_batch': 1000 * seconds, 'images_per_sec': args.batch_size / seconds})
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,209 @@
+"""Throughput, memory and accuracy parity of the embedding model across execution modes.
+
+Every (mode, execution, precision, batch size) configuration is timed in a
+fresh spawned process on random inputs, so peak RSS is per configuration.
+'inference' times model forwards; 'train' times a full triplet step (three
+forwards, fp32 triplet loss, backward, Adam step) and counts the three images
+of a triplet. 'compiled' runs the model through execution.prepare_model with
+--compile; warmup_seconds is the time of the first step, which includes
+compilation (or loading it from the compile cache). --unfreeze-blocks times
+fine-tuning the last K dense blocks (stacked triplet forward, activation
+checkpointing unless --no-checkpointing), to pick the deepest K that fits.
+
+With --val-json, every precision also embeds the same validation triplets and
+is compared against fp32: triplet accuracy, fraction of identical
+decisions and largest embedding difference.
+
+Usage:
+    python benchmark.py --precision fp32 bf16 --batch-sizes 16 64
+    python benchmark.py --mode inference --execution eager compiled --channels-last --batch-sizes 1 16 64
+    python benchmark.py --mode train --precision fp32 --batch-sizes 16 --unfreeze-blocks 0 1 2 3
+    python benchmark.py --precision fp32 bf16 --load-model model_model.pt \
+        --val-json customSplit_val.json --data-folder images/
+"""
+
+import argparse
+import concurrent.futures
+import itertools
+import multiprocessing
+import pathlib
+import resource
+import time
+
+import numpy as np
+import torch
+import torchvision
+
+import data_loader_triplet_v2 as data_loader
+import execution
+from denseNet201_v6_augs import initialize_model
+
+
+def peak_rss_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024  # ru_maxrss is in KB on Linux
+
+
+def build_model(load_model=None, unfreeze_blocks=0, checkpointing=True):
+    model = initialize_model(use_pretrained=False, unfreeze_blocks=unfreeze_blocks, checkpointing=checkpointing)
+    if load_model:
+        model.load_state_dict(torch.load(load_model, map_location='cpu'))
+    return model
+
+
+def time_config(mode, execution_mode, precision, batch_size, image_size, warmup, iters, threads=None,
+                load_model=None, channels_last=False, compile_cache_dir=execution.DEFAULT_COMPILE_CACHE_DIR,
+                unfreeze_blocks=0, checkpointing=True):
+    """Images/sec and peak memory of one configuration (run in its own process)."""
+    if threads:
+        torch.set_num_threads(threads)
+    device = torch.device('cpu')
+    torch.manual_seed(0)
+    model = build_model(load_model, unfreeze_blocks, checkpointing)
+    model_rss = peak_rss_mb()
+    inputs = [execution.to_device(torch.randn(batch_size, 3, image_size, image_size), device, channels_last)
+              for _ in range(3)]
+    if mode == 'inference':
+        model.eval()
+    model = execution.prepare_model(model, channels_last, execution_mode == 'compiled', compile_cache_dir,
+                                    training=mode == 'train', example_input=inputs[0])
+
+    if mode == 'inference':
+        images_per_step = batch_size
+
+        def step():
+            with torch.no_grad(), execution.autocast(precision, device):
+                model(inputs[0])
+    else:
+        model.train()
+        images_per_step = 3 * batch_size
+        optimizer = torch.optim.Adam([p for p in model.parameters() if p.requires_grad], lr=1e-4)
+
+        def step():
+            optimizer.zero_grad()
+            with execution.autocast(precision, device):
+                if unfreeze_blocks:
+                    embeddings = model(torch.cat(inputs)).chunk(3)
+                else:
+                    embeddings = [model(x) for x in inputs]
+            execution.triplet_loss(*embeddings, margin=1.0).backward()
+            optimizer.step()
+
+    start = time.perf_counter()
+    step()
+    warmup_seconds = time.perf_counter() - start
+    for _ in range(warmup - 1):
+        step()
+    start = time.perf_counter()
+    for _ in range(iters):
+        step()
+    seconds = time.perf_counter() - start
+    return {
+        'mode': mode,
+        'execution': execution_mode,
+        'channels_last': channels_last,
+        'precision': precision,
+        'batch_size': batch_size,
+        'unfreeze_blocks': unfreeze_blocks,
+        'checkpointing': checkpointing,
+        'images_per_sec': images_per_step * iters / seconds,
+        'warmup_seconds': warmup_seconds,
+        'peak_rss_mb': peak_rss_mb(),
+        'peak_rss_over_model_mb': peak_rss_mb() - model_rss,
+    }
+
+
+def embed_triplets(model, loader, precision, device):
+    """Embeddings [num_triplets, 3, dim] (float32) of every triplet of the loader."""
+    model.eval()
+    embeddings = []
+    with torch.no_grad():
+        for images, _ in loader:
+            with execution.autocast(precision, device):
+                batch = [model(x.to(device)).float() for x in images]
+            embeddings.append(torch.stack(batch, dim=1).cpu().numpy())
+    return np.concatenate(embeddings)
+
+
+def triplet_decisions(embeddings):
+    positive = np.linalg.norm(embeddings[:, 0] - embeddings[:, 1], axis=-1)
+    negative = np.linalg.norm(embeddings[:, 0] - embeddings[:, 2], axis=-1)
+    return positive < negative
+
+
+def accuracy_parity(args):
+    """Triplet accuracy per precision on the same validation triplets, vs. fp32."""
+    device = torch.device('cpu')
+    transforms = torchvision.transforms.Compose([
+        torchvision.transforms.Resize(args.image_size),
+        torchvision.transforms.CenterCrop(args.image_size),
+        torchvision.transforms.ToTensor(),
+        torchvision.transforms.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225]),
+    ])
+    np.random.seed(2021)
+    dataset = data_loader.TripletZebras(args.data_folder, args.val_json, transforms,
+                                        num_triplets=args.num_val_triplets)
+    loader = torch.utils.data.DataLoader(dataset, batch_size=args.batch_sizes[-1], shuffle=False,
+                                         num_workers=args.num_workers)
+    model = build_model(args.load_model)
+
+    reference = embed_triplets(model, loader, 'fp32', device)
+    reference_decisions = triplet_decisions(reference)
+    for precision in args.precision:
+        embeddings = reference if precision == 'fp32' else embed_triplets(model, loader, precision, device)
+        decisions = triplet_decisions(embeddings)
+        print({
+            'precision': precision,
+            'triplets': len(decisions),
+            'accuracy': float(decisions.mean()),
+            'same_decision_as_fp32': float((decisions == reference_decisions).mean()),
+            'max_abs_embedding_diff': float(np.abs(embeddings - reference).max()),
+        })
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark execution modes of the embedding model')
+    parser.add_argument('--precision', choices=execution.PRECISIONS, nargs='+', default=['fp32', 'bf16'])
+    parser.add_argument('--mode', choices=['inference', 'train'], nargs='+', default=['inference', 'train'])
+    parser.add_argument('--execution', choices=['eager', 'compiled'], nargs='+', default=['eager'],
+                        help='eager and/or compiled (torch.compile, TorchScript freeze fallback) execution')
+    parser.add_argument('--channels-last', action='store_true', default=False,
+                        help='run convolutions in channels_last (NHWC) memory format')
+    parser.add_argument('--compile-cache-dir', type=pathlib.Path, default=execution.DEFAULT_COMPILE_CACHE_DIR,
+                        help='where compiled graphs are cached between runs')
+    parser.add_argument('--batch-sizes', type=int, nargs='+', default=[1, 16, 64])
+    parser.add_argument('--unfreeze-blocks', type=int, nargs='+', default=[0],
+                        help='numbers of trailing dense blocks to fine-tune')
+    parser.add_argument('--no-checkpointing', action='store_true', default=False,
+                        help='keep all activations of the unfrozen blocks')
+    parser.add_argument('--image-size', type=int, default=224,
+                        help='Input to CNN will be size (image_size, image_size, 3)')
+    parser.add_argument('--warmup', type=int, default=3, help='untimed steps per configuration (at least 1)')
+    parser.add_argument('--iters', type=int, default=10, help='timed steps per configuration')
+    parser.add_argument('--threads', type=int, default=None, help='intra-op threads (default: torch default)')
+    parser.add_argument('--load-model', type=str, default=None,
+                        help='state_dict of a trained model (random classifier head otherwise)')
+    parser.add_argument('--val-json', type=str, default=None,
+                        help='also compare accuracy on these validation triplets')
+    parser.add_argument('--data-folder', type=str, default=None,
+                        help='folder containing data images')
+    parser.add_argument('--num-val-triplets', type=int, default=1000)
+    parser.add_argument('--num-workers', type=int, default=4)
+    args = parser.parse_args()
+
+    context = multiprocessing.get_context('spawn')
+    configs = itertools.product(args.mode, args.unfreeze_blocks, args.execution, args.batch_sizes, args.precision)
+    for mode, unfreeze_blocks, execution_mode, batch_size, precision in configs:
+        # A fresh process per configuration keeps peak memory comparable
+        with concurrent.futures.ProcessPoolExecutor(max_workers=1, mp_context=context) as pool:
+            result = pool.submit(time_config, mode, execution_mode, precision, batch_size, args.image_size,
+                                 max(args.warmup, 1), args.iters, args.threads, args.load_model,
+                                 args.channels_last, args.compile_cache_dir,
+                                 unfreeze_blocks, not args.no_checkpointing).result()
+        print(result)
+
+    if args.val_json:
+        accuracy_parity(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,90 @@
+"""Counter-based random numbers keyed by (seed, epoch, index).
+
+The scripts seeded the global np.random / torch RNGs in the main process and
+drew from them wherever randomness was needed, so results depended on how
+many draws happened before (worker count, batching, resumed epochs). Here a
+random number is a pure function of its key and counter: key() hashes
+integer parts such as (seed, epoch, sample index) with SplitMix64, and
+uniform() returns counter j = 0, 1, ... of every key, vectorized over many
+keys. Nothing is shared between samples, so no generator state has to be
+passed around or locked, and a sample gets the same numbers in any process
+and in any batch.
+
+Used for the triplet table (TripletZebras), the epoch order of the triplets
+(EpochRandomSampler) and the BatchAugment parameters of every triplet image.
+
+Usage:
+    u = uniform(key(seed, epoch, np.arange(n)), 4)   # [n, 4] floats in [0, 1)
+"""
+
+import numpy as np
+import torch
+
+GOLDEN = np.uint64(0x9E3779B97F4A7C15)
+
+
+def mix64(x):
+    """SplitMix64 finalizer of a uint64 array."""
+    with np.errstate(over='ignore'):
+        x = (x ^ (x >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+        x = (x ^ (x >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+        return x ^ (x >> np.uint64(31))
+
+
+def key(*parts):
+    """uint64 keys hashing the (broadcast) integer parts, e.g. key(seed, epoch, indices)."""
+    h = np.zeros((), dtype=np.uint64)
+    with np.errstate(over='ignore'):
+        for part in parts:
+            h = mix64(np.atleast_1d(h) ^ (np.asarray(part).astype(np.int64).astype(np.uint64) + GOLDEN))
+    return np.atleast_1d(h)
+
+
+def uniform(keys, draws):
+    """float64 [len(keys), draws] in [0, 1): counter j = 0 .. draws - 1 of every key."""
+    with np.errstate(over='ignore'):
+        counters = keys[:, None] + GOLDEN * np.arange(1, draws + 1, dtype=np.uint64)
+    return (mix64(counters) >> np.uint64(11)) * 2.0 ** -53
+
+
+def triplet_keys(annotation_ids):
+    """One key per image of stacked triplets ([anchor ids, positive ids, negative ids] -> [3 * N]).
+
+    An image is keyed by its whole triplet and its role, so its randomness
+    doesn't depend on the batch it lands in.
+    """
+    anchor, positive, negative = (torch.as_tensor(ids).numpy() for ids in annotation_ids)
+    roles = np.repeat(np.arange(3), len(anchor))
+    return key(np.tile(anchor, 3), np.tile(positive, 3), np.tile(negative, 3), roles)
+
+
+class EpochRandomSampler(torch.utils.data.Sampler):
+    """Random order of range(len(dataset)), a function of (seed, epoch) only (call set_epoch).
+
+    With num_replicas > 1 it yields only every num_replicas-th index of that
+    order, from rank on: the ranks share the dataset without the padding
+    (repeated indices) of DistributedSampler, so sums over ranks count every
+    index once. Ranks may get one index less than others.
+
+    Args:
+        dataset: sized dataset.
+        seed: seed of the order.
+        num_replicas, rank: processes sharing the dataset, and this one.
+    """
+    def __init__(self, dataset, seed=0, num_replicas=1, rank=0):
+        self.dataset = dataset
+        self.seed = seed
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.epoch = 0
+
+    def __iter__(self):
+        n = len(self.dataset)
+        order = np.argsort(uniform(key(self.seed, self.epoch, np.arange(n)), 1)[:, 0])
+        return iter(order[self.rank::self.num_replicas].tolist())
+
+    def __len__(self):
+        return len(range(self.rank, len(self.dataset), self.num_replicas))
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
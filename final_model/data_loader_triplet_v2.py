@@ -4,111 +4,95 @@ https://github.com/yunjey/pytorch-tutorial/blob/master/tutorials/03-advanced/ima
 
 import torch
 import torchvision
+import io
 import os.path
 import pathlib
 from PIL import Image
-from pycocotools.coco import COCO
 import pycocotools.mask as mask_util
 import numpy as np
 import matplotlib.pyplot as plt
-from tqdm import tqdm
 
-class TripletZebras(torch.utils.data.Dataset):
-    """COCO Custom Dataset compatible with torch.utils.data.DataLoader."""
-    def __init__(self, root, json, transform=None, num_triplets=100*1000, apply_mask=False, apply_mask_bbox=False):
+import annotation_index
+import counter_rng
+import hard_negatives
+import shared_batches
+import triplet_replay
+
+class ZebraAnnotations(torch.utils.data.Dataset):
+    """Image loading (with optional segmentation mask / bbox crop) shared by the datasets below."""
+    def __init__(self, root, json, transform=None, apply_mask=False, apply_mask_bbox=False):
         """Set the path for images and annotations.
 
         Args:
             root: image directory.
-            json: coco annotation file path.
+            json: coco annotation file path (its compact index is built on first use),
+                or a split index file (.npz).
             transform: image transformer.
-            filter_category (iterable): set of categories to include, e.g. [0, 1]
         """
         self.root = root
-        coco = COCO(json)
-        self.annotations = coco.anns
-        self.images = coco.imgs
+        self.index = annotation_index.open_annotations(json)
         self.mask = apply_mask
         self.mask_bbox = apply_mask_bbox
-
-        assert not (apply_mask and apply_mask_bbox), 'Can only choose one mask-type'
-        
-        zebra_annotations = [ann for ann in self.annotations.values() if ann['category_id'] == 1]
-        zebra_names = [ann['name'] for ann in zebra_annotations]
-        unique_zebra_names, zebra_names_counts = np.unique(zebra_names, return_counts=True) # numpy arrays
-        anchors = unique_zebra_names[np.where(zebra_names_counts > 1)]
-
-        # Generate triplets of annotation IDs (keys into self.annotations dictionary)
-        triplets = []
-        for i in tqdm(np.arange(num_triplets)):
-            triplets.append(self.generate_triplet(anchors, unique_zebra_names))
-        # Remove duplicates
-        triplets = np.unique(triplets, axis=0).tolist()
-
-        self.triplets = triplets
         self.transform = transform
+        # Optional readahead.ByteReadahead the frames are read through
+        self.readahead = None
 
-    def __getitem__(self, index):
-        """Returns triplet of images"""
-
-        assert len(self.triplets[index]) == 3, 'Expected triplet corresponding to anchor, positive, negative'
-
-        anchor_positive_negative = []
-        for annotation_id in self.triplets[index]:
-            annotation = self.annotations[annotation_id]
-            assert annotation['id'] == annotation_id
-
-            image_id = annotation['image_id']
-            image_info = self.images[image_id]
-            assert image_info['id'] == image_id
-
-            image_fname = image_info['file_name']
-            image_path = os.path.join(self.root, image_fname)
-
-            # Load image
-            image = Image.open(image_path).convert('RGB')
-            
-            # Apply segmentation mask
-            if self.mask==True:
-                mask = mask_util.decode(annotation['maskrcnn_mask_rle'])
-                segImage  = np.array(image)
-                binaryMask = (mask > 0.5).astype(np.float32)
-                segImage[np.where(binaryMask == 0.0)] = 0
-                image = Image.fromarray(np.uint8(segImage)).convert('RGB')
-                # Crop to bounding box
-                image = self.crop_to_bbox(image, annotation['maskrcnn_bbox'])
-            
-            if self.mask_bbox:
-                # Crop to bounding box
-                image = self.crop_to_bbox(image, annotation['maskrcnn_bbox'])
-
-            # Transform to tensor
-            if self.transform:
-                image = self.transform(image)
-
-            # Save to list
-            anchor_positive_negative.append(image)
-
-        return anchor_positive_negative, self.triplets[index]
-
-    def __len__(self):
-        return len(self.triplets)
-
-    def generate_triplet(self, anchors, unique_zebra_names):
-        anchor_zebra_name = np.random.choice(anchors, replace=True)
-        # Get annotations (ie, bounding boxes) associated with this individual
-        anchor_all_annotation_ids = [ann_id for (ann_id, ann) in self.annotations.items() if ann['name'] == anchor_zebra_name]
-
-        # Pick 2 bboxes to be anchor and positive
-        anchor_annotation_id, positive_annotation_id = np.random.choice(anchor_all_annotation_ids, size=2, replace=False)
-
-        # Pick a zebra individual that is NOT our anchor/positive
-        other_zebra_names = np.setdiff1d(unique_zebra_names, anchor_zebra_name)
-        neg_zebra_name = np.random.choice(other_zebra_names, replace=False)
-        negative_all_annotation_ids = [ann_id for (ann_id, ann) in self.annotations.items() if ann['name'] == neg_zebra_name]
-        negative_annotation_id = np.random.choice(negative_all_annotation_ids, replace=False)
+        assert not (apply_mask and apply_mask_bbox), 'Can only choose one mask-type'
 
-        return (anchor_annotation_id, positive_annotation_id, negative_annotation_id)
+    def load_image(self, row):
+        """Loads the image of one annotation (index row), masked/cropped and transformed."""
+        return self.crop_annotation(self.decode_frame(row), row)
+
+    def load_images(self, rows):
+        """load_image for several rows, decoding every frame only once; returns (images, decodes)."""
+        rows = np.asarray(rows)
+        frames = np.asarray(self.index.ann_image_row)[rows]
+        order = np.argsort(frames, kind='stable')
+        starts = np.flatnonzero(np.r_[True, frames[order][1:] != frames[order][:-1]])
+        self.prefetch(rows[order[starts]])
+        images = [None] * len(rows)
+        for group in np.split(order, starts[1:]):
+            image = self.decode_frame(rows[group[0]])
+            for i in group:
+                images[i] = self.crop_annotation(image, rows[i])
+        return images, len(starts)
+
+    def decode_frame(self, row):
+        """The decoded (RGB) frame annotation row is in."""
+        image_path = os.path.join(self.root, self.index.image_path(row))
+        if self.readahead is not None:
+            return Image.open(io.BytesIO(self.readahead.read(image_path))).convert('RGB')
+        return Image.open(image_path).convert('RGB')
+
+    def prefetch(self, rows):
+        """Hints the readahead (if any) that the frames of these rows are read next."""
+        if self.readahead is not None:
+            self.readahead.hint([os.path.join(self.root, self.index.image_path(row)) for row in rows])
+
+    def crop_annotation(self, image, row):
+        """Masks/crops one annotation out of its decoded frame and transforms it."""
+        # Apply segmentation mask
+        if self.mask==True:
+            mask = mask_util.decode(self.index.mask_rle(row))
+            segImage  = np.array(image)
+            binaryMask = (mask > 0.5).astype(np.float32)
+            segImage[np.where(binaryMask == 0.0)] = 0
+            image = Image.fromarray(np.uint8(segImage)).convert('RGB')
+            # Crop to bounding box
+            image = self.crop_to_bbox(image, self.index.ann_maskrcnn_bbox[row])
+
+        if self.mask_bbox:
+            # Crop to bounding box
+            image = self.crop_to_bbox(image, self.index.ann_maskrcnn_bbox[row])
+
+        # Transform to tensor
+        if self.transform:
+            image = self.transform(image)
+        return image
+
+    def annotation_name(self, annotation_id):
+        """Individual name for an annotation id."""
+        return self.index.name(self.index.row_of(annotation_id))
 
     def crop_to_bbox(self, image: Image.Image, bbox: tuple):
         # Assume order of bbox from maskrcnn
@@ -128,26 +112,183 @@ class TripletZebras(torch.utils.data.Dataset):
         return cropped_image
 
 
-def get_loader(root, json, transform, batch_size, shuffle=True, num_workers=4, num_triplets=100*1000, apply_mask=False, apply_mask_bbox=False):
+class AnnotationCrops(ZebraAnnotations):
+    """One item per annotation: (image, annotation ID), e.g. for embedding a gallery.
+
+    A list of positions (a batch from frame_batches.FrameBatchSampler) gives
+    (stacked images, annotation IDs, number of frames decoded) instead.
+    """
+    def __init__(self, root, json, transform=None, category_ids=(1,), apply_mask=False, apply_mask_bbox=False):
+        super().__init__(root, json, transform=transform, apply_mask=apply_mask, apply_mask_bbox=apply_mask_bbox)
+        self.rows = self.index.rows_for_categories(list(category_ids))
+
+    def __getitem__(self, index):
+        if isinstance(index, list):
+            rows = self.rows[index]
+            images, decodes = self.load_images(rows)
+            return torch.stack(images), torch.as_tensor(self.index.ann_id[rows], dtype=torch.int64), decodes
+        row = self.rows[index]
+        return self.load_image(row), int(self.index.ann_id[row])
+
+    def __len__(self):
+        return len(self.rows)
+
+
+class TripletZebras(ZebraAnnotations):
+    """COCO Custom Dataset compatible with torch.utils.data.DataLoader."""
+    def __init__(self, root, json, transform=None, num_triplets=100*1000, apply_mask=False, apply_mask_bbox=False,
+                 seed=None):
+        """Set the path for images and annotations.
+
+        Args:
+            root: image directory.
+            json: coco annotation file path (its compact index is built on first use),
+                or a split index file (.npz).
+            transform: image transformer.
+            num_triplets: number of (anchor, positive, negative) triplets to draw.
+            seed: triplet i is drawn from counter_rng keys (seed, i); None draws from the global np.random.
+        """
+        super().__init__(root, json, transform=transform, apply_mask=apply_mask, apply_mask_bbox=apply_mask_bbox)
+
+        # Group zebra annotations (rows of the index) by individual
+        zebra_rows = self.index.rows_for_categories([1])
+        name_ids, self.group_offsets, self.group_rows = self.index.individual_groups(zebra_rows)
+        self.group_sizes = np.diff(self.group_offsets)
+        anchors = np.flatnonzero(self.group_sizes > 1)
+
+        # Generate triplets of annotation IDs
+        triplets = self.generate_triplets(num_triplets, anchors, seed)
+        # Remove duplicates
+        triplets = np.unique(triplets, axis=0).tolist()
+
+        self.triplets = triplets
+
+    def __getitem__(self, index):
+        """Returns triplet of images (index may also be an (anchor, positive, negative) id triplet)"""
+        triplet = list(index) if isinstance(index, (tuple, list)) else self.triplets[index]
+
+        assert len(triplet) == 3, 'Expected triplet corresponding to anchor, positive, negative'
+
+        # The three frames are read (with a readahead) concurrently, and decoded once if shared
+        anchor_positive_negative, _ = self.load_images(self.index.row_of(np.asarray(triplet)))
+
+        return anchor_positive_negative, triplet
+
+    def __len__(self):
+        return len(self.triplets)
+
+    def generate_triplets(self, num_triplets, anchors, seed=None):
+        """Vectorized triplet sampling over the per-individual groups.
+
+        Args:
+            num_triplets: number of (anchor, positive, negative) triplets to draw.
+            anchors: group indices of individuals with at least 2 sightings.
+            seed: counter_rng seed (None = global np.random).
+        Returns:
+            int64 array [num_triplets, 3] of annotation IDs
+        """
+        sizes = self.group_sizes
+        if seed is None:
+            u = np.random.random((num_triplets, 5))
+        else:
+            u = counter_rng.uniform(counter_rng.key(seed, np.arange(num_triplets)), 5)
+
+        def pick(u, n):
+            return np.minimum(np.floor(u * n), n - 1).astype(np.int64)
+
+        # Pick an individual with >= 2 sightings, then 2 distinct sightings of it
+        anchor_group = anchors[pick(u[:, 0], len(anchors))]
+        anchor_pick = pick(u[:, 1], sizes[anchor_group])
+        positive_pick = pick(u[:, 2], sizes[anchor_group] - 1)
+        positive_pick += positive_pick >= anchor_pick
+
+        # Pick a zebra individual that is NOT our anchor/positive, then one of its sightings
+        negative_group = pick(u[:, 3], len(sizes) - 1)
+        negative_group += negative_group >= anchor_group
+        negative_pick = pick(u[:, 4], sizes[negative_group])
+
+        offsets = self.group_offsets
+        rows = np.stack([
+            self.group_rows[offsets[anchor_group] + anchor_pick],
+            self.group_rows[offsets[anchor_group] + positive_pick],
+            self.group_rows[offsets[negative_group] + negative_pick],
+        ], axis=1)
+        return np.asarray(self.index.ann_id)[rows]
+
+
+def loader_options(num_workers=4, pin_memory=False, persistent_workers=False, prefetch_factor=2):
+    """DataLoader keyword arguments; the worker-only ones are left out without workers."""
+    options = {'num_workers': num_workers, 'pin_memory': pin_memory}
+    if num_workers > 0:
+        options.update(persistent_workers=persistent_workers, prefetch_factor=prefetch_factor)
+    return options
+
+
+def get_loader(root, json, transform, batch_size, shuffle=True, num_workers=4, num_triplets=100*1000, apply_mask=False, apply_mask_bbox=False, distributed=False, seed=0, miner=None, replay=None, replay_fraction=0.25,
+               pin_memory=False, persistent_workers=False, prefetch_factor=2, shared_memory=False, image_size=None,
+               readahead=None, pad=True):
     zebra_triplets = TripletZebras(root=root,
         json=json,
         transform=transform,
         num_triplets=num_triplets,
         apply_mask=apply_mask,
-        apply_mask_bbox=apply_mask_bbox
+        apply_mask_bbox=apply_mask_bbox,
+        seed=seed
     )
+    # Frames read ahead into memory by a thread pool (see readahead.py)
+    zebra_triplets.readahead = readahead
+
+    # Each process of a distributed run loads its own shard of the triplets
+    # (every rank draws the same triplets, keyed by seed); the order is a function
+    # of (seed, epoch), whatever the number of workers (call set_epoch).
+    # DistributedSampler pads the shards to equal length with repeated triplets;
+    # evaluation loaders (pad=False) split them unpadded so every triplet counts once
+    if distributed and pad:
+        sampler = torch.utils.data.distributed.DistributedSampler(zebra_triplets, shuffle=True, seed=seed)
+    elif distributed:
+        sampler = counter_rng.EpochRandomSampler(zebra_triplets, seed, num_replicas=torch.distributed.get_world_size(),
+                                                 rank=torch.distributed.get_rank())
+    elif shuffle:
+        sampler = counter_rng.EpochRandomSampler(zebra_triplets, seed)
+    else:
+        sampler = torch.utils.data.SequentialSampler(zebra_triplets)
+    # Negatives mined from the current embeddings (see hard_negatives.py)
+    if miner is not None:
+        sampler = hard_negatives.HardNegativeSampler(zebra_triplets, miner, sampler, seed=seed)
+    options = loader_options(num_workers, pin_memory, persistent_workers, prefetch_factor)
+    # Batches mixing replayed high-loss triplets with fresh ones (see triplet_replay.py)
+    batch_sampler = None
+    if replay is not None:
+        batch_sampler = triplet_replay.ReplayBatchSampler(
+            zebra_triplets, replay, sampler, batch_size, replay_fraction, seed=seed)
+    # Workers write uint8 crops into a shared-memory batch ring (see shared_batches.py);
+    # transform must return uint8 [3, image_size, image_size] tensors
+    if shared_memory:
+        if batch_sampler is None:
+            batch_sampler = torch.utils.data.BatchSampler(sampler, batch_size, drop_last=False)
+        return shared_batches.SharedBatchLoader(zebra_triplets, batch_sampler, image_size, options)
+    if batch_sampler is not None:
+        return torch.utils.data.DataLoader(dataset=zebra_triplets, batch_sampler=batch_sampler, **options)
 
     # Data loader for COCO dataset
     # This will return (images, animal-ID) for each iteration.
     # images: a tensor of shape (batch_size, 3, INPUT_SIZE, INPUT_SIZE).
     data_loader = torch.utils.data.DataLoader(dataset=zebra_triplets,
-                batch_size=32,
-                shuffle=True,
-                num_workers=num_workers)
+                batch_size=batch_size,
+                sampler=sampler,
+                **options)
     
     return data_loader
 
 
+def set_epoch(loader, epoch):
+    """Keys the epoch's randomness of a get_loader (or shards.get_stream_loader) loader by epoch."""
+    for sampler in (getattr(loader, 'batch_sampler', None), loader.sampler):
+        if hasattr(sampler, 'set_epoch'):
+            sampler.set_epoch(epoch)
+            return
+
+
 def main():
     # Example usage of the dataset loader
     # These packages are only necessary for this test, so we import here
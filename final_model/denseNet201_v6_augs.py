@@ -6,6 +6,17 @@ import numpy as np
 import torch.nn as nn
 import torch.optim as optim
 import data_loader_triplet_v2 as data_loader
+import activation_cache
+import backbone
+import batch_augment
+import distributed
+import execution
+import hard_negatives
+import prefetch
+import readahead
+import shards
+import triplet_replay
+from torch.nn.parallel import DistributedDataParallel
 from torch.optim.lr_scheduler import StepLR
 import matplotlib.pyplot as plt
 from matplotlib import cm
@@ -14,7 +25,7 @@ import json
 from sklearn.manifold import TSNE
 
 
-def initialize_model(use_pretrained=True, l1Units = 512, l2Units=128):
+def initialize_model(use_pretrained=True, l1Units = 512, l2Units=128, unfreeze_blocks=0, checkpointing=True):
 
     model = torch.hub.load('pytorch/vision:v0.9.0', 'densenet201', pretrained=use_pretrained)
     for param in model.parameters():
@@ -27,9 +38,12 @@ def initialize_model(use_pretrained=True, l1Units = 512, l2Units=128):
             nn.ReLU(),
             nn.Linear(l1Units, l2Units)
             )
+    if unfreeze_blocks:
+        # fine-tune the last dense blocks too; state_dict keys stay the same
+        model = backbone.PartiallyFrozenDenseNet(model, unfreeze_blocks, checkpointing)
     return model
 
-def train(args, model, device, train_loader, optimizer, epoch, margin):
+def train(args, model, device, train_loader, optimizer, epoch, margin, miner=None, replay=None, batch_transform=None):
     '''
     This is your training function. When you call this function, the model is
     trained for 1 epoch.
@@ -38,20 +52,43 @@ def train(args, model, device, train_loader, optimizer, epoch, margin):
     for batch_idx, batch in enumerate(train_loader):
         anchor_positive_negative_imgs, anchor_positive_negative_anns = batch
         anchor_img, positive_img, negative_img = anchor_positive_negative_imgs
-        anchor_img, positive_img, negative_img = anchor_img.to(device), positive_img.to(device), negative_img.to(device)
+        if batch_transform is not None:
+            # Augment the collated uint8 triplets as one batch on the device
+            images = batch_augment.transform_triplets(
+                batch_transform, torch.cat([anchor_img, positive_img, negative_img]).to(device),
+                anchor_positive_negative_anns)
+            anchor_img, positive_img, negative_img = images.chunk(3)
+        anchor_img, positive_img, negative_img = (execution.to_device(x, device, args.channels_last)
+                                                  for x in (anchor_img, positive_img, negative_img))
         optimizer.zero_grad()  # Clear the gradient
-        anchor_emb = model(anchor_img)
-        positive_emb = model(positive_img)
-        negative_emb = model(negative_img)
-        loss = F.triplet_margin_loss(anchor_emb, positive_emb, negative_emb, margin=margin, p=2)  # sum up batch loss
+        with execution.autocast(args.precision, device):
+            if args.unfreeze_blocks or args.activation_cache:
+                # One pass over the stacked triplets, so the frozen prefix runs once per distinct
+                # annotation (augmented images differ, so they are never shared)
+                keys = None if args.apply_augmentation else torch.cat(anchor_positive_negative_anns).to(device)
+                embeddings = model(torch.cat([anchor_img, positive_img, negative_img]), keys=keys)
+                anchor_emb, positive_emb, negative_emb = embeddings.chunk(3)
+            else:
+                anchor_emb = model(anchor_img)
+                positive_emb = model(positive_img)
+                negative_emb = model(negative_img)
+        if replay is not None:
+            # Keep per-triplet losses: high-loss triplets are replayed, zero-loss ones skipped for a while
+            losses = execution.triplet_loss(anchor_emb, positive_emb, negative_emb, margin, reduction='none')
+            replay.record(torch.stack(anchor_positive_negative_anns, 1).numpy(), losses.detach().cpu().numpy())
+            loss = losses.mean()
+        else:
+            loss = execution.triplet_loss(anchor_emb, positive_emb, negative_emb, margin)  # sum up batch loss
         loss.backward()  # Gradient computation
         optimizer.step()  # Perform a single optimization step
-        if batch_idx % args.batch_log_interval == 0:
+        if miner is not None:
+            miner.step(model)  # refresh the hard-negative index in the background when due
+        if batch_idx % args.batch_log_interval == 0 and distributed.is_main_process():
             print('Train Epoch: {} [{}/{} ({:.0f}%)]\tLoss: {:.6f}'.format(
                 epoch, batch_idx * len(anchor_img), len(train_loader.sampler),
                        100. * batch_idx / len(train_loader), loss.item()))
 
-def test(model, device, test_loader, dataName, margin):
+def test(model, device, test_loader, dataName, margin, precision='fp32', channels_last=False, batch_transform=None):
     model.eval()  # Set the model to inference mode
     test_loss = 0
     correct = 0 # number of times it gets the distances correct
@@ -60,23 +97,35 @@ def test(model, device, test_loader, dataName, margin):
         for batch_idx, batch in enumerate(test_loader):
             anchor_positive_negative_imgs, anchor_positive_negative_anns = batch
             anchor_img, positive_img, negative_img = anchor_positive_negative_imgs
-            anchor_img, positive_img, negative_img = anchor_img.to(device), positive_img.to(device), negative_img.to(device)
-            anchor_emb = model(anchor_img)
-            positive_emb = model(positive_img)
-            negative_emb = model(negative_img)
+            if batch_transform is not None:
+                images = batch_augment.transform_triplets(
+                    batch_transform, torch.cat([anchor_img, positive_img, negative_img]).to(device),
+                    anchor_positive_negative_anns)
+                anchor_img, positive_img, negative_img = images.chunk(3)
+            anchor_img, positive_img, negative_img = (execution.to_device(x, device, channels_last)
+                                                      for x in (anchor_img, positive_img, negative_img))
+            with execution.autocast(precision, device):
+                anchor_emb = model(anchor_img)
+                positive_emb = model(positive_img)
+                negative_emb = model(negative_img)
+            anchor_emb, positive_emb, negative_emb = anchor_emb.float(), positive_emb.float(), negative_emb.float()
             # function that takes output and turns into anchor, positive, negative
-            test_loss += F.triplet_margin_loss(anchor_emb, positive_emb, negative_emb, margin=margin, p=2) # sum up batch loss
+            test_loss += execution.triplet_loss(anchor_emb, positive_emb, negative_emb, margin) # sum up batch loss
 
             predict_match = torch.linalg.norm(anchor_emb - positive_emb, dim=-1) < torch.linalg.norm(anchor_emb - negative_emb, dim=-1)
 
             correct += predict_match.sum()
             test_num += len(predict_match)
 
+    # Sum over all processes of a distributed run
+    totals = distributed.all_reduce_sum(torch.tensor([float(test_loss), float(correct), float(test_num)]))
+    test_loss, correct, test_num = totals[0], int(totals[1]), int(totals[2])
     test_loss /= test_num
 
-    print('\n' + dataName + ' tested: Average loss: {:.4f}, Accuracy: {}/{} ({:.0f}%)\n'.format(
-        test_loss, correct, test_num,
-        100. * correct / test_num))
+    if distributed.is_main_process():
+        print('\n' + dataName + ' tested: Average loss: {:.4f}, Accuracy: {}/{} ({:.0f}%)\n'.format(
+            test_loss, correct, test_num,
+            100. * correct / test_num))
 
 
     return test_loss #, correct, test_num
@@ -120,14 +169,14 @@ def main():
                             os.environ.get('SM_CHANNEL_ANNOTATIONS', '.'),
                             'customSplit_train.json'
                         ),
-                        help='JSON with COCO-format annotations for training dataset')
+                        help='JSON with COCO-format annotations (or split index .npz) for training dataset')
     parser.add_argument('--val-json',
                         # For AWS, get path from folder
                         default=os.path.join(
                             os.environ.get('SM_CHANNEL_ANNOTATIONS', '.'),
                             'customSplit_val.json'
                         ),
-                        help='JSON with COCO-format annotations for validation dataset')
+                        help='JSON with COCO-format annotations (or split index .npz) for validation dataset')
     parser.add_argument('--model-dir', type=str, default=os.environ.get('SM_MODEL_DIR', '.'))
     parser.add_argument('--output-data-dir', type=str, default=os.environ.get('SM_OUTPUT_DATA_DIR', '.'))
     parser.add_argument('--batch-log-interval', type=int, default=10,
@@ -144,22 +193,79 @@ def main():
                         help='Input to CNN will be size (image_size, image_size, 3)')
     parser.add_argument('--apply-augmentation',  type=bool, default = False,
                     help='Applies image augmentations')
+    parser.add_argument('--distributed', action='store_true', default=False,
+                        help='data-parallel training over the processes started by torchrun (gloo backend)')
+    parser.add_argument('--threads-per-process', type=int, default=None,
+                        help='intra-op threads per process with --distributed (default: cores / processes per box)')
+    parser.add_argument('--unfreeze-blocks', type=int, default=0,
+                        help='also fine-tune the last K dense blocks of DenseNet-201 (0 = classifier head only)')
+    parser.add_argument('--no-checkpointing', action='store_true', default=False,
+                        help='keep all activations of the unfrozen blocks instead of recomputing them in backward')
+    parser.add_argument('--activation-cache', type=str, default=None,
+                        help='folder for cached frozen-prefix feature maps (needs un-augmented images)')
+    parser.add_argument('--cache-cut', type=str, default=None,
+                        help='stage the cached forward pass starts from, e.g. denseblock3 (default: first trainable one)')
+    parser.add_argument('--cache-size-gb', type=float, default=10,
+                        help='disk budget of the activation cache')
+    parser.add_argument('--hard-negatives', choices=hard_negatives.MINING_MODES, default=None,
+                        help='mine semi-hard or hard training negatives from the current embeddings')
+    parser.add_argument('--mining-refresh-steps', type=int, default=100,
+                        help='optimizer steps between refreshes of the hard-negative index')
+    parser.add_argument('--mining-neighbors', type=int, default=32,
+                        help='nearest other-individual sightings kept per annotation')
+    parser.add_argument('--replay-fraction', type=float, default=0,
+                        help='share of every training batch replayed from the high-loss triplet buffer (0 = off)')
+    parser.add_argument('--replay-capacity', type=int, default=2000,
+                        help='high-loss triplets kept for replay')
+    parser.add_argument('--replay-max-age', type=int, default=500,
+                        help='optimizer steps after which a recorded triplet loss is forgotten')
+    parser.add_argument('--num-workers', type=int, default=4,
+                        help='data loader worker processes')
+    parser.add_argument('--prefetch-factor', type=int, default=2,
+                        help='batches loaded ahead by each worker')
+    parser.add_argument('--persistent-workers', action='store_true', default=False,
+                        help='keep the loader workers alive between epochs')
+    parser.add_argument('--prefetch-batches', type=int, default=0,
+                        help='training batches transferred and normalized ahead in a background thread (0 = off)')
+    parser.add_argument('--shared-memory-batches', action='store_true', default=False,
+                        help='workers write uint8 training crops into a shared-memory batch ring')
+    parser.add_argument('--readahead-threads', type=int, default=0,
+                        help='threads per loader process reading upcoming frames into memory (0 = off)')
+    parser.add_argument('--readahead-mb', type=int, default=256,
+                        help='in-memory frame cache per loader process for --readahead-threads')
+    parser.add_argument('--train-shards', type=str, default=None,
+                        help='stream training triplets from shards packed with shards.py '
+                             '(local directory, or s3:// prefix read with s3fs)')
+    parser.add_argument('--shuffle-buffer', type=int, default=1000,
+                        help='crops held for shuffling with --train-shards')
+    execution.add_execution_args(parser)
     args = parser.parse_args()
+    if args.distributed:
+        assert not args.evaluate, 'run --evaluate in a single process'
+        rank, world_size, local_rank = distributed.init_distributed('gloo', args.threads_per_process)
     use_cuda = not args.no_cuda and torch.cuda.is_available()
     use_seg = args.use_seg
     use_bbox = args.use_bbox
     use_aug = args.apply_augmentation
-    trainFract = args.train_fract
     margin = args.margin
-    print('use seg?', use_seg)
-    print('use bbox?', use_bbox)
-    print('use aug?', use_aug)
-    print('using margin: ' + str(margin))
-    print('using training fraction: ' + str(trainFract))
+    if distributed.is_main_process():
+        print('use seg?', use_seg)
+        print('use bbox?', use_bbox)
+        print('use aug?', use_aug)
+        print('using margin: ' + str(margin))
+        print('precision:', args.precision)
+        print('unfrozen dense blocks:', args.unfreeze_blocks)
+        if args.distributed:
+            print('distributed over {} processes'.format(world_size))
     np.random.seed(2021)  # to ensure you always get the same train/test split
     torch.manual_seed(args.seed)
     device = torch.device("cuda" if use_cuda else "cpu")
-    kwargs = {'num_workers': 1, 'pin_memory': True} if use_cuda else {}
+    if args.distributed and use_cuda:
+        device = torch.device("cuda", local_rank)
+    kwargs = {'num_workers': args.num_workers, 'pin_memory': use_cuda, 'persistent_workers': args.persistent_workers,
+              'prefetch_factor': args.prefetch_factor}
+    if args.readahead_threads:
+        kwargs['readahead'] = readahead.ByteReadahead(num_threads=args.readahead_threads, max_mb=args.readahead_mb)
 
 
     # Define transforms
@@ -170,26 +276,16 @@ def main():
         torchvision.transforms.CenterCrop(args.image_size),
     ])
     
-    augment1 = torchvision.transforms.RandomChoice(
-        [torchvision.transforms.RandomAffine(degrees=10, translate=(0.05,0.05), shear=10), 
-         torchvision.transforms.ColorJitter(brightness=(1,1), contrast=(1,1), saturation=(1,1), hue=(-0.1,0.1)),
-         torchvision.transforms.RandomPerspective(distortion_scale=0.20, p=1),
-         torchvision.transforms.GaussianBlur(5, sigma=(0.1, 1.5))]
-        )
-    
     # Pretrained torchvision models need specific normalization;
     # see https://pytorch.org/vision/stable/models.html
     normalize = torchvision.transforms.Normalize(mean=[0.485, 0.456, 0.406],
                                                  std=[0.229, 0.224, 0.225])
     
-    augment2 = torchvision.transforms.RandomErasing(p=0.5, scale=(0.02, 0.10), ratio=(0.3, 3.3), value=0, inplace=False)
-    
-    transforms_aug = torchvision.transforms.Compose([
+    # Augmented, prefetched or shared-memory training images stay uint8 in the workers; random affine /
+    # hue / perspective / blur, normalization and random erasing run on whole batches (see batch_augment.py)
+    transforms_uint8 = torchvision.transforms.Compose([
         downsample,
-        augment1,
-        torchvision.transforms.ToTensor(),
-        normalize,
-        augment2,
+        torchvision.transforms.PILToTensor(),
     ])
     
     transforms = torchvision.transforms.Compose([
@@ -197,6 +293,14 @@ def main():
         torchvision.transforms.ToTensor(),
         normalize,
     ])
+    train_transforms = transforms
+    train_batch_transform = None
+    if use_aug:
+        train_transforms = transforms_uint8
+        train_batch_transform = batch_augment.BatchAugment(seed=args.seed + (rank if args.distributed else 0))
+    elif args.prefetch_batches or args.shared_memory_batches:
+        train_transforms = transforms_uint8
+        train_batch_transform = batch_augment.normalize
 
     if args.evaluate:
         # generate some plots, don't actually train the model
@@ -208,6 +312,9 @@ def main():
         model = model.to(device)
         model.load_state_dict(torch.load(modelName))
         model.eval()
+        example_input = execution.to_device(torch.zeros(1, 3, args.image_size, args.image_size), device, args.channels_last)
+        model = execution.prepare_model(model, args.channels_last, args.compile, args.compile_cache_dir,
+                                        training=False, example_input=example_input)
 
         val_loader = data_loader.get_loader(
             args.data_folder,
@@ -218,6 +325,7 @@ def main():
             num_triplets=int(0.15 * args.num_train_triplets),
             apply_mask=use_seg,
             apply_mask_bbox=use_bbox,
+            **kwargs
         )
 
         # plot 6 errors on the validation set and count total number of errors
@@ -232,10 +340,11 @@ def main():
         allIms = []
         with torch.no_grad():  # For the inference step, gradient is not computed
             for (img1, img2, img3), (ann1, ann2, ann3) in val_loader:
-                img1Dev, img2Dev, img3Dev = img1.to(device), img2.to(device), img3.to(device)
-                anchor_emb = model(img1Dev) # just use these
-                positive_emb = model(img2Dev)
-                negative_emb = model(img3Dev)
+                img1Dev, img2Dev, img3Dev = (execution.to_device(x, device, args.channels_last) for x in (img1, img2, img3))
+                with execution.autocast(args.precision, device):
+                    anchor_emb = model(img1Dev).float() # just use these
+                    positive_emb = model(img2Dev).float()
+                    negative_emb = model(img3Dev).float()
                 # find the errors
                 for i, anc in enumerate(anchor_emb):
                     if np.linalg.norm(anc.cpu() - positive_emb.cpu()[i]) >= np.linalg.norm(anc.cpu() - negative_emb.cpu()[i]):
@@ -247,7 +356,7 @@ def main():
                 for i, anc in enumerate(anchor_emb):
                     annID = float(ann1[i].numpy())
                     if annID not in loggedAnns:
-                        zebIDs.append(val_loader.dataset.annotations[annID]['name'])
+                        zebIDs.append(val_loader.dataset.annotation_name(int(annID)))
                         allEmbeds.append(anc.cpu().numpy().copy())
                         allIms.append(img1[i].permute(1,2,0).numpy().copy())
                         loggedAnns.append(annID)
@@ -352,28 +461,47 @@ def main():
 
         return
 
+    miner = None
+    if args.hard_negatives:
+        train_crops = data_loader.AnnotationCrops(args.data_folder, args.train_json, transforms,
+                                                  apply_mask=use_seg, apply_mask_bbox=use_bbox)
+        miner = hard_negatives.HardNegativeMiner(train_crops, device, mode=args.hard_negatives, margin=margin,
+                                                 refresh_steps=args.mining_refresh_steps,
+                                                 num_neighbors=args.mining_neighbors, batch_size=args.batch_size)
+
+    replay = None
+    if args.replay_fraction:
+        # Replayed batches differ in number between processes, which DDP can't synchronize
+        assert not args.distributed, 'triplet replay runs in a single process'
+        replay = triplet_replay.ReplayBuffer(args.replay_capacity, args.replay_max_age)
+
     # Initialize dataset loaders
-    if use_aug:
-        train_loader = data_loader.get_loader(
-            args.data_folder,
-            args.train_json,
-            transforms_aug,
-            batch_size=args.batch_size,
-            shuffle=True,
-            num_triplets=args.num_train_triplets,
-            apply_mask=use_seg,
-            apply_mask_bbox=use_bbox,
-        )
+    if args.train_shards:
+        # Sequential reads of packed shards; the shard split can't give every process the same number of batches
+        assert not (args.distributed or miner is not None or replay is not None or args.shared_memory_batches), \
+            '--train-shards streams its own triplets in a single process'
+        stream_kwargs = {key: value for key, value in kwargs.items() if key != 'readahead'}
+        train_loader = shards.get_stream_loader(args.train_shards, train_transforms, args.batch_size,
+                                                json=args.train_json, apply_mask=use_seg, apply_mask_bbox=use_bbox,
+                                                shuffle_buffer=args.shuffle_buffer, seed=args.seed, **stream_kwargs)
     else:
         train_loader = data_loader.get_loader(
             args.data_folder,
             args.train_json,
-            transforms,
+            train_transforms,
             batch_size=args.batch_size,
             shuffle=True,
             num_triplets=args.num_train_triplets,
             apply_mask=use_seg,
             apply_mask_bbox=use_bbox,
+            distributed=args.distributed,
+            seed=args.seed,
+            miner=miner,
+            replay=replay,
+            replay_fraction=args.replay_fraction,
+            shared_memory=args.shared_memory_batches,
+            image_size=args.image_size,
+            **kwargs
         )
     val_loader = data_loader.get_loader(
         args.data_folder,
@@ -384,11 +512,15 @@ def main():
         num_triplets=int(0.15 * args.num_train_triplets),
         apply_mask=use_seg,
         apply_mask_bbox=use_bbox,
+        distributed=args.distributed,
+        seed=args.seed,
+        pad=False,
+        **kwargs
     )
 
     # object recognition, pretrained on imagenet
     # https://pytorch.org/hub/pytorch_vision_densenet/
-    model = initialize_model()
+    model = initialize_model(unfreeze_blocks=args.unfreeze_blocks, checkpointing=not args.no_checkpointing)
     # print(model)
     model = model.to(device)
     if args.load_model_dir:
@@ -396,26 +528,74 @@ def main():
         model_path = os.path.join(args.load_model_dir, modelName)
         print('Loading model from:', model_path)
         model.load_state_dict(torch.load(model_path))
+    cache = None
+    if args.activation_cache:
+        assert not use_aug, 'cached activations need un-augmented images'
+        if not isinstance(model, backbone.PartiallyFrozenDenseNet):
+            model = backbone.PartiallyFrozenDenseNet(model, 0)
+        cache_dir = args.activation_cache
+        if args.distributed:
+            cache_dir = os.path.join(cache_dir, 'rank{}'.format(rank))
+        cache = activation_cache.open_for_model(model, cache_dir, args.cache_cut, args.cache_size_gb, args.image_size,
+                                                extra=json.dumps([use_seg, use_bbox, str(transforms)]))
+        if distributed.is_main_process():
+            print('activation cache: {} entries of {} KB'.format(len(cache), cache.entry_bytes // 1024))
+    model = execution.prepare_model(model, args.channels_last, args.compile, args.compile_cache_dir)
+    if args.distributed:
+        # Gradients of the trainable classifier head are all-reduced; the frozen backbone has none
+        model = DistributedDataParallel(model, device_ids=[local_rank] if use_cuda else None)
     # Try different optimzers here [Adam, SGD, RMSprop]
     optimizer = optim.Adam(model.parameters(), lr=args.lr, weight_decay = args.weight_decay)
 
     # Set your learning rate scheduler
     scheduler = StepLR(optimizer, step_size=args.step, gamma=args.gamma)
 
+    # Overlap the next batches' collation, transfer and normalization/augmentation with the current step
+    train_batches = train_loader
+    step_transform = train_batch_transform
+    if args.prefetch_batches:
+        train_batches = prefetch.BackgroundPrefetcher(train_loader, device, args.prefetch_batches,
+                                                      train_batch_transform, args.channels_last)
+        step_transform = None
+
     # Training loop
     trainLoss = []
     valLoss = []
     for epoch in range(1, args.epochs + 1):
-        train(args, model, device, train_loader, optimizer, epoch, margin = margin) # None placeholder for triplet loss argument
-        trloss = test(model, device, train_loader, "train data", margin = margin) # training loss
-        vloss = test(model, device, val_loader, "val data", margin = margin) # validation loss
+        # Triplet order, mined/replayed draws and augmentation are keyed by (seed, epoch)
+        data_loader.set_epoch(train_loader, epoch)
+        if isinstance(train_batch_transform, batch_augment.BatchAugment):
+            train_batch_transform.set_epoch(epoch)
+        train(args, model, device, train_batches, optimizer, epoch, margin = margin, miner = miner, replay = replay, batch_transform = step_transform) # None placeholder for triplet loss argument
+        if args.prefetch_batches and distributed.is_main_process():
+            print('data wait: {:.1%} of the epoch'.format(train_batches.data_wait_fraction()))
+        if args.shared_memory_batches and distributed.is_main_process():
+            print('decode sharing: {:.2f} crops per decoded frame'.format(train_loader.decode_sharing_ratio()))
+        if args.train_shards:
+            print('shards: {} anchors without a positive/negative in the shuffle buffer so far'.format(
+                train_loader.dataset.unpaired))
+        if miner is not None and distributed.is_main_process():
+            print('hard negatives: {}/{} triplets mined so far'.format(miner.mined, miner.requested))
+        if replay is not None and distributed.is_main_process():
+            batch_sampler = train_loader.batch_sampler
+            print('replay: {} triplets buffered, {} replayed and {} satisfied ones skipped so far'.format(
+                len(replay), batch_sampler.replayed, batch_sampler.skipped))
+        if cache is not None:
+            cache.flush()
+        trloss = test(model, device, train_loader, "train data", margin = margin, precision=args.precision, channels_last=args.channels_last, batch_transform=train_batch_transform) # training loss
+        vloss = test(model, device, val_loader, "val data", margin = margin, precision=args.precision, channels_last=args.channels_last) # validation loss
         # Move losses to cpu for plotting
         trainLoss.append(trloss.cpu())
         valLoss.append(vloss.cpu())
         scheduler.step()  # learning rate scheduler
 
-        if args.save_model:
-            torch.save(model.state_dict(), os.path.join(args.model_dir, args.name + "_model.pt"))
+        if args.save_model and distributed.is_main_process():
+            torch.save(execution.unwrap(model).state_dict(), os.path.join(args.model_dir, args.name + "_model.pt"))
+
+    main_process = distributed.is_main_process()
+    distributed.cleanup()
+    if not main_process:
+        return
 
     # plot training and validation loss by epoch
     f = plt.figure(figsize=(6, 5))
@@ -0,0 +1,57 @@
+"""Helpers for multi-process (CPU) data-parallel training with torch.distributed.
+
+Processes are started by torchrun, which sets RANK, WORLD_SIZE, LOCAL_RANK,
+LOCAL_WORLD_SIZE, MASTER_ADDR and MASTER_PORT. One box:
+
+    torchrun --standalone --nproc-per-node 4 denseNet201_v6_augs.py --distributed ...
+
+Several boxes (run on each, same rendezvous endpoint):
+
+    torchrun --nnodes 2 --nproc-per-node 4 --rdzv-backend c10d --rdzv-endpoint node0:29500 \
+        denseNet201_v6_augs.py --distributed ...
+
+Without --distributed every helper degrades to the single-process case.
+"""
+
+import os
+
+import torch
+import torch.distributed as dist
+
+
+def init_distributed(backend='gloo', threads_per_process=None):
+    """Joins the process group started by torchrun; returns (rank, world_size, local_rank).
+
+    Intra-op threads are split between the processes on a box so they don't
+    oversubscribe the cores.
+    """
+    rank = int(os.environ.get('RANK', 0))
+    world_size = int(os.environ.get('WORLD_SIZE', 1))
+    local_rank = int(os.environ.get('LOCAL_RANK', 0))
+    local_world_size = int(os.environ.get('LOCAL_WORLD_SIZE', 1))
+    if threads_per_process is None:
+        threads_per_process = max(1, (os.cpu_count() or 1) // local_world_size)
+    torch.set_num_threads(threads_per_process)
+    dist.init_process_group(backend=backend, rank=rank, world_size=world_size)
+    return rank, world_size, local_rank
+
+
+def is_distributed():
+    return dist.is_available() and dist.is_initialized()
+
+
+def is_main_process():
+    """True on rank 0 (and when not distributed): the process that logs and saves."""
+    return not is_distributed() or dist.get_rank() == 0
+
+
+def all_reduce_sum(tensor):
+    """Sums a tensor over all processes (in place); returns it."""
+    if is_distributed():
+        dist.all_reduce(tensor, op=dist.ReduceOp.SUM)
+    return tensor
+
+
+def cleanup():
+    if is_distributed():
+        dist.destroy_process_group()
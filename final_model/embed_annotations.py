@@ -0,0 +1,94 @@
+"""Embeds every annotation of a (split) annotation file with a trained model.
+
+The output .npz (annotation_ids, embeddings) is the gallery that geo_index.py
+searches.
+
+Usage:
+    python embed_annotations.py --name model --load-model-dir models/ \
+        --json customSplit_test.json --data-folder images/ -o test_embeddings.npz
+"""
+
+import argparse
+import os
+import pathlib
+
+import numpy as np
+import torch
+import torchvision
+
+import data_loader_triplet_v2 as data_loader
+import execution
+import frame_batches
+from denseNet201_v6_augs import initialize_model
+
+
+def embed(model, device, loader, precision='fp32', channels_last=False):
+    """Returns (annotation_ids, embeddings) for every item of the loader."""
+    model.eval()
+    annotation_ids, embeddings = [], []
+    with torch.no_grad():
+        for images, ann_ids in loader:
+            with execution.autocast(precision, device):
+                batch_embeddings = model(execution.to_device(images, device, channels_last))
+            embeddings.append(batch_embeddings.float().cpu().numpy())
+            annotation_ids.append(ann_ids.numpy())
+    return np.concatenate(annotation_ids), np.concatenate(embeddings)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Embed annotations for gallery search')
+    parser.add_argument('--name', default='model',
+                        help='name of the model save file (<name>_model.pt)')
+    parser.add_argument('--load-model-dir', type=str, default=os.environ.get('SM_CHANNEL_LOAD_MODEL_DIR'),
+                        help='folder with the model save file')
+    parser.add_argument('--data-folder', default=os.environ.get('SM_CHANNEL_DATA'),
+                        help='folder containing data images')
+    parser.add_argument('-j', '--json', type=pathlib.Path, required=True,
+                        help='JSON with COCO-format annotations (or split index .npz)')
+    parser.add_argument('-o', '--output', type=pathlib.Path, required=True,
+                        help='output .npz with annotation_ids and embeddings')
+    parser.add_argument('-c', '--category-ids', type=int, nargs='+', default=[1],
+                        help='Which animal categories to embed (1 = zebra, 2 = giraffe)')
+    parser.add_argument('--batch-size', type=int, default=64)
+    parser.add_argument('--num-workers', type=int, default=4)
+    parser.add_argument('--image-size', type=int, default=224,
+                        help='Input to CNN will be size (image_size, image_size, 3)')
+    parser.add_argument('--use-seg', action='store_true', default=False,
+                        help='apply the segmentation mask')
+    parser.add_argument('--use-bbox', action='store_true', default=False,
+                        help='crop to the bounding box')
+    parser.add_argument('--no-cuda', action='store_true', default=False)
+    execution.add_execution_args(parser)
+    args = parser.parse_args()
+    device = torch.device('cuda' if not args.no_cuda and torch.cuda.is_available() else 'cpu')
+
+    transforms = torchvision.transforms.Compose([
+        torchvision.transforms.Resize(args.image_size),
+        torchvision.transforms.CenterCrop(args.image_size),
+        torchvision.transforms.ToTensor(),
+        torchvision.transforms.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225]),
+    ])
+    dataset = data_loader.AnnotationCrops(args.data_folder, args.json, transforms,
+                                          category_ids=args.category_ids,
+                                          apply_mask=args.use_seg, apply_mask_bbox=args.use_bbox)
+    # Annotations of a frame are embedded together, decoding the frame once
+    loader = frame_batches.FrameGroupedLoader(dataset, args.batch_size, {'num_workers': args.num_workers})
+
+    modelName = args.name + '_model.pt'
+    if args.load_model_dir:
+        modelName = os.path.join(args.load_model_dir, modelName)
+    model = initialize_model(use_pretrained=False).to(device)
+    model.load_state_dict(torch.load(modelName, map_location=device))
+    model.eval()
+    example_input = execution.to_device(torch.zeros(1, 3, args.image_size, args.image_size), device, args.channels_last)
+    model = execution.prepare_model(model, args.channels_last, args.compile, args.compile_cache_dir,
+                                    training=False, example_input=example_input)
+
+    annotation_ids, embeddings = embed(model, device, loader, args.precision, args.channels_last)
+    np.savez(args.output, annotation_ids=annotation_ids, embeddings=embeddings)
+    print('{} embeddings -> {} ({:.2f} crops per decoded frame)'.format(
+        len(annotation_ids), args.output, loader.decode_sharing_ratio()))
+
+
+if __name__ == '__main__':
+    main()
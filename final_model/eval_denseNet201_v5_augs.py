@@ -6,6 +6,7 @@ import numpy as np
 import torch.nn as nn
 import torch.optim as optim
 import data_loader_triplet_v2 as data_loader
+import execution
 from torch.optim.lr_scheduler import StepLR
 import matplotlib.pyplot as plt
 from matplotlib import cm
@@ -38,12 +39,14 @@ def train(args, model, device, train_loader, optimizer, epoch):
     for batch_idx, batch in enumerate(train_loader):
         anchor_positive_negative_imgs, anchor_positive_negative_anns = batch
         anchor_img, positive_img, negative_img = anchor_positive_negative_imgs
-        anchor_img, positive_img, negative_img = anchor_img.to(device), positive_img.to(device), negative_img.to(device)
+        anchor_img, positive_img, negative_img = (execution.to_device(x, device, args.channels_last)
+                                                  for x in (anchor_img, positive_img, negative_img))
         optimizer.zero_grad()  # Clear the gradient
-        anchor_emb = model(anchor_img)
-        positive_emb = model(positive_img)
-        negative_emb = model(negative_img)
-        loss = F.triplet_margin_loss(anchor_emb, positive_emb, negative_emb, margin=1.0, p=2)  # sum up batch loss
+        with execution.autocast(args.precision, device):
+            anchor_emb = model(anchor_img)
+            positive_emb = model(positive_img)
+            negative_emb = model(negative_img)
+        loss = execution.triplet_loss(anchor_emb, positive_emb, negative_emb, margin=1.0)  # sum up batch loss
         loss.backward()  # Gradient computation
         optimizer.step()  # Perform a single optimization step
         if batch_idx % args.batch_log_interval == 0:
@@ -52,7 +55,7 @@ def train(args, model, device, train_loader, optimizer, epoch):
                        100. * batch_idx / len(train_loader), loss.item()))
 
 
-def test(model, device, test_loader, dataName):
+def test(model, device, test_loader, dataName, precision='fp32', channels_last=False):
     model.eval()  # Set the model to inference mode
     test_loss = 0
     correct = 0  # number of times it gets the distances correct
@@ -61,14 +64,15 @@ def test(model, device, test_loader, dataName):
         for batch_idx, batch in enumerate(test_loader):
             anchor_positive_negative_imgs, anchor_positive_negative_anns = batch
             anchor_img, positive_img, negative_img = anchor_positive_negative_imgs
-            anchor_img, positive_img, negative_img = anchor_img.to(device), positive_img.to(device), negative_img.to(
-                device)
-            anchor_emb = model(anchor_img)
-            positive_emb = model(positive_img)
-            negative_emb = model(negative_img)
+            anchor_img, positive_img, negative_img = (execution.to_device(x, device, channels_last)
+                                                      for x in (anchor_img, positive_img, negative_img))
+            with execution.autocast(precision, device):
+                anchor_emb = model(anchor_img)
+                positive_emb = model(positive_img)
+                negative_emb = model(negative_img)
+            anchor_emb, positive_emb, negative_emb = anchor_emb.float(), positive_emb.float(), negative_emb.float()
             # function that takes output and turns into anchor, positive, negative
-            test_loss += F.triplet_margin_loss(anchor_emb, positive_emb, negative_emb, margin=1.0,
-                                               p=2)  # sum up batch loss
+            test_loss += execution.triplet_loss(anchor_emb, positive_emb, negative_emb, margin=1.0)  # sum up batch loss
 
             predict_match = torch.linalg.norm(anchor_emb - positive_emb, dim=-1) < torch.linalg.norm(
                 anchor_emb - negative_emb, dim=-1)
@@ -122,14 +126,14 @@ def main():
                             os.environ.get('SM_CHANNEL_ANNOTATIONS', '.'),
                             'customSplit_train.json'
                         ),
-                        help='JSON with COCO-format annotations for training dataset')
+                        help='JSON with COCO-format annotations (or split index .npz) for training dataset')
     parser.add_argument('--val-json',
                         # For AWS, get path from folder
                         default=os.path.join(
                             os.environ.get('SM_CHANNEL_ANNOTATIONS', '.'),
                             'customSplit_val.json'
                         ),
-                        help='JSON with COCO-format annotations for validation dataset')
+                        help='JSON with COCO-format annotations (or split index .npz) for validation dataset')
     parser.add_argument('--model-dir', type=str, default=os.environ.get('SM_MODEL_DIR', '.'))
     parser.add_argument('--batch-log-interval', type=int, default=10,
                         help='Number of batches to run each epoch before logging metrics.')
@@ -145,6 +149,7 @@ def main():
                         help='Input to CNN will be size (image_size, image_size, 3)')
     parser.add_argument('--apply-augmentation', action='store_true', default=False,
                         help='Applies image augmentations')
+    execution.add_execution_args(parser)
     args = parser.parse_args()
     use_cuda = not args.no_cuda and torch.cuda.is_available()
     use_seg = args.use_seg
@@ -153,6 +158,7 @@ def main():
     print('use seg?', use_seg)
     print('use bbox?', use_bbox)
     print('use aug?', use_aug)
+    print('precision:', args.precision)
     np.random.seed(2021)  # to ensure you always get the same train/test split
     torch.manual_seed(args.seed)
     device = torch.device("cuda" if use_cuda else "cpu")
@@ -202,6 +208,9 @@ def main():
         model = model.to(device)
         model.load_state_dict(torch.load(modelName))
         model.eval()
+        example_input = execution.to_device(torch.zeros(1, 3, args.image_size, args.image_size), device, args.channels_last)
+        model = execution.prepare_model(model, args.channels_last, args.compile, args.compile_cache_dir,
+                                        training=False, example_input=example_input)
 
         # load the underlying annotations file for the
         BOX_ANNOTATION_FILE = '../../Data/gzgc.coco/masks/instances_train2020_maskrcnn.json'
@@ -248,10 +257,11 @@ def main():
         cor_negDis = []
         with torch.no_grad():  # For the inference step, gradient is not computed
             for (img1, img2, img3), (ann1, ann2, ann3) in val_loader:
-                img1Dev, img2Dev, img3Dev = img1.to(device), img2.to(device), img3.to(device)
-                anchor_emb = model(img1Dev)  # just use these
-                positive_emb = model(img2Dev)
-                negative_emb = model(img3Dev)
+                img1Dev, img2Dev, img3Dev = (execution.to_device(x, device, args.channels_last) for x in (img1, img2, img3))
+                with execution.autocast(args.precision, device):
+                    anchor_emb = model(img1Dev).float()  # just use these
+                    positive_emb = model(img2Dev).float()
+                    negative_emb = model(img3Dev).float()
                 # find the errors
                 for i, anc in enumerate(anchor_emb):
                     if np.linalg.norm(anc.cpu() - positive_emb.cpu()[i]) >= np.linalg.norm(
@@ -270,7 +280,7 @@ def main():
                 for i, anc in enumerate(anchor_emb):
                     annID = float(ann1[i].numpy())
                     if annID not in loggedAnns:
-                        zebIDs.append(val_loader.dataset.annotations[annID]['name'])
+                        zebIDs.append(val_loader.dataset.annotation_name(int(annID)))
                         allEmbeds.append(anc.cpu().numpy().copy())
                         allIms.append(img1[i].permute(1, 2, 0).numpy().copy())
                         loggedAnns.append(annID)
@@ -510,6 +520,7 @@ def main():
     model = initialize_model()
     # print(model)
     model = model.to(device)
+    model = execution.prepare_model(model, args.channels_last, args.compile, args.compile_cache_dir)
     # Try different optimzers here [Adam, SGD, RMSprop]
     optimizer = optim.Adam(model.parameters(), lr=args.lr, weight_decay=args.weight_decay)
 
@@ -521,14 +532,14 @@ def main():
     valLoss = []
     for epoch in range(1, args.epochs + 1):
         train(args, model, device, train_loader, optimizer, epoch)  # None placeholder for triplet loss argument
-        trloss = test(model, device, train_loader, "train data")  # training loss
-        vloss = test(model, device, val_loader, "val data")  # validation loss
+        trloss = test(model, device, train_loader, "train data", precision=args.precision, channels_last=args.channels_last)  # training loss
+        vloss = test(model, device, val_loader, "val data", precision=args.precision, channels_last=args.channels_last)  # validation loss
         trainLoss.append(trloss)
         valLoss.append(vloss)
         scheduler.step()  # learning rate scheduler
 
         if args.save_model:
-            torch.save(model.state_dict(), os.path.join(args.model_dir, args.name + "_model.pt"))
+            torch.save(execution.unwrap(model).state_dict(), os.path.join(args.model_dir, args.name + "_model.pt"))
 
     # plot training and validation loss by epoch
     f = plt.figure(figsize=(6, 5))
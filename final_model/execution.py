@@ -0,0 +1,106 @@
+"""Execution options shared by the training, eval and inference scripts.
+
+--precision bf16 runs model forwards under autocast (bfloat16 matmuls and
+convolutions on CPUs with bf16 support); parameters, optimizer state and the
+triplet loss stay in float32.
+
+--channels-last stores the model's conv weights and the input batches in
+NHWC layout, which avoids layout conversions around DenseNet's many small
+convolutions and concatenations on CPU.
+
+--compile wraps the model with torch.compile. Compiled kernels and graphs are
+cached in --compile-cache-dir (default $REID_COMPILE_CACHE, else
+~/.cache/animal-reid/compile), so only the first run pays the full warm-up.
+Where torch.compile is unavailable, inference falls back to a frozen
+TorchScript module and training to eager mode.
+"""
+
+import contextlib
+import os
+import pathlib
+import warnings
+
+import torch
+import torch.nn.functional as F
+
+PRECISIONS = ('fp32', 'bf16')
+DEFAULT_COMPILE_CACHE_DIR = pathlib.Path(os.environ.get('REID_COMPILE_CACHE', '~/.cache/animal-reid/compile')).expanduser()
+
+
+def add_execution_args(parser):
+    parser.add_argument('--precision', choices=PRECISIONS, default='fp32',
+                        help='fp32, or bf16 autocast for the model forwards')
+    parser.add_argument('--channels-last', action='store_true', default=False,
+                        help='run convolutions in channels_last (NHWC) memory format')
+    parser.add_argument('--compile', action='store_true', default=False,
+                        help='torch.compile the model (TorchScript freeze for inference if unavailable)')
+    parser.add_argument('--compile-cache-dir', type=pathlib.Path, default=DEFAULT_COMPILE_CACHE_DIR,
+                        help='where compiled graphs are cached between runs')
+    return parser
+
+
+def autocast(precision, device):
+    """Context for model forwards: bf16 autocast, or nothing for fp32."""
+    if precision == 'fp32':
+        return contextlib.nullcontext()
+    return torch.autocast(device_type=device.type, dtype=torch.bfloat16)
+
+
+def triplet_loss(anchor_emb, positive_emb, negative_emb, margin, reduction='mean'):
+    """Triplet margin loss computed in float32, whatever precision the embeddings are in."""
+    return F.triplet_margin_loss(anchor_emb.float(), positive_emb.float(), negative_emb.float(), margin=margin, p=2,
+                                 reduction=reduction)
+
+
+def to_device(images, device, channels_last=False):
+    """Moves an image batch to the device, in channels_last layout if requested."""
+    if channels_last:
+        return images.to(device, memory_format=torch.channels_last)
+    return images.to(device)
+
+
+def enable_compile_cache(cache_dir):
+    """Points the inductor caches at cache_dir (must run before the first compile)."""
+    cache_dir = pathlib.Path(cache_dir).expanduser()
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    os.environ.setdefault('TORCHINDUCTOR_CACHE_DIR', str(cache_dir))
+    try:
+        import torch._inductor.config as inductor_config
+        inductor_config.fx_graph_cache = True
+    except (ImportError, AttributeError):
+        pass
+
+
+def prepare_model(model, channels_last=False, compile=False, compile_cache_dir=DEFAULT_COMPILE_CACHE_DIR,
+                  training=True, example_input=None):
+    """Applies the execution mode to a model; returns the module to run forwards with.
+
+    Keep the original model for state_dict()/saving (or use unwrap()).
+    example_input is only needed for the TorchScript fallback.
+    """
+    if channels_last:
+        model = model.to(memory_format=torch.channels_last)
+    if not compile:
+        return model
+    if hasattr(torch, 'compile'):
+        enable_compile_cache(compile_cache_dir)
+        return torch.compile(model)
+    if training:
+        warnings.warn('torch.compile is not available; training in eager mode')
+        return model
+    # Frozen TorchScript inlines the (eval-mode) weights and folds batch norms
+    model.eval()
+    with torch.no_grad():
+        scripted = torch.jit.trace(model, example_input) if example_input is not None else torch.jit.script(model)
+        return torch.jit.freeze(scripted)
+
+
+def unwrap(model):
+    """The plain model behind torch.compile / DistributedDataParallel wrappers, for saving."""
+    while True:
+        if hasattr(model, '_orig_mod'):
+            model = model._orig_mod
+        elif isinstance(model, torch.nn.parallel.DistributedDataParallel):
+            model = model.module
+        else:
+            return model
@@ -0,0 +1,120 @@
+"""Frame-grouped decoding of annotation crops.
+
+A frame (camera image) usually holds several annotations, and every crop
+used to open and decode its whole frame again. Decoding dominates loading
+(the frames are large JPEGs, the crops small), so the loaders group the
+crops they need by frame and decode each frame once for all of them
+(ZebraAnnotations.load_images):
+
+    - triplet batches through the shared ring (shared_batches.py) share the
+      decodes of the 3 x batch_size crops of each batch;
+    - passes over every annotation (embed_annotations.py, the hard-negative
+      miner's refreshes) use FrameGroupedLoader, whose FrameBatchSampler
+      orders the annotations by frame, so all annotations of a frame land in
+      the same batch.
+
+decode_sharing_ratio() is the number of crops per decoded frame (1.0 means
+nothing was shared).
+
+Running this module compares decodes and time of a per-annotation pass over
+AnnotationCrops with the frame-grouped one.
+
+Usage:
+    python embed_annotations.py ...  (frame-grouped)
+    python frame_batches.py --data-folder images/ --json customSplit_train.json
+"""
+
+import argparse
+import math
+import time
+
+import numpy as np
+import torch
+
+
+class FrameBatchSampler(torch.utils.data.Sampler):
+    """Batches of AnnotationCrops positions in frame order (annotations of a frame are adjacent).
+
+    Args:
+        crops: AnnotationCrops.
+        batch_size: annotations per batch.
+    """
+    def __init__(self, crops, batch_size):
+        frames = np.asarray(crops.index.ann_image_row)[crops.rows]
+        self.order = np.argsort(frames, kind='stable')
+        self.batch_size = batch_size
+
+    def __iter__(self):
+        for start in range(0, len(self.order), self.batch_size):
+            yield self.order[start:start + self.batch_size].tolist()
+
+    def __len__(self):
+        return math.ceil(len(self.order) / self.batch_size)
+
+
+class FrameGroupedLoader:
+    """Iterable of (images, annotation ids) batches over AnnotationCrops, in frame order.
+
+    Args:
+        crops: AnnotationCrops.
+        batch_size: annotations per batch.
+        loader_options: DataLoader keyword arguments (see data_loader_triplet_v2.loader_options).
+    """
+    def __init__(self, crops, batch_size, loader_options=None):
+        self.loader = torch.utils.data.DataLoader(crops, sampler=FrameBatchSampler(crops, batch_size),
+                                                  batch_size=None, **(loader_options or {}))
+        self.crops = 0
+        self.decodes = 0
+
+    def __len__(self):
+        return len(self.loader)
+
+    def decode_sharing_ratio(self):
+        """Crops per decoded frame over the last (or current) pass."""
+        return self.crops / self.decodes if self.decodes else 1.0
+
+    def __iter__(self):
+        self.crops = 0
+        self.decodes = 0
+        for images, annotation_ids, decodes in self.loader:
+            self.crops += len(annotation_ids)
+            self.decodes += int(decodes)
+            yield images, annotation_ids
+
+
+def main():
+    import torchvision
+
+    import data_loader_triplet_v2 as data_loader
+
+    parser = argparse.ArgumentParser(description='Frame decodes and time: per-annotation vs frame-grouped crops')
+    parser.add_argument('--data-folder', type=str, required=True, help='folder containing data images')
+    parser.add_argument('--json', type=str, required=True, help='COCO-format annotations (or split index .npz)')
+    parser.add_argument('--image-size', type=int, default=224)
+    parser.add_argument('--batch-size', type=int, default=64)
+    parser.add_argument('--num-workers', type=int, default=4)
+    parser.add_argument('--use-bbox', action='store_true', default=False, help='crop to the bounding box')
+    args = parser.parse_args()
+
+    transforms = torchvision.transforms.Compose([
+        torchvision.transforms.Resize(args.image_size),
+        torchvision.transforms.CenterCrop(args.image_size),
+        torchvision.transforms.PILToTensor(),
+    ])
+    crops = data_loader.AnnotationCrops(args.data_folder, args.json, transforms, apply_mask_bbox=args.use_bbox)
+    options = data_loader.loader_options(args.num_workers)
+
+    for name, loader in [
+            ('per_annotation', torch.utils.data.DataLoader(crops, batch_size=args.batch_size, **options)),
+            ('frame_grouped', FrameGroupedLoader(crops, args.batch_size, options))]:
+        start = time.perf_counter()
+        num_crops = sum(len(annotation_ids) for _, annotation_ids in loader)
+        seconds = time.perf_counter() - start
+        decodes = loader.decodes if isinstance(loader, FrameGroupedLoader) else num_crops
+        print({'pipeline': name, 'crops': num_crops, 'frame_decodes': decodes,
+               'decode_sharing_ratio': num_crops / decodes, 'seconds': seconds,
+               'crops_per_sec': num_crops / seconds})
+
+
+if __name__ == '__main__':
+    main()
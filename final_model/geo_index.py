@@ -0,0 +1,254 @@
+"""Geo-indexed candidate pruning for re-identification queries.
+
+Most individuals are sighted within a small area, so a query only needs to be
+compared against gallery sightings close to where (and when) it was taken.
+GeoGridIndex buckets gallery sightings into a lat/lon grid and answers radius
+queries with exact haversine distances; GeoPrunedSearch ranks only the
+individuals sighted within the radius / time window and falls back to a
+global search when the local result is not confident.
+
+Running this module measures, for several radii, how often the true
+individual is within reach, re-ID accuracy with pruning vs. a global search,
+and the fraction of the gallery each query is compared against.
+
+Usage:
+    python embed_annotations.py --json customSplit_test.json --data-folder images/ -o test_embeddings.npz
+    python geo_index.py --json customSplit_test.json --embeddings test_embeddings.npz \
+        --radii 250 1000 5000 --time-window-days 30
+"""
+
+import argparse
+import pathlib
+import time
+
+import numpy as np
+
+import annotation_index
+
+EARTH_RADIUS_M = 6371008.8
+METERS_PER_DEGREE = np.pi * EARTH_RADIUS_M / 180  # along a meridian
+SECONDS_PER_DAY = 24 * 3600
+
+
+def haversine(lat1, lon1, lat2, lon2):
+    """Great-circle distance in meters between points given in degrees (broadcasts)."""
+    lat1, lon1, lat2, lon2 = (np.radians(np.asarray(x, dtype=np.float64)) for x in (lat1, lon1, lat2, lon2))
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS_M * np.arcsin(np.sqrt(np.minimum(a, 1.0)))
+
+
+class GeoGridIndex:
+    """Uniform lat/lon grid over sightings, for radius queries.
+
+    Cells are cell_size_m tall; their width in degrees is chosen at the highest
+    latitude in the data so cells are at least cell_size_m wide everywhere.
+    Sightings without GPS are never returned. Longitude wrap-around at +-180
+    is not handled (the dataset is far from it).
+    """
+    def __init__(self, lat, lon, cell_size_m=1000.0):
+        self.lat = np.asarray(lat, dtype=np.float64)
+        self.lon = np.asarray(lon, dtype=np.float64)
+        valid = np.flatnonzero(np.isfinite(self.lat) & np.isfinite(self.lon))
+        self.cell_lat_deg = cell_size_m / METERS_PER_DEGREE
+        max_abs_lat = np.max(np.abs(self.lat[valid])) if len(valid) else 0.0
+        self.cell_lon_deg = self.cell_lat_deg / np.cos(np.radians(min(max_abs_lat, 89.0)))
+
+        keys = self._keys(np.floor(self.lat[valid] / self.cell_lat_deg), np.floor(self.lon[valid] / self.cell_lon_deg))
+        order = np.argsort(keys, kind='stable')
+        self.rows = valid[order]
+        self.cell_keys, starts = np.unique(keys[order], return_index=True)
+        self.offsets = np.append(starts, len(order)).astype(np.int64)
+
+    @staticmethod
+    def _keys(cell_i, cell_j):
+        return (cell_i.astype(np.int64) << 32) + (cell_j.astype(np.int64) & 0xFFFFFFFF)
+
+    def query_radius(self, lat, lon, radius_m):
+        """Rows within radius_m of (lat, lon), and their distances in meters."""
+        if not (np.isfinite(lat) and np.isfinite(lon)):
+            return np.empty(0, dtype=np.int64), np.empty(0)
+        dlat = radius_m / METERS_PER_DEGREE
+        dlon = dlat / np.cos(np.radians(min(abs(lat) + dlat, 89.0)))
+        cell_i = np.arange(np.floor((lat - dlat) / self.cell_lat_deg), np.floor((lat + dlat) / self.cell_lat_deg) + 1)
+        cell_j = np.arange(np.floor((lon - dlon) / self.cell_lon_deg), np.floor((lon + dlon) / self.cell_lon_deg) + 1)
+        keys = self._keys(*(c.ravel() for c in np.meshgrid(cell_i, cell_j, indexing='ij')))
+        cells = np.searchsorted(self.cell_keys, keys)
+        present = cells < len(self.cell_keys)
+        present[present] = self.cell_keys[cells[present]] == keys[present]
+        cells = cells[present]
+        if len(cells) == 0:
+            return np.empty(0, dtype=np.int64), np.empty(0)
+        rows = np.concatenate([self.rows[self.offsets[c]:self.offsets[c + 1]] for c in cells])
+        distances = haversine(lat, lon, self.lat[rows], self.lon[rows])
+        within = distances <= radius_m
+        return rows[within], distances[within]
+
+
+def rank_individuals(distances, labels, k):
+    """Top-k individuals by their closest sighting: (labels, distances)."""
+    order = np.argsort(distances, kind='stable')
+    ranked_labels, first = np.unique(labels[order], return_index=True)
+    best = np.argsort(first)[:k]
+    return ranked_labels[best], distances[order][first[best]]
+
+
+class GeoPrunedSearch:
+    """Gallery search restricted to sightings near the query in space and time.
+
+    Args:
+        embeddings: [num_gallery, dim] gallery embeddings.
+        labels: individual id per gallery sighting.
+        lat, lon: GPS degrees per sighting (NaN if unknown).
+        times: capture time per sighting in seconds (NaN if unknown).
+        cell_size_m: grid cell size of the spatial index.
+    """
+    def __init__(self, embeddings, labels, lat, lon, times=None, cell_size_m=1000.0):
+        self.embeddings = np.asarray(embeddings, dtype=np.float32)
+        self.labels = np.asarray(labels)
+        self.times = None if times is None else np.asarray(times, dtype=np.float64)
+        self.geo = GeoGridIndex(lat, lon, cell_size_m)
+
+    def local_candidates(self, lat, lon, radius_m, query_time=None, time_window_s=None):
+        rows, _ = self.geo.query_radius(lat, lon, radius_m)
+        if time_window_s is not None and query_time is not None and self.times is not None and np.isfinite(query_time):
+            # Sightings without a capture time are kept rather than silently dropped
+            dt = np.abs(self.times[rows] - query_time)
+            rows = rows[~(dt > time_window_s)]
+        return rows
+
+    def search(self, query_embedding, lat, lon, radius_m, query_time=None, time_window_s=None,
+               k=5, exclude=None, confidence_ratio=0.8, max_distance=None):
+        """Ranks individuals for one query.
+
+        The local result is confident if it holds at least two individuals
+        and its best one is closer than confidence_ratio times the second
+        best (and, if given, within max_distance); otherwise the whole gallery
+        is searched.
+
+        Returns:
+            (top-k labels, fell back to global search, number of sightings compared)
+        """
+        rows = self.local_candidates(lat, lon, radius_m, query_time, time_window_s)
+        if exclude is not None:
+            rows = rows[~np.isin(rows, exclude)]
+        compared = len(rows)
+        if len(rows):
+            distances = np.linalg.norm(self.embeddings[rows] - query_embedding, axis=1)
+            top_labels, top_distances = rank_individuals(distances, self.labels[rows], max(k, 2))
+            # A lone local individual is no evidence: the true match is then most likely elsewhere
+            confident = len(top_distances) > 1 and top_distances[0] <= confidence_ratio * top_distances[1]
+            if max_distance is not None:
+                confident &= top_distances[0] <= max_distance
+            if confident:
+                return top_labels[:k], False, compared
+
+        rows = np.arange(len(self.embeddings))
+        if exclude is not None:
+            rows = rows[~np.isin(rows, exclude)]
+        distances = np.linalg.norm(self.embeddings[rows] - query_embedding, axis=1)
+        top_labels, _ = rank_individuals(distances, self.labels[rows], k)
+        return top_labels, True, compared + len(rows)
+
+
+def evaluate(search, radius_m, time_window_s=None, k=5, confidence_ratio=0.8, max_distance=None):
+    """Leave-one-out re-ID over the gallery with geo pruning at one radius.
+
+    Only sightings whose individual has another sighting are used as queries.
+    """
+    labels = search.labels
+    _, inverse, counts = np.unique(labels, return_inverse=True, return_counts=True)
+    queries = np.flatnonzero(counts[inverse] > 1)
+    lat, lon = search.geo.lat, search.geo.lon
+    times = search.times if search.times is not None else np.full(len(labels), np.nan)
+
+    reachable = top1 = topk = fallbacks = compared = 0
+    start = time.perf_counter()
+    for q in queries:
+        local = search.local_candidates(lat[q], lon[q], radius_m, times[q], time_window_s)
+        reachable += np.any((labels[local] == labels[q]) & (local != q))
+        ranked, fell_back, n = search.search(search.embeddings[q], lat[q], lon[q], radius_m, times[q], time_window_s,
+                                             k=k, exclude=[q], confidence_ratio=confidence_ratio,
+                                             max_distance=max_distance)
+        top1 += len(ranked) > 0 and ranked[0] == labels[q]
+        topk += labels[q] in ranked
+        fallbacks += fell_back
+        compared += n
+    elapsed = time.perf_counter() - start
+    n = max(len(queries), 1)
+    return {
+        'radius_m': radius_m,
+        'queries': len(queries),
+        'recall_within_radius': float(reachable / n),
+        'top1': float(top1 / n),
+        'top{}'.format(k): float(topk / n),
+        'fallback_rate': float(fallbacks / n),
+        'compared_fraction': float(compared / n / max(len(labels) - 1, 1)),
+        'ms_per_query': float(1000 * elapsed / n),
+    }
+
+
+def evaluate_global(embeddings, labels, k=5):
+    """Leave-one-out top-1 / top-k of a search over the whole gallery."""
+    _, inverse, counts = np.unique(labels, return_inverse=True, return_counts=True)
+    queries = np.flatnonzero(counts[inverse] > 1)
+    top1 = topk = 0
+    for q in queries:
+        distances = np.linalg.norm(embeddings - embeddings[q], axis=1)
+        distances[q] = np.inf
+        ranked, _ = rank_individuals(distances, labels, k)
+        top1 += ranked[0] == labels[q]
+        topk += labels[q] in ranked
+    n = max(len(queries), 1)
+    return {'top1': float(top1 / n), 'top{}'.format(k): float(topk / n)}
+
+
+def load_gallery(json_path, embeddings_path):
+    """Embeddings plus individual, GPS and capture time of every embedded annotation."""
+    index = annotation_index.open_annotations(json_path)
+    with np.load(embeddings_path) as data:
+        annotation_ids = data['annotation_ids']
+        embeddings = data['embeddings']
+    rows = index.row_of(annotation_ids)
+    return {
+        'annotation_ids': annotation_ids,
+        'embeddings': embeddings,
+        'labels': np.asarray(index.ann_name)[rows],
+        'lat': index.ann_lat[rows],
+        'lon': index.ann_lon[rows],
+        'times': index.ann_time[rows],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure geo-pruned re-ID recall and compute savings')
+    parser.add_argument('-j', '--json', type=pathlib.Path, required=True,
+                        help='Annotations JSON file in COCO-format (or split index .npz)')
+    parser.add_argument('-e', '--embeddings', type=pathlib.Path, required=True,
+                        help='.npz with annotation_ids and embeddings (see embed_annotations.py)')
+    parser.add_argument('-r', '--radii', type=float, nargs='+', default=[250, 1000, 5000],
+                        help='search radii in meters')
+    parser.add_argument('--time-window-days', type=float, default=None,
+                        help='only consider sightings within this many days of the query')
+    parser.add_argument('--cell-size', type=float, default=1000.0,
+                        help='grid cell size in meters')
+    parser.add_argument('-k', type=int, default=5, help='report top-k accuracy')
+    parser.add_argument('--confidence-ratio', type=float, default=0.8,
+                        help='local result is confident if best < ratio * second-best individual distance')
+    parser.add_argument('--max-distance', type=float, default=None,
+                        help='local result is only confident if the best embedding distance is below this')
+    args = parser.parse_args()
+
+    gallery = load_gallery(args.json, args.embeddings)
+    search = GeoPrunedSearch(gallery['embeddings'], gallery['labels'], gallery['lat'], gallery['lon'],
+                             gallery['times'], cell_size_m=args.cell_size)
+    time_window_s = None if args.time_window_days is None else args.time_window_days * SECONDS_PER_DAY
+
+    print('gallery: {} sightings, {} with GPS'.format(len(gallery['labels']), len(search.geo.rows)))
+    print('global search:', evaluate_global(search.embeddings, search.labels, args.k))
+    for radius in args.radii:
+        print(evaluate(search, radius, time_window_s, k=args.k, confidence_ratio=args.confidence_ratio,
+                       max_distance=args.max_distance))
+
+
+if __name__ == '__main__':
+    main()
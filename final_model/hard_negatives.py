@@ -0,0 +1,247 @@
+"""Hard-negative mining from a periodically refreshed embedding index.
+
+Random negatives are mostly easy: after a few epochs nearly every triplet
+already satisfies the margin and contributes no gradient. HardNegativeMiner
+re-embeds the training annotations with the current model every
+refresh_steps optimizer steps, keeps the nearest sightings of *other*
+individuals for every annotation, and HardNegativeSampler swaps the negative
+of each triplet for one of them:
+
+    semi-hard: a negative farther from the anchor than the positive, but
+               within the margin (FaceNet); the random negative is kept if
+               there is none among the neighbours.
+    hard:      any of the nearest other-individual sightings.
+
+The refresh runs in a background thread on a snapshot of the model, so
+training doesn't wait for it; until the first index is ready the random
+negatives are used. With a frozen backbone (no trainable parameters and its
+batch norms in eval mode, as PartiallyFrozenDenseNet keeps them) the pooled
+backbone features are computed once and a refresh only re-runs the classifier
+head over them; otherwise every refresh re-embeds the images. A plain DenseNet
+in train mode updates its batch norm statistics even with frozen weights, so
+it is re-embedded too.
+
+Usage:
+    python denseNet201_v6_augs.py --hard-negatives semi-hard --mining-refresh-steps 100 ...
+"""
+
+import copy
+import threading
+import time
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+import distributed
+import execution
+import frame_batches
+
+MINING_MODES = ('semi-hard', 'hard')
+
+
+def nearest_other_individuals(embeddings, labels, num_neighbors, chunk_size=1024):
+    """Nearest sightings of other individuals for every row.
+
+    Returns:
+        neighbors: int64 [N, num_neighbors] rows sorted by distance (-1 = none)
+        distances: float32 [N, num_neighbors] (inf = none)
+    """
+    embeddings = torch.as_tensor(embeddings, dtype=torch.float32)
+    labels = torch.as_tensor(labels)
+    k = min(num_neighbors, len(embeddings))
+    neighbors = np.full((len(embeddings), num_neighbors), -1, dtype=np.int64)
+    distances = np.full((len(embeddings), num_neighbors), np.inf, dtype=np.float32)
+    for start in range(0, len(embeddings), chunk_size):
+        query = embeddings[start:start + chunk_size]
+        d = torch.cdist(query, embeddings)
+        d[labels[start:start + chunk_size, None] == labels[None, :]] = float('inf')
+        nearest, rows = torch.topk(d, k, dim=1, largest=False)
+        neighbors[start:start + len(query), :k] = rows.numpy()
+        distances[start:start + len(query), :k] = nearest.numpy()
+    neighbors[~np.isfinite(distances)] = -1
+    return neighbors, distances
+
+
+class NegativeIndex:
+    """Embeddings of the training annotations and their nearest other-individual sightings."""
+    def __init__(self, embeddings, labels, num_neighbors):
+        self.embeddings = np.asarray(embeddings, dtype=np.float32)
+        self.neighbors, self.distances = nearest_other_individuals(self.embeddings, labels, num_neighbors)
+
+    def negative(self, anchor, positive, mode, margin, rng):
+        """Row of a mined negative for (anchor, positive) rows, or None."""
+        valid = np.flatnonzero(self.neighbors[anchor] >= 0)
+        if mode == 'semi-hard':
+            d_ap = np.linalg.norm(self.embeddings[anchor] - self.embeddings[positive])
+            d_an = self.distances[anchor, valid]
+            valid = valid[(d_an > d_ap) & (d_an < d_ap + margin)]
+        if not len(valid):
+            return None
+        return int(self.neighbors[anchor, valid[rng.randint(len(valid))]])
+
+
+def frozen_backbone(model):
+    """True if model.features neither trains nor updates batch norm statistics."""
+    if any(p.requires_grad for p in model.features.parameters()):
+        return False
+    return not any(m.training for m in model.features.modules() if isinstance(m, torch.nn.modules.batchnorm._BatchNorm))
+
+
+class HardNegativeMiner:
+    """Keeps a NegativeIndex of the training annotations up to date during training.
+
+    Args:
+        crops: AnnotationCrops of the training annotations (un-augmented transforms).
+        device: device the snapshot model embeds on.
+        mode: 'semi-hard' or 'hard'.
+        margin: triplet loss margin (semi-hard band).
+        refresh_steps: optimizer steps between refreshes.
+        num_neighbors: other-individual neighbours kept per annotation.
+        batch_size, num_workers: of the embedding loader.
+    """
+    def __init__(self, crops, device, mode='semi-hard', margin=1.0, refresh_steps=100, num_neighbors=32,
+                 batch_size=64, num_workers=4):
+        assert mode in MINING_MODES, 'mode must be one of {}'.format(MINING_MODES)
+        self.crops = crops
+        self.device = device
+        self.mode = mode
+        self.margin = margin
+        self.refresh_steps = refresh_steps
+        self.num_neighbors = num_neighbors
+        self.batch_size = batch_size
+        self.num_workers = num_workers
+
+        index = crops.index
+        self.annotation_ids = np.asarray(index.ann_id)[crops.rows]
+        self.labels = np.asarray(index.ann_name)[crops.rows]
+        self.id_order = np.argsort(self.annotation_ids)
+
+        self.index = None
+        self.snapshot = None
+        self.bank = None
+        self.steps = 0
+        self.next_refresh = 0
+        self.refreshes = 0
+        self.thread = None
+        self.error = None
+        self.requested = 0
+        self.mined = 0
+
+    def rows_of(self, annotation_ids):
+        """Positions of annotation ids among the mined annotations (-1 if not mined)."""
+        positions = np.minimum(np.searchsorted(self.annotation_ids[self.id_order], annotation_ids),
+                               len(self.id_order) - 1)
+        rows = self.id_order[positions]
+        return np.where(self.annotation_ids[rows] == annotation_ids, rows, -1)
+
+    def negative_for(self, anchor_id, positive_id, rng):
+        """Annotation id of a mined negative, or None (no index yet / no suitable neighbour)."""
+        self.requested += 1
+        index = self.index
+        if index is None:
+            return None
+        anchor, positive = self.rows_of(np.array([anchor_id, positive_id]))
+        if anchor < 0 or positive < 0:
+            return None
+        row = index.negative(anchor, positive, self.mode, self.margin, rng)
+        if row is None:
+            return None
+        self.mined += 1
+        return int(self.annotation_ids[row])
+
+    def step(self, model):
+        """Call after every optimizer step; starts a background refresh when one is due."""
+        if self.error is not None:
+            raise self.error
+        due = self.steps >= self.next_refresh
+        self.steps += 1
+        if not due or (self.thread is not None and self.thread.is_alive()):
+            return
+        model = execution.unwrap(model)
+        if self.snapshot is None:
+            cache = getattr(model, 'activation_cache', None)
+            # The snapshot never shares the (single-threaded) activation cache
+            self.snapshot = copy.deepcopy(model, memo={id(cache): None} if cache is not None else None)
+        self.frozen_backbone = frozen_backbone(model)
+        if not self.frozen_backbone:
+            self.bank = None
+        self.snapshot.load_state_dict(model.state_dict())
+        self.next_refresh = self.steps + self.refresh_steps
+        self.thread = threading.Thread(target=self._refresh, daemon=True)
+        self.thread.start()
+
+    def wait(self):
+        """Blocks until a running refresh has finished."""
+        if self.thread is not None:
+            self.thread.join()
+        if self.error is not None:
+            raise self.error
+
+    def _refresh(self):
+        try:
+            start = time.perf_counter()
+            embeddings = self.embed()
+            self.index = NegativeIndex(embeddings, self.labels, self.num_neighbors)
+            self.refreshes += 1
+            if distributed.is_main_process():
+                print('hard negatives: index {} of {} annotations ready after {:.1f}s'.format(
+                    self.refreshes, len(embeddings), time.perf_counter() - start))
+        except Exception as error:
+            self.error = error
+
+    def embed(self):
+        """Embeddings of all mined annotations with the snapshot model."""
+        model = self.snapshot
+        model.eval()
+        with torch.no_grad():
+            if not self.frozen_backbone:
+                return self.run_crops(model).numpy()
+            if self.bank is None:
+                # Pooled backbone features, as in DenseNet.forward before the classifier
+                self.bank = self.run_crops(
+                    lambda x: torch.flatten(F.adaptive_avg_pool2d(F.relu(model.features(x)), (1, 1)), 1))
+            return torch.cat([model.classifier(x.to(self.device)).cpu()
+                              for x in self.bank.split(16 * self.batch_size)]).numpy()
+
+    def run_crops(self, function):
+        """function applied to every annotation crop, concatenated on the CPU in crops order."""
+        loader = frame_batches.FrameGroupedLoader(self.crops, self.batch_size, {'num_workers': self.num_workers})
+        outputs, annotation_ids = [], []
+        for images, ids in loader:
+            outputs.append(function(images.to(self.device)).cpu())
+            annotation_ids.append(ids.numpy())
+        # Batches come in frame order
+        outputs = torch.cat(outputs)
+        return outputs[np.argsort(self.rows_of(np.concatenate(annotation_ids)))]
+
+
+class HardNegativeSampler(torch.utils.data.Sampler):
+    """Yields (anchor, positive, negative) annotation id triplets with mined negatives.
+
+    Args:
+        dataset: TripletZebras (its __getitem__ accepts a triplet).
+        miner: HardNegativeMiner.
+        index_sampler: order of dataset.triplets, e.g. RandomSampler or DistributedSampler.
+        seed: seed of the negative choice.
+    """
+    def __init__(self, dataset, miner, index_sampler, seed=0):
+        self.dataset = dataset
+        self.miner = miner
+        self.index_sampler = index_sampler
+        self.seed = seed
+        self.rng = np.random.RandomState(seed)
+
+    def __iter__(self):
+        for i in self.index_sampler:
+            anchor, positive, negative = self.dataset.triplets[i]
+            mined = self.miner.negative_for(anchor, positive, self.rng)
+            yield (anchor, positive, negative if mined is None else mined)
+
+    def __len__(self):
+        return len(self.index_sampler)
+
+    def set_epoch(self, epoch):
+        self.rng = np.random.RandomState([self.seed, epoch])
+        if hasattr(self.index_sampler, 'set_epoch'):
+            self.index_sampler.set_epoch(epoch)
@@ -0,0 +1,215 @@
+"""Background prefetching of triplet batches onto the training device.
+
+BackgroundPrefetcher iterates a triplet DataLoader in a thread and, for the
+next batches, does the work that used to sit between two optimizer steps:
+waiting for collation, the transfer to the device, and the batch transform
+(normalization of uint8 images or BatchAugment). Up to depth prepared batches
+are queued, so the training step only waits when the pipeline can't keep up;
+that time is counted in wait_seconds, and data_wait_fraction() relates it to
+the whole epoch.
+
+On CUDA the transfer is asynchronous: the loader's pinned tensors are copied
+one by one (views of the shared-memory ring are first staged in page-locked
+memory), and the copy and transform run on a separate CUDA stream, so they
+overlap with the training step's kernels on the default stream. The consumer
+waits for a batch's event before using it.
+
+Running this module times triplet training steps with the plain loader
+(transfer and normalization inline) and with the prefetcher, and prints the
+fraction of each step spent waiting for data.
+
+Usage:
+    python denseNet201_v6_augs.py --num-workers 4 --prefetch-factor 4 --persistent-workers --prefetch-batches 2 ...
+    python prefetch.py --data-folder images/ --json customSplit_train.json --batches 50
+"""
+
+import argparse
+import queue
+import threading
+import time
+
+import torch
+
+import batch_augment
+import execution
+
+_END = object()
+
+
+def prepare_triplet(images, device, transform=None, channels_last=False, annotation_ids=None):
+    """Anchor, positive and negative image batches moved to the device and transformed."""
+    if torch.device(device).type == 'cuda':
+        if not all(x.is_pinned() for x in images):
+            # Only copies from page-locked memory are asynchronous
+            staged = torch.empty((sum(len(x) for x in images),) + tuple(images[0].shape[1:]),
+                                 dtype=images[0].dtype, pin_memory=True)
+            images = [torch.cat(images, out=staged)]
+        # One copy per tensor, so the loader's pinned batches are used as they are
+        images = torch.cat([x.to(device, non_blocking=True) for x in images])
+    else:
+        images = torch.cat(images)
+    if transform is not None:
+        images = batch_augment.transform_triplets(transform, images, annotation_ids)
+    return [execution.to_device(x, device, channels_last) for x in images.chunk(3)]
+
+
+class BackgroundPrefetcher:
+    """Iterable over (images, annotation ids) like the triplet DataLoader, with images prepared ahead.
+
+    Args:
+        loader: triplet DataLoader.
+        device: training device.
+        depth: prepared batches kept ready.
+        transform: applied to the stacked triplet images on the device (e.g. BatchAugment).
+        channels_last: return channels_last images.
+    """
+    def __init__(self, loader, device, depth=2, transform=None, channels_last=False):
+        self.loader = loader
+        self.device = device
+        self.depth = depth
+        self.transform = transform
+        self.channels_last = channels_last
+        self.wait_seconds = 0.0
+        self.epoch_seconds = 0.0
+        self.stream = torch.cuda.Stream(device) if torch.device(device).type == 'cuda' else None
+
+    @property
+    def sampler(self):
+        return self.loader.sampler
+
+    def __len__(self):
+        return len(self.loader)
+
+    def data_wait_fraction(self):
+        """Share of the last epoch the consumer spent waiting for a batch."""
+        return self.wait_seconds / self.epoch_seconds if self.epoch_seconds else 0.0
+
+    def _produce(self, batches, stop):
+        def put(item):
+            # Gives up once the consumer has stopped, instead of blocking on a full queue
+            while not stop.is_set():
+                try:
+                    batches.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        try:
+            for images, anns in self.loader:
+                event = None
+                if self.stream is None:
+                    prepared = prepare_triplet(images, self.device, self.transform, self.channels_last, anns)
+                else:
+                    with torch.cuda.stream(self.stream):
+                        prepared = prepare_triplet(images, self.device, self.transform, self.channels_last, anns)
+                        event = torch.cuda.Event()
+                        event.record(self.stream)
+                    # The source may be a ring slot the workers rewrite once the next batches are drawn
+                    event.synchronize()
+                if not put((prepared, anns, event)):
+                    return
+        except Exception as error:
+            put(error)
+            return
+        put(_END)
+
+    def __iter__(self):
+        batches = queue.Queue(maxsize=self.depth)
+        stop = threading.Event()
+        thread = threading.Thread(target=self._produce, args=(batches, stop), daemon=True)
+        self.wait_seconds = 0.0
+        epoch_start = time.perf_counter()
+        thread.start()
+        try:
+            while True:
+                start = time.perf_counter()
+                item = batches.get()
+                self.wait_seconds += time.perf_counter() - start
+                if item is _END:
+                    return
+                if isinstance(item, Exception):
+                    raise item
+                images, anns, event = item
+                if event is not None:
+                    stream = torch.cuda.current_stream(self.device)
+                    stream.wait_event(event)
+                    for x in images:
+                        # Memory allocated on the prefetch stream is now also used by the training stream
+                        x.record_stream(stream)
+                yield images, anns
+        finally:
+            self.epoch_seconds = time.perf_counter() - epoch_start
+            stop.set()
+            thread.join()
+
+
+def time_steps(batches, step, num_batches):
+    """(data wait seconds, total seconds) of num_batches training steps over batches."""
+    wait = 0.0
+    start = time.perf_counter()
+    iterator = iter(batches)
+    for _ in range(num_batches):
+        fetch_start = time.perf_counter()
+        images, _ = next(iterator)
+        wait += time.perf_counter() - fetch_start
+        step(images)
+    total = time.perf_counter() - start
+    del iterator
+    return wait, total
+
+
+def main():
+    import torchvision
+
+    import data_loader_triplet_v2 as data_loader
+    from denseNet201_v6_augs import initialize_model
+
+    parser = argparse.ArgumentParser(description='Data-wait fraction of training steps with and without prefetching')
+    parser.add_argument('--data-folder', type=str, required=True, help='folder containing data images')
+    parser.add_argument('--json', type=str, required=True, help='COCO-format annotations (or split index .npz)')
+    parser.add_argument('--image-size', type=int, default=224)
+    parser.add_argument('--batch-size', type=int, default=32)
+    parser.add_argument('--batches', type=int, default=50, help='timed steps per configuration')
+    parser.add_argument('--num-workers', type=int, default=4)
+    parser.add_argument('--prefetch-factor', type=int, default=2)
+    parser.add_argument('--persistent-workers', action='store_true', default=False)
+    parser.add_argument('--prefetch-batches', type=int, default=2, help='depth of the background prefetcher')
+    args = parser.parse_args()
+
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    transforms = torchvision.transforms.Compose([
+        torchvision.transforms.Resize(args.image_size),
+        torchvision.transforms.CenterCrop(args.image_size),
+        torchvision.transforms.PILToTensor(),
+    ])
+    loader = data_loader.get_loader(args.data_folder, args.json, transforms, batch_size=args.batch_size,
+                                    num_workers=args.num_workers, num_triplets=args.batch_size * args.batches,
+                                    pin_memory=device.type == 'cuda', persistent_workers=args.persistent_workers,
+                                    prefetch_factor=args.prefetch_factor)
+    model = initialize_model(use_pretrained=False).to(device)
+    model.train()
+    optimizer = torch.optim.Adam(model.parameters(), lr=1e-4)
+
+    def step(images):
+        optimizer.zero_grad()
+        embeddings = [model(x) for x in images]
+        execution.triplet_loss(*embeddings, margin=1.0).backward()
+        optimizer.step()
+
+    def inline(loader):
+        # Transfer and normalization between two steps, as without the prefetcher
+        for images, anns in loader:
+            yield prepare_triplet(images, device, batch_augment.normalize), anns
+
+    num_batches = len(loader) - 1
+    for name, batches in [('inline', inline(loader)),
+                          ('prefetch', BackgroundPrefetcher(loader, device, args.prefetch_batches,
+                                                            batch_augment.normalize))]:
+        wait, total = time_steps(batches, step, num_batches)
+        print({'pipeline': name, 'batches': num_batches, 'seconds': total, 'data_wait_seconds': wait,
+               'data_wait_fraction': wait / total})
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,175 @@
+"""Read-ahead of raw frame bytes from slow storage.
+
+On SageMaker the frames come from the SM_CHANNEL_DATA channel, locally often
+from network mounts or spinning disks, and every Image.open blocked the
+loader worker on a cold read. With a ByteReadahead set on the dataset
+(get_loader(readahead=...)), each worker
+
+    - hints the frames it will need: those of its current batch (all read
+      concurrently instead of one after the other) and, on the shared
+      memory ring, those of the next batch it will get (the batch
+      descriptors carry it, see shared_batches.BatchDescriptors);
+    - reads them with a bounded thread pool into an in-memory byte cache;
+    - decodes from memory, only waiting when a read is still in flight.
+
+Each process (main or loader worker) gets its own pool and cache; a pickled
+ByteReadahead starts empty. Decoded frames are kept up to max_mb, least
+recently used first out.
+
+Running this module compares triplet loading throughput from a throttled
+stand-in of slow storage (fixed latency and bandwidth per read) with and
+without read-ahead.
+
+Usage:
+    python denseNet201_v6_augs.py --shared-memory-batches --readahead-threads 16 ...
+    python readahead.py --data-folder images/ --json customSplit_train.json --latency-ms 20 --batches 20
+"""
+
+import argparse
+import collections
+import concurrent.futures
+import os
+import time
+
+
+def read_bytes(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+class ThrottledStorage:
+    """read_bytes with a fixed latency and bandwidth per read, standing in for slow storage.
+
+    Args:
+        latency_ms: delay before every read.
+        mb_per_sec: bandwidth of a single read (None = unlimited).
+    """
+    def __init__(self, latency_ms=20.0, mb_per_sec=None):
+        self.latency_ms = latency_ms
+        self.mb_per_sec = mb_per_sec
+
+    def __call__(self, path):
+        data = read_bytes(path)
+        seconds = self.latency_ms / 1000
+        if self.mb_per_sec:
+            seconds += len(data) / (self.mb_per_sec * 1024 ** 2)
+        time.sleep(seconds)
+        return data
+
+
+class ByteReadahead:
+    """Per-process thread pool reading hinted files into an in-memory byte cache.
+
+    Args:
+        storage: path -> bytes (read_bytes, or a ThrottledStorage).
+        num_threads: concurrent reads (0 = read synchronously, hints are ignored).
+        max_mb: size of the cache of frames already read.
+    """
+    def __init__(self, storage=read_bytes, num_threads=8, max_mb=256):
+        self.storage = storage
+        self.num_threads = num_threads
+        self.max_bytes = max_mb * 1024 ** 2
+        self._reset()
+
+    def _reset(self):
+        self.pool = None
+        self.pid = None
+        self.frames = collections.OrderedDict()  # path -> bytes or Future
+        self.cached_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.wait_seconds = 0.0
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state.update(pool=None, pid=None, frames=collections.OrderedDict(), cached_bytes=0)
+        return state
+
+    def _executor(self):
+        # A forked worker must not use its parent's pool
+        if self.pid != os.getpid():
+            self._reset()
+            self.pool = concurrent.futures.ThreadPoolExecutor(self.num_threads)
+            self.pid = os.getpid()
+        return self.pool
+
+    def hint(self, paths):
+        """Starts reading the files that are about to be read (in the order given)."""
+        if not self.num_threads:
+            return
+        pool = self._executor()
+        for path in paths:
+            if path not in self.frames:
+                self.frames[path] = pool.submit(self.storage, path)
+
+    def read(self, path):
+        """The file's bytes, from the cache if it was hinted."""
+        frame = self.frames.pop(path, None) if self.pid == os.getpid() else None
+        if frame is None:
+            self.misses += 1
+            data = self.storage(path)
+        elif isinstance(frame, concurrent.futures.Future):
+            self.hits += 1
+            start = time.perf_counter()
+            data = frame.result()
+            self.wait_seconds += time.perf_counter() - start
+        else:
+            self.hits += 1
+            self.cached_bytes -= len(frame)
+            data = frame
+        if self.num_threads:
+            self._executor()
+            self.frames[path] = data
+            self.cached_bytes += len(data)
+            self.evict()
+        return data
+
+    def evict(self):
+        """Drops the least recently used frames already read while the cache is over max_bytes."""
+        for path in list(self.frames):
+            if self.cached_bytes <= self.max_bytes:
+                return
+            frame = self.frames[path]
+            if not isinstance(frame, concurrent.futures.Future):
+                del self.frames[path]
+                self.cached_bytes -= len(frame)
+
+
+def main():
+    import numpy as np
+    import torchvision
+
+    import data_loader_triplet_v2 as data_loader
+    import shared_batches
+
+    parser = argparse.ArgumentParser(description='Triplet loading from throttled storage with and without read-ahead')
+    parser.add_argument('--data-folder', type=str, required=True, help='folder containing data images')
+    parser.add_argument('--json', type=str, required=True, help='COCO-format annotations (or split index .npz)')
+    parser.add_argument('--image-size', type=int, default=224)
+    parser.add_argument('--batch-size', type=int, default=32)
+    parser.add_argument('--batches', type=int, default=20)
+    parser.add_argument('--num-workers', type=int, default=2)
+    parser.add_argument('--latency-ms', type=float, default=20.0, help='per read of the throttled storage')
+    parser.add_argument('--mb-per-sec', type=float, default=None, help='per read of the throttled storage')
+    parser.add_argument('--readahead-threads', type=int, default=16)
+    args = parser.parse_args()
+
+    transforms = torchvision.transforms.Compose([
+        torchvision.transforms.Resize(args.image_size),
+        torchvision.transforms.CenterCrop(args.image_size),
+        torchvision.transforms.PILToTensor(),
+    ])
+    storage = ThrottledStorage(args.latency_ms, args.mb_per_sec)
+    for name, threads in [('blocking_reads', 0), ('readahead', args.readahead_threads)]:
+        np.random.seed(2021)
+        loader = data_loader.get_loader(args.data_folder, args.json, transforms, batch_size=args.batch_size,
+                                        num_workers=args.num_workers,
+                                        num_triplets=args.batch_size * (args.batches + 1),
+                                        shared_memory=True, image_size=args.image_size,
+                                        readahead=ByteReadahead(storage, threads))
+        seconds, images = shared_batches.time_loading(loader, args.batches, lambda x: x)
+        print({'pipeline': name, 'latency_ms': args.latency_ms, 'images_per_sec': images / seconds})
+
+
+if __name__ == '__main__':
+    main()
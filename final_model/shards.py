@@ -0,0 +1,498 @@
+"""Packed tar shards of a split, streamed sequentially with a shuffle buffer.
+
+Random access to thousands of small JPEGs is slow on object-store backed or
+network filesystems (the SageMaker notebook copies the whole data/ prefix
+before training). pack_shards writes the zebra annotations of a split into
+large tar shards plus an index.npz:
+
+    crops:  one JPEG per annotation, masked/cropped as for training (and
+            optionally resized), ordered individual by individual so that
+            sightings of an individual stream in close together;
+    frames: the original frame files, one per frame, cropped when streamed
+            (the split's annotation file is then needed to stream).
+
+StreamingTriplets and StreamingPKBatches read the shards front to back (one
+request per shard, so they work from any stream the opener returns and need
+no local copy of the data), pass the crops through a bounded shuffle buffer
+and serve
+
+    - (anchor, positive, negative) triplets like TripletZebras: every crop
+      leaving the buffer is an anchor, with a positive and a negative drawn
+      from the buffer; or
+    - P x K batches: K crops of each of P individuals.
+
+Shards are reshuffled every epoch (set_epoch) and split among loader workers.
+The epoch and the counters of skipped crops live in shared memory, so they
+reach (and come back from) persistent workers too.
+
+Running this module packs a split, or compares triplet loading by random
+access with streaming shards from a throttled local stand-in of an object
+store.
+
+Usage:
+    python shards.py pack --data-folder images/ --json customSplit_train.json -o shards/train --crop-size 256
+    python denseNet201_v6_augs.py --train-shards shards/train --shuffle-buffer 2000 ...
+    python shards.py bench --data-folder images/ --json customSplit_train.json --shards shards/train --latency-ms 20
+"""
+
+import argparse
+import collections
+import io
+import multiprocessing
+import os
+import tarfile
+import time
+
+import numpy as np
+import torch
+import torchvision
+from PIL import Image
+
+
+def join(location, name):
+    """location/name for a local directory or an object store URL."""
+    if '://' in location:
+        return location.rstrip('/') + '/' + name
+    return os.path.join(location, name)
+
+
+def increment(counter):
+    """Adds 1 to a multiprocessing.Value shared with the loader workers."""
+    with counter.get_lock():
+        counter.value += 1
+
+
+def open_local(path):
+    return open(path, 'rb')
+
+
+def open_s3(path):
+    """Opens an s3:// URL with s3fs (only needed for shards in S3)."""
+    import s3fs
+    return s3fs.S3FileSystem().open(path, 'rb')
+
+
+def opener_for(location):
+    """open_s3 for an s3:// prefix, open_local for a local directory."""
+    if location.startswith('s3://'):
+        return open_s3
+    if '://' in location:
+        raise ValueError('shards must be in a local directory or under an s3:// prefix, not {}'.format(location))
+    return open_local
+
+
+class ThrottledObjectStore:
+    """open_local with a fixed latency per request and a bandwidth limit, standing in for an object store.
+
+    Args:
+        latency_ms: delay before every request (open).
+        mb_per_sec: bandwidth of a single stream (None = unlimited).
+    """
+    def __init__(self, latency_ms=20.0, mb_per_sec=None):
+        self.latency_ms = latency_ms
+        self.mb_per_sec = mb_per_sec
+
+    def __call__(self, path):
+        time.sleep(self.latency_ms / 1000)
+        return ThrottledStream(open_local(path), self.mb_per_sec)
+
+    def read_bytes(self, path):
+        """readahead.ByteReadahead storage: one request per file."""
+        with self(path) as stream:
+            return stream.read()
+
+
+class ThrottledStream(io.RawIOBase):
+    def __init__(self, stream, mb_per_sec):
+        self.stream = stream
+        self.mb_per_sec = mb_per_sec
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        n = self.stream.readinto(buffer)
+        if self.mb_per_sec and n:
+            time.sleep(n / (self.mb_per_sec * 1024 ** 2))
+        return n
+
+    def close(self):
+        self.stream.close()
+        super().close()
+
+
+def pack_shards(annotations, output, shard_mb=512, mode='crops', crop_size=None, category_ids=(1,), seed=0):
+    """Writes the annotations of a split into tar shards and index.npz; returns the number of shards.
+
+    Args:
+        annotations: data_loader_triplet_v2.ZebraAnnotations of the split (mask/bbox options as for training,
+            no transform).
+        output: directory of the shards.
+        shard_mb: shard size at which the next shard is started.
+        mode: 'crops' (one JPEG per annotation) or 'frames' (one original file per frame).
+        crop_size: crops are resized to this shorter side (None = as cropped).
+        category_ids: annotation categories packed.
+        seed: seed of the order of individuals (crops).
+    """
+    assert mode in ('crops', 'frames'), 'mode must be crops or frames'
+    os.makedirs(output, exist_ok=True)
+    index = annotations.index
+    rows = index.rows_for_categories(list(category_ids))
+    rows = rows[np.asarray(index.ann_image_row)[rows] >= 0]
+    if mode == 'crops':
+        # Individuals in random order, their sightings together
+        names = np.asarray(index.ann_name)[rows]
+        rank = np.random.RandomState(seed).permutation(names.max() + 1)[names]
+        rows = rows[np.argsort(rank, kind='stable')]
+        member_rows = [[row] for row in rows]
+    else:
+        frames = np.asarray(index.ann_image_row)[rows]
+        order = np.argsort(frames, kind='stable')
+        member_rows = np.split(rows[order], np.flatnonzero(np.diff(frames[order])) + 1)
+    resize = torchvision.transforms.Resize(crop_size) if crop_size else None
+
+    shard_names, member_shard, member_offset, member_size, ann_member = [], [], [], [], []
+    tar = None
+    for member, group in enumerate(member_rows):
+        if mode == 'crops':
+            image = annotations.crop_annotation(annotations.decode_frame(group[0]), group[0])
+            if resize is not None:
+                image = resize(image)
+            buffer = io.BytesIO()
+            image.save(buffer, format='JPEG', quality=95)
+            data = buffer.getvalue()
+        else:
+            with open(os.path.join(annotations.root, index.image_path(group[0])), 'rb') as f:
+                data = f.read()
+        if tar is None or tar.offset >= shard_mb * 1024 ** 2:
+            if tar is not None:
+                tar.close()
+            shard_names.append('shard-{:05d}.tar'.format(len(shard_names)))
+            tar = tarfile.open(os.path.join(output, shard_names[-1]), 'w', format=tarfile.USTAR_FORMAT)
+        info = tarfile.TarInfo('{:08d}.jpg'.format(member))
+        info.size = len(data)
+        member_shard.append(len(shard_names) - 1)
+        member_offset.append(tar.offset)
+        member_size.append(len(data))
+        ann_member.extend([member] * len(group))
+        tar.addfile(info, io.BytesIO(data))
+    if tar is not None:
+        tar.close()
+
+    packed = np.concatenate(member_rows) if member_rows else rows
+    np.savez(os.path.join(output, 'index.npz'), mode=mode, shards=np.array(shard_names),
+             member_shard=np.array(member_shard, dtype=np.int32), member_offset=np.array(member_offset, dtype=np.int64),
+             member_size=np.array(member_size, dtype=np.int64), ann_member=np.array(ann_member, dtype=np.int64),
+             ann_id=np.asarray(index.ann_id)[packed], ann_name=np.asarray(index.ann_name)[packed])
+    return len(shard_names)
+
+
+class LabelBuffer:
+    """Shuffle buffer of (annotation id, label, image) that can also draw by label."""
+    def __init__(self):
+        self.entries = []
+        self.by_label = collections.defaultdict(list)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def add(self, entry):
+        self.entries.append(entry)
+        self.by_label[entry[1]].append(entry)
+
+    def remove(self, entry, position=None):
+        if position is None:
+            position = next(i for i, other in enumerate(self.entries) if other is entry)
+        self.entries[position] = self.entries[-1]
+        self.entries.pop()
+        same = self.by_label[entry[1]]
+        same.remove(entry)
+        if not same:
+            del self.by_label[entry[1]]
+
+    def pop_random(self, rng):
+        position = rng.randint(len(self.entries))
+        entry = self.entries[position]
+        self.remove(entry, position)
+        return entry
+
+    def other_label(self, label, rng, tries=32):
+        """A random entry of another label (None if there is none)."""
+        if len(self.by_label) == (label in self.by_label):
+            return None
+        for _ in range(tries):
+            entry = self.entries[rng.randint(len(self.entries))]
+            if entry[1] != label:
+                return entry
+        others = [entry for entry in self.entries if entry[1] != label]
+        return others[rng.randint(len(others))] if others else None
+
+
+class ShardStream(torch.utils.data.IterableDataset):
+    """Crops of packed shards, read sequentially; the base of StreamingTriplets and StreamingPKBatches.
+
+    Args:
+        location: shard directory or object store prefix (pack_shards output).
+        transform: applied to every crop (PIL image).
+        json: annotation file of the split, needed to crop frames shards (its mask/bbox options below).
+        shuffle_buffer: crops held for shuffling.
+        seed: seed of shard order and buffer draws (combined with the epoch).
+        opener: path -> readable binary stream (open_local, ThrottledObjectStore, an object store client).
+    """
+    def __init__(self, location, transform=None, json=None, apply_mask=False, apply_mask_bbox=False,
+                 shuffle_buffer=1000, seed=0, opener=open_local):
+        self.location = location
+        self.transform = transform
+        self.shuffle_buffer = shuffle_buffer
+        self.seed = seed
+        self.opener = opener
+        # Shared with the loader workers, which keep their copy of the dataset across epochs
+        self.shared_epoch = multiprocessing.Value('q', 0)
+        with opener(join(location, 'index.npz')) as stream:
+            index = np.load(io.BytesIO(stream.read()))
+            self.mode = str(index['mode'])
+            self.shards = index['shards'].tolist()
+            self.member_shard = index['member_shard']
+            self.ann_member = index['ann_member']
+            self.ann_id = index['ann_id']
+            self.ann_name = index['ann_name']
+        self.member_starts = np.searchsorted(self.ann_member, np.arange(len(self.member_shard) + 1))
+        self.annotations = None
+        if self.mode == 'frames':
+            assert json is not None, 'frames shards are cropped with the annotations of the split'
+            import data_loader_triplet_v2 as data_loader
+            self.annotations = data_loader.ZebraAnnotations(None, json, transform=transform, apply_mask=apply_mask,
+                                                            apply_mask_bbox=apply_mask_bbox)
+
+    @property
+    def epoch(self):
+        return self.shared_epoch.value
+
+    def set_epoch(self, epoch):
+        self.shared_epoch.value = epoch
+
+    def rng(self):
+        info = torch.utils.data.get_worker_info()
+        return np.random.RandomState([self.seed, self.epoch, info.id if info is not None else 0])
+
+    def worker_shards(self):
+        """This worker's share of the epoch's shard order."""
+        order = np.random.RandomState([self.seed, self.epoch]).permutation(len(self.shards))
+        info = torch.utils.data.get_worker_info()
+        if info is not None:
+            order = order[info.id::info.num_workers]
+        return order
+
+    def crops(self):
+        """(annotation id, label, image) of this worker's shards, in stream order."""
+        for shard in self.worker_shards():
+            with self.opener(join(self.location, self.shards[shard])) as stream:
+                tar = tarfile.open(fileobj=stream, mode='r|')
+                for info in tar:
+                    if not info.isfile():
+                        continue
+                    member = int(info.name.split('.')[0])
+                    image = Image.open(io.BytesIO(tar.extractfile(info).read())).convert('RGB')
+                    for position in range(self.member_starts[member], self.member_starts[member + 1]):
+                        annotation_id = int(self.ann_id[position])
+                        if self.annotations is not None:
+                            row = self.annotations.index.row_of(annotation_id)
+                            crop = self.annotations.crop_annotation(image, row)
+                        else:
+                            crop = self.transform(image) if self.transform else image
+                        yield annotation_id, int(self.ann_name[position]), crop
+
+
+class StreamingTriplets(ShardStream):
+    """(anchor, positive, negative) images and annotation ids, like TripletZebras, from shards.
+
+    Every crop leaving the shuffle buffer is the anchor of one triplet, with a
+    positive of the same individual and a negative of another one drawn from
+    the buffer; anchors without another sighting in the buffer are counted in
+    unpaired and dropped.
+    """
+    def __init__(self, location, transform=None, **kwargs):
+        super().__init__(location, transform, **kwargs)
+        self.shared_unpaired = multiprocessing.Value('q', 0)
+
+    @property
+    def unpaired(self):
+        """Anchors dropped so far (in all workers) for lack of a positive or negative in the buffer."""
+        return self.shared_unpaired.value
+
+    def __len__(self):
+        """Upper bound of the triplets per epoch: anchors without a positive in the buffer are dropped."""
+        return len(self.ann_id)
+
+    def triplet(self, buffer, rng):
+        anchor = buffer.pop_random(rng)
+        same = buffer.by_label.get(anchor[1])
+        negative = buffer.other_label(anchor[1], rng)
+        if not same or negative is None:
+            increment(self.shared_unpaired)
+            return None
+        positive = same[rng.randint(len(same))]
+        return [anchor[2], positive[2], negative[2]], [anchor[0], positive[0], negative[0]]
+
+    def __iter__(self):
+        rng = self.rng()
+        buffer = LabelBuffer()
+        for entry in self.crops():
+            buffer.add(entry)
+            if len(buffer) >= self.shuffle_buffer:
+                item = self.triplet(buffer, rng)
+                if item is not None:
+                    yield item
+        while buffer:
+            item = self.triplet(buffer, rng)
+            if item is not None:
+                yield item
+
+
+class StreamingPKBatches(ShardStream):
+    """Batches of K crops of each of P individuals: (images [P*K, ...], annotation ids, labels).
+
+    Use with batch_size=None. When the buffer is full but holds fewer than P
+    individuals with K crops, a random crop is dropped (counted in dropped).
+    """
+    def __init__(self, location, transform=None, p=8, k=4, **kwargs):
+        super().__init__(location, transform, **kwargs)
+        self.p = p
+        self.k = k
+        self.shared_dropped = multiprocessing.Value('q', 0)
+
+    @property
+    def dropped(self):
+        """Crops dropped so far (in all workers) from a full buffer without a P x K batch."""
+        return self.shared_dropped.value
+
+    def __len__(self):
+        return len(self.ann_id) // (self.p * self.k)
+
+    def batch(self, buffer, rng):
+        eligible = [label for label, entries in buffer.by_label.items() if len(entries) >= self.k]
+        if len(eligible) < self.p:
+            return None
+        entries = []
+        for label in rng.choice(eligible, self.p, replace=False):
+            same = buffer.by_label[label]
+            entries.extend([same[i] for i in rng.choice(len(same), self.k, replace=False)])
+        for entry in entries:
+            buffer.remove(entry)
+        return (torch.stack([entry[2] for entry in entries]), torch.tensor([entry[0] for entry in entries]),
+                torch.tensor([entry[1] for entry in entries]))
+
+    def __iter__(self):
+        rng = self.rng()
+        buffer = LabelBuffer()
+        for entry in self.crops():
+            buffer.add(entry)
+            if len(buffer) >= self.shuffle_buffer:
+                batch = self.batch(buffer, rng)
+                if batch is not None:
+                    yield batch
+                elif len(buffer) >= self.shuffle_buffer:
+                    buffer.pop_random(rng)
+                    increment(self.shared_dropped)
+        batch = self.batch(buffer, rng)
+        while batch is not None:
+            yield batch
+            batch = self.batch(buffer, rng)
+
+
+class StreamingLoader:
+    """DataLoader over a StreamingTriplets, with the len() and sampler.set_epoch() of the map-style loaders."""
+    def __init__(self, dataset, batch_size, loader_options):
+        self.dataset = dataset
+        self.batch_size = batch_size
+        self.loader = torch.utils.data.DataLoader(dataset, batch_size=batch_size, **loader_options)
+
+    @property
+    def sampler(self):
+        return self.dataset
+
+    def __len__(self):
+        """Upper bound of the batches per epoch: unpaired anchors are dropped (see StreamingTriplets.__len__)."""
+        return -(-len(self.dataset) // self.batch_size)
+
+    def __iter__(self):
+        return iter(self.loader)
+
+
+def get_stream_loader(location, transform, batch_size, json=None, apply_mask=False, apply_mask_bbox=False,
+                      shuffle_buffer=1000, seed=0, opener=None, num_workers=4, pin_memory=False,
+                      persistent_workers=False, prefetch_factor=2):
+    """Triplet loader over packed shards (see get_loader for the map-style one).
+
+    opener defaults to opener_for(location).
+    """
+    import data_loader_triplet_v2 as data_loader
+
+    if opener is None:
+        opener = opener_for(location)
+
+    dataset = StreamingTriplets(location, transform, json=json, apply_mask=apply_mask,
+                                apply_mask_bbox=apply_mask_bbox, shuffle_buffer=shuffle_buffer, seed=seed,
+                                opener=opener)
+    options = data_loader.loader_options(num_workers, pin_memory, persistent_workers, prefetch_factor)
+    return StreamingLoader(dataset, batch_size, options)
+
+
+def main():
+    import data_loader_triplet_v2 as data_loader
+    import readahead
+
+    parser = argparse.ArgumentParser(description='Pack a split into tar shards, or time streaming them')
+    parser.add_argument('command', choices=['pack', 'bench'])
+    parser.add_argument('--data-folder', type=str, required=True, help='folder containing data images')
+    parser.add_argument('--json', type=str, required=True, help='COCO-format annotations (or split index .npz)')
+    parser.add_argument('-o', '--shards', type=str, required=True, help='shard directory')
+    parser.add_argument('--mode', choices=['crops', 'frames'], default='crops')
+    parser.add_argument('--shard-mb', type=float, default=512)
+    parser.add_argument('--crop-size', type=int, default=None, help='resize packed crops to this shorter side')
+    parser.add_argument('--use-seg', action='store_true', default=False, help='apply the segmentation mask')
+    parser.add_argument('--use-bbox', action='store_true', default=False, help='crop to the bounding box')
+    parser.add_argument('--image-size', type=int, default=224)
+    parser.add_argument('--batch-size', type=int, default=32)
+    parser.add_argument('--shuffle-buffer', type=int, default=1000)
+    parser.add_argument('--num-workers', type=int, default=2)
+    parser.add_argument('--latency-ms', type=float, default=20.0, help='per request of the throttled store')
+    parser.add_argument('--mb-per-sec', type=float, default=None, help='per stream of the throttled store')
+    args = parser.parse_args()
+
+    if args.command == 'pack':
+        annotations = data_loader.ZebraAnnotations(args.data_folder, args.json, apply_mask=args.use_seg,
+                                                   apply_mask_bbox=args.use_bbox)
+        start = time.perf_counter()
+        num_shards = pack_shards(annotations, args.shards, args.shard_mb, args.mode, args.crop_size)
+        print({'shards': num_shards, 'mode': args.mode, 'seconds': time.perf_counter() - start})
+        return
+
+    transforms = torchvision.transforms.Compose([
+        torchvision.transforms.Resize(args.image_size),
+        torchvision.transforms.CenterCrop(args.image_size),
+        torchvision.transforms.PILToTensor(),
+    ])
+    store = ThrottledObjectStore(args.latency_ms, args.mb_per_sec)
+    streaming = get_stream_loader(args.shards, transforms, args.batch_size, json=args.json, apply_mask=args.use_seg,
+                                  apply_mask_bbox=args.use_bbox, shuffle_buffer=args.shuffle_buffer, opener=store,
+                                  num_workers=args.num_workers)
+    # As many triplets by random access (every frame read is one request)
+    np.random.seed(2021)
+    random_access = data_loader.get_loader(args.data_folder, args.json, transforms, batch_size=args.batch_size,
+                                           num_workers=args.num_workers, apply_mask=args.use_seg,
+                                           apply_mask_bbox=args.use_bbox, num_triplets=len(streaming.dataset),
+                                           readahead=readahead.ByteReadahead(store.read_bytes, num_threads=0))
+    for name, loader in [('random_access', random_access), ('streaming_shards', streaming)]:
+        start = time.perf_counter()
+        triplets = sum(len(anchor) for (anchor, _, _), _ in loader)
+        seconds = time.perf_counter() - start
+        summary = {'pipeline': name, 'latency_ms': args.latency_ms, 'triplets': triplets, 'seconds': seconds,
+                   'images_per_sec': 3 * triplets / seconds}
+        if loader is streaming:
+            summary['unpaired_anchors'] = streaming.dataset.unpaired
+        print(summary)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,195 @@
+"""Zero-copy triplet batches through a ring of shared-memory uint8 buffers.
+
+With the default DataLoader path every worker builds three float32 tensors
+per triplet, collates them into new stacked tensors (a fresh shared-memory
+segment per batch) and sends them to the main process. SharedBatchLoader
+instead preallocates, in the main process, a ring of uint8 batch buffers
+[num_slots, 3, batch_size, 3, H, W] in shared memory. The sampler hands each
+batch a ring slot; the worker decodes the batch's crops straight into that
+slot and only returns the slot number and the annotation ids (each frame
+the batch needs is decoded once for all of its crops; decode_sharing_ratio()
+reports crops per decode over the epoch). Images cross
+the process boundary once, as uint8 (4x less than float32), and
+normalization runs once per batch in the main process
+(batch_augment.normalize, or BatchAugment).
+
+The main process gets views into the ring: a batch must be copied out (the
+training loop's torch.cat / .to(device), or the BackgroundPrefetcher) before
+extra_slots further batches have been requested, after which its slot is
+rewritten.
+
+Running this module compares loading throughput and per-batch IPC bytes of
+the default float32 path against the ring.
+
+Usage:
+    python denseNet201_v6_augs.py --shared-memory-batches ...
+    python shared_batches.py --data-folder images/ --json customSplit_train.json --batches 50
+"""
+
+import argparse
+import collections
+import time
+
+import numpy as np
+import torch
+
+
+class TripletBatchWriter(torch.utils.data.Dataset):
+    """Dataset over batch descriptors (slot, triplets): writes the batch's uint8 crops into its ring slot.
+
+    Args:
+        dataset: TripletZebras whose transform returns uint8 [3, H, W] tensors.
+        buffers: shared uint8 ring [num_slots, 3, batch_size, 3, H, W].
+    """
+    def __init__(self, dataset, buffers):
+        self.dataset = dataset
+        self.buffers = buffers
+
+    def __getitem__(self, descriptor):
+        slot, triplets, upcoming = descriptor
+        if upcoming:
+            # Frames of this worker's next batch are read while this one is decoded
+            self.dataset.prefetch(self.dataset.index.row_of(np.asarray(upcoming).flatten()))
+        triplets = torch.tensor(triplets, dtype=torch.int64)
+        # Annotations of the batch that share a frame share its decode
+        images, decodes = self.dataset.load_images(self.dataset.index.row_of(triplets.t().flatten().numpy()))
+        buffer = self.buffers[slot]
+        for i, image in enumerate(images):
+            buffer[i // len(triplets), i % len(triplets)].copy_(image)
+        return slot, triplets, decodes
+
+
+class BatchDescriptors(torch.utils.data.Sampler):
+    """Turns the batches of a batch sampler into (ring slot, id triplets, upcoming id triplets).
+
+    Slots are assigned round robin. With a lookahead, upcoming are the
+    triplets of the batch lookahead places further on: the DataLoader hands
+    batches to its workers round robin, so with lookahead = num_workers that
+    is the next batch of the same worker (for its readahead).
+    """
+    def __init__(self, dataset, batch_sampler, num_slots, lookahead=0):
+        self.dataset = dataset
+        self.batch_sampler = batch_sampler
+        self.num_slots = num_slots
+        self.lookahead = lookahead
+        self.next_slot = 0
+
+    def __iter__(self):
+        pending = collections.deque()
+        for batch in self.batch_sampler:
+            pending.append([item if isinstance(item, tuple) else tuple(self.dataset.triplets[item]) for item in batch])
+            if len(pending) > self.lookahead:
+                yield self.describe(pending)
+        while pending:
+            yield self.describe(pending)
+
+    def describe(self, pending):
+        triplets = pending.popleft()
+        upcoming = pending[self.lookahead - 1] if self.lookahead and len(pending) >= self.lookahead else []
+        descriptor = (self.next_slot, triplets, upcoming)
+        self.next_slot = (self.next_slot + 1) % self.num_slots
+        return descriptor
+
+    def __len__(self):
+        return len(self.batch_sampler)
+
+
+class SharedBatchLoader:
+    """Iterable like the triplet DataLoader: ([anchor, positive, negative] uint8 batches, [3 id tensors]).
+
+    Args:
+        dataset: TripletZebras with a uint8 transform of size image_size.
+        batch_sampler: batches of dataset indices or id triplets (BatchSampler, ReplayBatchSampler).
+        image_size: side of the square crops.
+        loader_options: DataLoader keyword arguments (see data_loader_triplet_v2.loader_options).
+        extra_slots: batches the consumer may hold on to beyond the ones the workers prefetch.
+
+    With a readahead on the dataset, every descriptor also names the next
+    batch of the same worker.
+    """
+    def __init__(self, dataset, batch_sampler, image_size, loader_options, extra_slots=2):
+        workers = loader_options.get('num_workers', 0)
+        in_flight = workers * loader_options.get('prefetch_factor', 2) if workers else 1
+        self.num_slots = in_flight + extra_slots
+        lookahead = max(workers, 1) if dataset.readahead is not None else 0
+        self.batch_size = batch_sampler.batch_size
+        self.buffers = torch.empty((self.num_slots, 3, self.batch_size, 3, image_size, image_size),
+                                   dtype=torch.uint8).share_memory_()
+        self.dataset = dataset
+        self.batch_sampler = batch_sampler
+        descriptors = BatchDescriptors(dataset, batch_sampler, self.num_slots, lookahead)
+        self.loader = torch.utils.data.DataLoader(TripletBatchWriter(dataset, self.buffers), sampler=descriptors,
+                                                  batch_size=None, **loader_options)
+        self.crops = 0
+        self.decodes = 0
+
+    @property
+    def sampler(self):
+        return self.batch_sampler.sampler
+
+    def __len__(self):
+        return len(self.loader)
+
+    def decode_sharing_ratio(self):
+        """Crops per decoded frame over the last (or current) epoch."""
+        return self.crops / self.decodes if self.decodes else 1.0
+
+    def __iter__(self):
+        self.crops = 0
+        self.decodes = 0
+        for slot, triplets, decodes in self.loader:
+            n = len(triplets)
+            self.crops += 3 * n
+            self.decodes += int(decodes)
+            yield [self.buffers[slot, k, :n] for k in range(3)], list(triplets.unbind(1))
+
+
+def time_loading(loader, num_batches, prepare):
+    """(seconds, images) to draw num_batches batches and prepare them in the main process."""
+    images = 0
+    start = time.perf_counter()
+    for i, (batch, _) in enumerate(loader):
+        if i == num_batches:
+            break
+        images += sum(len(prepare(x)) for x in batch)
+    return time.perf_counter() - start, images
+
+
+def main():
+    import torchvision
+
+    import batch_augment
+    import data_loader_triplet_v2 as data_loader
+
+    parser = argparse.ArgumentParser(description='Triplet loading throughput: float32 collation vs shared uint8 ring')
+    parser.add_argument('--data-folder', type=str, required=True, help='folder containing data images')
+    parser.add_argument('--json', type=str, required=True, help='COCO-format annotations (or split index .npz)')
+    parser.add_argument('--image-size', type=int, default=224)
+    parser.add_argument('--batch-size', type=int, default=32)
+    parser.add_argument('--batches', type=int, default=50)
+    parser.add_argument('--num-workers', type=int, default=4)
+    args = parser.parse_args()
+
+    downsample = [torchvision.transforms.Resize(args.image_size), torchvision.transforms.CenterCrop(args.image_size)]
+    float_transforms = torchvision.transforms.Compose(downsample + [
+        torchvision.transforms.ToTensor(),
+        torchvision.transforms.Normalize(mean=batch_augment.IMAGENET_MEAN, std=batch_augment.IMAGENET_STD),
+    ])
+    uint8_transforms = torchvision.transforms.Compose(downsample + [torchvision.transforms.PILToTensor()])
+    image_bytes = 3 * args.image_size ** 2
+    num_triplets = args.batch_size * (args.batches + 1)
+
+    for name, transforms, shared, prepare, bytes_per_image in [
+            ('float32_collate', float_transforms, False, lambda x: x, 4 * image_bytes),
+            ('shared_uint8_ring', uint8_transforms, True, batch_augment.normalize, image_bytes)]:
+        np.random.seed(2021)
+        loader = data_loader.get_loader(args.data_folder, args.json, transforms, batch_size=args.batch_size,
+                                        num_workers=args.num_workers, num_triplets=num_triplets,
+                                        shared_memory=shared, image_size=args.image_size)
+        seconds, images = time_loading(loader, args.batches, prepare)
+        print({'pipeline': name, 'images_per_sec': images / seconds,
+               'image_ipc_mb_per_batch': 3 * args.batch_size * bytes_per_image / 1024 ** 2})
+
+
+if __name__ == '__main__':
+    main()
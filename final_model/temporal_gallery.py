@@ -0,0 +1,270 @@
+"""Time-partitioned gallery with recent-first re-identification search.
+
+In the field the best match for a new sighting is usually a recent sighting
+of the same animal. TemporalGallery splits the gallery into partitions of
+--partition-days by capture time and searches them in order of their
+distance in time to the query (sightings without a capture time last). The
+search stops after a partition as soon as the best individual so far is
+within match_threshold, so most queries never touch old partitions.
+
+Old partitions can be compacted into cold storage: each becomes a directory
+of .npy files that is memory-mapped only when a search reaches it, so the
+resident gallery stays the size of the hot (recent) partitions.
+
+Running this module benchmarks search latency, gallery fraction compared and
+accuracy against exhaustive search, broken down by how old the most recent
+earlier sighting of the query's individual is.
+
+Usage:
+    python temporal_gallery.py --json customSplit_test.json --embeddings test_embeddings.npz \
+        --partition-days 30 --match-threshold 0.5 --cold-dir gallery_cold/ --hot-partitions 3
+"""
+
+import argparse
+import json
+import os
+import pathlib
+import shutil
+import tempfile
+import time
+
+import numpy as np
+
+from geo_index import SECONDS_PER_DAY, load_gallery, rank_individuals
+
+UNDATED = None  # partition key of sightings without a capture time
+AGE_BINS_DAYS = [7, 30, 90, 365]
+
+
+class Partition:
+    """Sightings of one time window: gallery rows, embeddings, labels, times.
+
+    A cold partition keeps only its path and key in memory and memory-maps its
+    arrays on first access.
+    """
+    COLUMNS = ['rows', 'embeddings', 'labels', 'times']
+
+    def __init__(self, key, rows=None, embeddings=None, labels=None, times=None, path=None):
+        self.key = key
+        self.path = None if path is None else pathlib.Path(path)
+        self._arrays = None if rows is None else {
+            'rows': rows, 'embeddings': embeddings, 'labels': labels, 'times': times}
+
+    @property
+    def is_cold(self):
+        return self.path is not None
+
+    def arrays(self):
+        if self._arrays is None:
+            self._arrays = {name: np.load(self.path / (name + '.npy'), mmap_mode='r') for name in self.COLUMNS}
+        return self._arrays
+
+    def __len__(self):
+        return len(self.arrays()['rows'])
+
+    def write(self, path):
+        """Writes the partition to path atomically and turns it into a cold partition."""
+        path = pathlib.Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_dir = pathlib.Path(tempfile.mkdtemp(prefix=path.name + '.', dir=path.parent))
+        for name, array in self.arrays().items():
+            np.save(tmp_dir / (name + '.npy'), np.asarray(array))
+        with open(tmp_dir / 'meta.json', 'w') as f:
+            json.dump({'key': self.key, 'num_sightings': len(self)}, f)
+        # Move an older copy aside rather than deleting it first, so a crash never loses the partition
+        stale_dir = None
+        if path.exists():
+            stale_dir = tmp_dir.with_name(tmp_dir.name + '.stale')
+            os.rename(path, stale_dir)
+        os.rename(tmp_dir, path)
+        if stale_dir is not None:
+            shutil.rmtree(stale_dir, ignore_errors=True)
+        self.path = path
+        self._arrays = None  # drop the in-memory copy; reopened mmapped on demand
+
+
+class TemporalGallery:
+    """Gallery partitioned by capture time.
+
+    Args:
+        embeddings: [num_gallery, dim] gallery embeddings.
+        labels: individual id per gallery sighting.
+        times: capture time per sighting in unix seconds (NaN if unknown).
+        partition_days: length of a partition.
+    """
+    def __init__(self, embeddings, labels, times, partition_days=30.0):
+        embeddings = np.asarray(embeddings, dtype=np.float32)
+        labels = np.asarray(labels)
+        times = np.asarray(times, dtype=np.float64)
+        self.partition_seconds = partition_days * SECONDS_PER_DAY
+        self.num_sightings = len(labels)
+
+        # Newest partition first, then one partition of the undated sightings
+        dated = np.flatnonzero(np.isfinite(times))
+        keys = np.floor(times[dated] / self.partition_seconds).astype(np.int64)
+        order = np.argsort(-keys, kind='stable')
+        unique_keys, starts = np.unique(-keys[order], return_index=True)
+        offsets = np.append(starts, len(order))
+        self.partitions = []
+        for g, key in enumerate(-unique_keys):
+            rows = dated[order[offsets[g]:offsets[g + 1]]]
+            self.partitions.append(Partition(int(key), rows, embeddings[rows], labels[rows], times[rows]))
+        undated = np.flatnonzero(~np.isfinite(times))
+        if len(undated):
+            self.partitions.append(Partition(UNDATED, undated, embeddings[undated], labels[undated], times[undated]))
+
+    def compact(self, cold_dir, hot_partitions=3):
+        """Moves all but the newest hot_partitions dated partitions to cold storage."""
+        cold_dir = pathlib.Path(cold_dir)
+        dated = [p for p in self.partitions if p.key is not UNDATED]
+        cold = dated[hot_partitions:] + [p for p in self.partitions if p.key is UNDATED]
+        for partition in cold:
+            if not partition.is_cold:
+                name = 'undated' if partition.key is UNDATED else 'partition_{}'.format(partition.key)
+                partition.write(cold_dir / name)
+        return len(cold)
+
+    def search_order(self, query_time=None):
+        """Partitions ordered by distance in time to the query; undated last."""
+        dated = [p for p in self.partitions if p.key is not UNDATED]
+        undated = [p for p in self.partitions if p.key is UNDATED]
+        if query_time is not None and np.isfinite(query_time):
+            query_key = np.floor(query_time / self.partition_seconds)
+            dated.sort(key=lambda p: (abs(p.key - query_key), -p.key))
+        return dated + undated
+
+    def search(self, query_embedding, query_time=None, k=5, match_threshold=None, exclude=None):
+        """Recent-first search with early termination.
+
+        Partitions are searched in search_order; after each one the search
+        stops if the best individual so far is within match_threshold (never,
+        if match_threshold is None).
+
+        Returns:
+            (top-k labels, partitions searched, sightings compared, terminated early)
+        """
+        best = {}  # label -> smallest distance so far
+        compared = searched = 0
+        early = False
+        for partition in self.search_order(query_time):
+            arrays = partition.arrays()
+            keep = slice(None) if exclude is None else ~np.isin(arrays['rows'], exclude)
+            embeddings, labels = arrays['embeddings'][keep], arrays['labels'][keep]
+            searched += 1
+            compared += len(labels)
+            if len(labels):
+                distances = np.linalg.norm(embeddings - query_embedding, axis=1)
+                top_labels, top_distances = rank_individuals(distances, labels, k)
+                for label, distance in zip(top_labels.tolist(), top_distances.tolist()):
+                    if distance < best.get(label, np.inf):
+                        best[label] = distance
+            if match_threshold is not None and best and min(best.values()) <= match_threshold:
+                early = True
+                break
+        ranked = sorted(best, key=best.get)[:k]
+        return ranked, searched, compared, early
+
+
+def match_ages(labels, times):
+    """Days since the most recent earlier sighting of the same individual (NaN if none)."""
+    order = np.lexsort((times, labels))
+    sorted_labels, sorted_times = labels[order], times[order]
+    same = np.zeros(len(order), dtype=bool)
+    same[1:] = sorted_labels[1:] == sorted_labels[:-1]
+    age = np.full(len(order), np.nan)
+    age[1:][same[1:]] = (sorted_times[1:] - sorted_times[:-1])[same[1:]] / SECONDS_PER_DAY
+    ages = np.empty(len(order))
+    ages[order] = age
+    return ages
+
+
+def age_bin_names():
+    edges = [0] + AGE_BINS_DAYS
+    return ['<{}d'.format(hi) for hi in AGE_BINS_DAYS] + ['>={}d'.format(edges[-1]), 'no earlier/undated']
+
+
+def benchmark(gallery, embeddings, labels, times, queries, k=5, match_threshold=None):
+    """Per age bin: queries, latency, partitions searched, fraction compared, accuracy vs. exhaustive."""
+    ages = match_ages(labels, times)
+    bins = np.where(np.isfinite(ages), np.searchsorted(AGE_BINS_DAYS, ages, side='right'), len(AGE_BINS_DAYS) + 1)
+    columns = ['latency_ms', 'partitions', 'compared', 'early', 'top1', 'topk', 'exhaustive_top1']
+    results = {name: np.zeros(len(queries)) for name in columns}
+    for i, q in enumerate(queries):
+        start = time.perf_counter()
+        ranked, searched, compared, early = gallery.search(embeddings[q], times[q], k=k,
+                                                           match_threshold=match_threshold, exclude=[q])
+        results['latency_ms'][i] = 1000 * (time.perf_counter() - start)
+        results['partitions'][i] = searched
+        results['compared'][i] = compared / max(len(labels) - 1, 1)
+        results['early'][i] = early
+        results['top1'][i] = len(ranked) > 0 and ranked[0] == labels[q]
+        results['topk'][i] = labels[q] in ranked
+
+        distances = np.linalg.norm(embeddings - embeddings[q], axis=1)
+        distances[q] = np.inf
+        exhaustive, _ = rank_individuals(distances, labels, 1)
+        results['exhaustive_top1'][i] = exhaustive[0] == labels[q]
+
+    report = {}
+    query_bins = bins[queries]
+    for b, name in enumerate(age_bin_names()):
+        selected = query_bins == b
+        if not selected.any():
+            continue
+        latency = results['latency_ms'][selected]
+        report[name] = {
+            'queries': int(selected.sum()),
+            'latency_ms_p50': float(np.percentile(latency, 50)),
+            'latency_ms_p95': float(np.percentile(latency, 95)),
+            'partitions_searched': float(results['partitions'][selected].mean()),
+            'compared_fraction': float(results['compared'][selected].mean()),
+            'early_stop_rate': float(results['early'][selected].mean()),
+            'top1': float(results['top1'][selected].mean()),
+            'top{}'.format(k): float(results['topk'][selected].mean()),
+            'exhaustive_top1': float(results['exhaustive_top1'][selected].mean()),
+        }
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark time-partitioned gallery search')
+    parser.add_argument('-j', '--json', type=pathlib.Path, required=True,
+                        help='Annotations JSON file in COCO-format (or split index .npz)')
+    parser.add_argument('-e', '--embeddings', type=pathlib.Path, required=True,
+                        help='.npz with annotation_ids and embeddings (see embed_annotations.py)')
+    parser.add_argument('--partition-days', type=float, default=30,
+                        help='length of a gallery partition in days')
+    parser.add_argument('--match-threshold', type=float, default=None,
+                        help='stop searching older partitions once a match is this close')
+    parser.add_argument('--cold-dir', type=pathlib.Path, default=None,
+                        help='compact old partitions into this folder')
+    parser.add_argument('--hot-partitions', type=int, default=3,
+                        help='number of recent partitions kept in memory')
+    parser.add_argument('-k', type=int, default=5, help='report top-k accuracy')
+    parser.add_argument('-n', '--num-queries', type=int, default=1000,
+                        help='number of leave-one-out queries to time')
+    parser.add_argument('-s', '--seed', type=int, default=21)
+    args = parser.parse_args()
+
+    data = load_gallery(args.json, args.embeddings)
+    embeddings = data['embeddings'].astype(np.float32)
+    labels, times = data['labels'], data['times']
+    gallery = TemporalGallery(embeddings, labels, times, args.partition_days)
+    if args.cold_dir:
+        num_cold = gallery.compact(args.cold_dir, args.hot_partitions)
+        print('compacted {} of {} partitions into {}'.format(num_cold, len(gallery.partitions), args.cold_dir))
+
+    _, inverse, counts = np.unique(labels, return_inverse=True, return_counts=True)
+    candidates = np.flatnonzero(counts[inverse] > 1)
+    rng = np.random.RandomState(args.seed)
+    queries = rng.choice(candidates, size=min(args.num_queries, len(candidates)), replace=False)
+
+    print('gallery: {} sightings, {} partitions, {} undated'.format(
+        len(labels), len(gallery.partitions), int(np.isnan(times).sum())))
+    report = benchmark(gallery, embeddings, labels, times, queries, k=args.k, match_threshold=args.match_threshold)
+    for name, row in report.items():
+        print('match age {}: {}'.format(name, row))
+
+
+if __name__ == '__main__':
+    main()
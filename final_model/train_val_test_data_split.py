@@ -1,118 +1,271 @@
+"""Identity-disjoint train/val/test (and k-fold) splits of a COCO-format annotation file.
+
+Individuals are keyed by (category, annotation 'name') and grouped in a single
+pass over the annotation index. Each species is stratified by how often an
+individual was sighted (one, two, more than two), and each stratum is split
+on its own, so every split sees the same mix of rarely and frequently sighted
+animals of every species.
+
+With --folds 1 (default) the strata are split train/val/test. With --folds K
+the test individuals are held out first and the rest are dealt into K
+identity-disjoint folds; fold k is the validation set of split k and the
+other folds its training set. --train-subsets adds nested fractional training
+sets (a prefix of each stratum), e.g. for learning curves.
+
+Outputs either compact COCO JSON (only the images each split references,
+copied record by record out of the source JSON at the byte ranges the index
+recorded, so the source is not parsed again) or split index files (.npz of
+annotation ids plus the source JSON) that data_loader_triplet_v2 opens
+directly without ever re-parsing the JSON. Prefer --format index for folds
+and subsets.
+
+Usage:
+    python train_val_test_data_split.py -j ../gzgc.coco/annotations/instances_train2020.json \
+        -o ../gzgc.coco/annotations/ --seed 21 --fractions 0.7 0.1 0.2 --category-ids 1
+    python train_val_test_data_split.py -j instances_train2020.json -o folds/ \
+        --category-ids 1 2 --folds 5 --train-subsets 0.125 0.25 0.5 --format index
+"""
+
+import argparse
 import json
-import numpy as np
 import os
+import pathlib
+
+import numpy as np
+
+import annotation_index
+
+NUM_BUCKETS = 3  # one, two, more than two sightings
+
+
+def sighting_buckets(group_sizes):
+    """Bucket per individual: 0 = one sighting, 1 = two, 2 = more than two."""
+    return np.minimum(group_sizes, NUM_BUCKETS) - 1
+
+
+def individual_strata(index, category_ids):
+    """Groups the selected annotations by (category, individual) in one pass.
+
+    Returns:
+        strata: stratum per individual (category position * NUM_BUCKETS + bucket)
+        offsets: individual g owns order[offsets[g]:offsets[g + 1]]
+        order: annotation rows sorted by (category, name)
+    """
+    category_ids = np.sort(np.asarray(category_ids))
+    rows = np.flatnonzero(np.isin(index.ann_category, category_ids))
+    categories = np.asarray(index.ann_category)[rows]
+    names = np.asarray(index.ann_name)[rows]
+    order_in_rows = np.lexsort((names, categories))
+    order = rows[order_in_rows]
+    categories, names = categories[order_in_rows], names[order_in_rows]
+
+    new_group = np.ones(len(order), dtype=bool)
+    new_group[1:] = (categories[1:] != categories[:-1]) | (names[1:] != names[:-1])
+    starts = np.flatnonzero(new_group)
+    offsets = np.append(starts, len(order)).astype(np.int64)
+    group_sizes = np.diff(offsets)
+    group_category = np.searchsorted(category_ids, categories[starts])
+    strata = group_category * NUM_BUCKETS + sighting_buckets(group_sizes)
+    return strata, offsets, order
+
+
+def stratum_positions(strata, rng):
+    """Random position of each individual within its stratum.
+
+    Strata are permuted in order (category, then one/two/more sightings), which
+    for a single category reproduces the original script's np.random sequence.
+    """
+    positions = np.empty(len(strata), dtype=np.int64)
+    stratum_sizes = np.bincount(strata, minlength=strata.max() + 1 if len(strata) else 0)
+    for stratum in range(len(stratum_sizes)):
+        members = np.flatnonzero(strata == stratum)
+        rand_split_inds = rng.permutation(np.arange(len(members))).astype(int)
+        positions[members[rand_split_inds]] = np.arange(len(members))
+    return positions, stratum_sizes
+
+
+def assign_individuals(strata, rng, fractions, folds=1):
+    """Assigns every individual to test or to one of the train/val folds.
+
+    Args:
+        strata: stratum per individual, see individual_strata.
+        rng: np.random.RandomState.
+        fractions: (train, val, test) fractions; test takes the remainder.
+        folds: 1 for a single train/val split, K for K-fold cross-validation.
+    Returns:
+        fold: per individual; -1 = test, otherwise the fold it is validation for
+            (with folds=1: 0 = val, -2 = train)
+        positions: random position of each individual within its stratum
+    """
+    positions, stratum_sizes = stratum_positions(strata, rng)
+    n = stratum_sizes[strata]
+    train_val_divide = np.floor(fractions[0] * n).astype(np.int64)
+    val_test_divide = train_val_divide + np.floor(fractions[1] * n).astype(np.int64)
+
+    fold = np.full(len(strata), -1, dtype=np.int64)
+    if folds == 1:
+        fold[positions < train_val_divide] = -2
+        fold[(positions >= train_val_divide) & (positions < val_test_divide)] = 0
+    else:
+        pool = positions < val_test_divide
+        # Deal each stratum round-robin so the folds stay stratified
+        fold[pool] = positions[pool] % folds
+    return fold, positions
+
+
+def nested_prefix(selected, strata, positions, fraction):
+    """First floor(fraction * n) selected individuals of each stratum, by position."""
+    members = np.flatnonzero(selected)
+    order = members[np.lexsort((positions[members], strata[members]))]
+    sorted_strata = strata[order]
+    counts = np.bincount(sorted_strata, minlength=strata.max() + 1 if len(strata) else 0)
+    first = np.searchsorted(sorted_strata, sorted_strata)
+    rank = np.arange(len(order)) - first
+    keep = rank < np.floor(fraction * counts[sorted_strata])
+    subset = np.zeros(len(strata), dtype=bool)
+    subset[order[keep]] = True
+    return subset
+
+
+def build_splits(index, category_ids, seed, fractions, folds=1, train_subsets=()):
+    """Computes every split in one pass over the annotation index.
+
+    Returns:
+        dict of split name -> sorted annotation rows, e.g. 'train', 'val',
+        'test', 'train_0.5' or 'fold0_train', 'fold0_val', 'fold0_train_0.5', 'test'
+    """
+    strata, offsets, order = individual_strata(index, category_ids)
+    rng = np.random.RandomState(seed)
+    fold, positions = assign_individuals(strata, rng, fractions, folds)
+    group_sizes = np.diff(offsets)
+
+    def rows(selected):
+        return np.sort(order[np.repeat(selected, group_sizes)])
+
+    splits = {}
+    for k in range(folds):
+        prefix = '' if folds == 1 else 'fold{}_'.format(k)
+        train = fold == -2 if folds == 1 else (fold >= 0) & (fold != k)
+        splits[prefix + 'train'] = rows(train)
+        splits[prefix + 'val'] = rows(fold == k)
+        for fraction in train_subsets:
+            splits['{}train_{}'.format(prefix, fraction)] = rows(nested_prefix(train, strata, positions, fraction))
+    splits['test'] = rows(fold == -1)
+    return splits
+
+
+def sightings_per_individual(index, rows):
+    """(sightings, number of individuals with that many) over the individuals of the given rows."""
+    categories = np.asarray(index.ann_category)[rows].astype(np.int64)
+    names = np.asarray(index.ann_name)[rows].astype(np.int64)
+    _, group_sizes = np.unique((categories << 32) | names, return_counts=True)
+    return np.unique(group_sizes, return_counts=True)
+
+
+def write_split_index(path, index, rows, source_json, **meta):
+    """Writes a split index file: annotation ids into the source JSON's index."""
+    path = pathlib.Path(path)
+    source = os.path.relpath(pathlib.Path(source_json).resolve(), path.resolve().parent)
+    np.savez(path,
+             annotation_ids=np.asarray(index.ann_id)[rows],
+             source=np.array(source),
+             meta=np.array(json.dumps(meta)))
+
+
+def write_coco_json(path, categories, images, annotations):
+    """Streams a compact COCO JSON to disk one record (JSON-encoded bytes) at a time."""
+    def write_list(f, key, records):
+        f.write('"{}": ['.format(key).encode('utf-8'))
+        for i, record in enumerate(records):
+            if i:
+                f.write(b',')
+            f.write(record)
+        f.write(b']')
+
+    with open(path, 'wb') as f:
+        f.write(b'{')
+        write_list(f, 'categories', categories)
+        f.write(b',')
+        write_list(f, 'images', images)
+        f.write(b',')
+        write_list(f, 'annotations', annotations)
+        f.write(b'}')
+
+
+def write_json_splits(json_path, index, splits, output_paths):
+    """Writes one COCO JSON per split, keeping only the images it references.
+
+    Images and annotations are copied byte for byte from the memory-mapped
+    source JSON, in their source order, at the byte ranges in the index.
+    """
+    source = np.memmap(json_path, dtype=np.uint8, mode='r')
+    categories = [json.dumps(category, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+                  for category in index.meta['categories']]
+
+    def records(spans):
+        for start, end in spans[np.argsort(spans[:, 0])].tolist():
+            yield source[start:end].tobytes()
+
+    for name, rows in splits.items():
+        image_rows = np.unique(np.asarray(index.ann_image_row)[rows])
+        image_rows = image_rows[image_rows >= 0]
+        write_coco_json(output_paths[name], categories,
+                        records(np.asarray(index.img_span)[image_rows]),
+                        records(np.asarray(index.ann_span)[rows]))
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Identity-disjoint train/val/test and k-fold splits')
+    parser.add_argument('-j', '--json', type=pathlib.Path,
+                        default='../gzgc.coco/annotations/instances_train2020.json',
+                        help='Annotations JSON file in COCO-format')
+    parser.add_argument('-o', '--output-dir', type=pathlib.Path,
+                        default='../gzgc.coco/annotations/',
+                        help='Folder for the split files')
+    parser.add_argument('--prefix', default='customSplit',
+                        help='Split files are named <prefix>_<split>.{json,npz}')
+    parser.add_argument('-s', '--seed', type=int, default=21,
+                        help='random seed for consistency')
+    parser.add_argument('--fractions', type=float, nargs=3, default=[0.7, 0.1, 0.2],
+                        metavar=('TRAIN', 'VAL', 'TEST'),
+                        help='fraction of individuals per split; test is the remainder. '
+                             'With --folds K, train + val individuals are dealt into the K folds')
+    parser.add_argument('-c', '--category-ids', type=int, nargs='+', default=[1],
+                        help='Which animal categories to include (1 = zebra, 2 = giraffe)')
+    parser.add_argument('-k', '--folds', type=int, default=1,
+                        help='number of identity-disjoint cross-validation folds')
+    parser.add_argument('--train-subsets', type=float, nargs='*', default=[],
+                        help='also write nested fractional training sets, e.g. 0.125 0.5')
+    parser.add_argument('--format', choices=['json', 'index'], default='json',
+                        help='compact COCO JSON copies, or split index files (.npz)')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    assert abs(sum(args.fractions) - 1.0) < 1e-6, 'fractions should sum to 1'
+    assert args.folds >= 1, 'need at least one fold'
+
+    index = annotation_index.load_index(args.json)
+    splits = build_splits(index, args.category_ids, args.seed, args.fractions,
+                          folds=args.folds, train_subsets=args.train_subsets)
+
+    os.makedirs(args.output_dir, exist_ok=True)  # create directory if needed
+    suffix = '.npz' if args.format == 'index' else '.json'
+    output_paths = {name: args.output_dir.joinpath('{}_{}{}'.format(args.prefix, name, suffix))
+                    for name in splits}
+    if args.format == 'index':
+        for name, rows in splits.items():
+            write_split_index(output_paths[name], index, rows, args.json,
+                              split=name, seed=args.seed, fractions=args.fractions,
+                              folds=args.folds, category_ids=args.category_ids)
+    else:
+        write_json_splits(args.json, index, splits, output_paths)
+
+    for name, rows in splits.items():
+        print('{}: {} annotations -> {}'.format(name, len(rows), output_paths[name]))
+        print('    sightings per individual (count, num individuals):', sightings_per_individual(index, rows))
+
 
-np.random.seed(21)
-
-# load the annotations
-BOX_ANNOTATION_FILE = '../gzgc.coco/annotations/instances_train2020.json'
-with open(BOX_ANNOTATION_FILE) as f:
-    data_orig = json.load(f)
-f.close()
-
-# get zebra annotations (excludes giraffe)
-zebra_annotations = [ann for ann in data_orig['annotations'] if ann['category_id'] == 1]
-
-# get the zebra names from the annotations, 6286 zebra annotations, 639 giraffe annotations
-zebra_names = [ann['name'] for ann in zebra_annotations]
-
-# get the unique individual zebra names and counts
-zebra_names_counts = np.unique(zebra_names, return_counts=True)
-
-#  tells you that there's 876 zebra names with 1 sighting, 346 zebra names with 2 sightings, etc
-print(np.unique(np.unique(zebra_names, return_counts=True)[1], return_counts=True))
-
-# group zebra ids by single sighting, two sightings, or more than two
-zebra_names_one = zebra_names_counts[0][np.where(zebra_names_counts[1] == 1)]  # zebra with just one image
-zebra_names_two = zebra_names_counts[0][np.where(zebra_names_counts[1] == 2)]
-zebra_names_over_two = zebra_names_counts[0][np.where(zebra_names_counts[1] > 2)]
-
-# split each group into 0.7 train / 0.1 val / 0.2 test
-trainFrac = 0.7
-valFrac = 0.1
-testFrac = 0.2  # just assumed to be the remainder of the data after train and val
-# split ones
-rand_split_inds = np.random.permutation(np.arange(len(zebra_names_one))).astype(int)
-trainValDivide = int(np.floor(trainFrac * len(zebra_names_one)))
-valTestDivide = trainValDivide + int(np.floor(valFrac * len(zebra_names_one)))
-zebra_one_train = [zebra_names_one[a] for a in rand_split_inds[:trainValDivide]]
-zebra_one_val = [zebra_names_one[a] for a in rand_split_inds[trainValDivide:valTestDivide]]
-zebra_one_test = [zebra_names_one[a] for a in rand_split_inds[valTestDivide:]]
-
-# split twos
-rand_split_inds = np.random.permutation(np.arange(len(zebra_names_two))).astype(int)
-trainValDivide = int(np.floor(trainFrac * len(zebra_names_two)))
-valTestDivide = trainValDivide + int(np.floor(valFrac * len(zebra_names_two)))
-zebra_two_train = [zebra_names_two[a] for a in rand_split_inds[:trainValDivide]]
-zebra_two_val = [zebra_names_two[a] for a in rand_split_inds[trainValDivide:valTestDivide]]
-zebra_two_test = [zebra_names_two[a] for a in rand_split_inds[valTestDivide:]]
-
-# split over twos
-rand_split_inds = np.random.permutation(np.arange(len(zebra_names_over_two))).astype(int)
-trainValDivide = int(np.floor(trainFrac * len(zebra_names_over_two)))
-valTestDivide = trainValDivide + int(np.floor(valFrac * len(zebra_names_over_two)))
-zebra_over_two_train = [zebra_names_over_two[a] for a in rand_split_inds[:trainValDivide]]
-zebra_over_two_val = [zebra_names_over_two[a] for a in rand_split_inds[trainValDivide:valTestDivide]]
-zebra_over_two_test = [zebra_names_over_two[a] for a in rand_split_inds[valTestDivide:]]
-
-# concatenate ids over groups
-zebra_train = zebra_one_train + zebra_two_train + zebra_over_two_train
-zebra_val = zebra_one_val + zebra_two_val + zebra_over_two_val
-zebra_test = zebra_one_test + zebra_two_test + zebra_over_two_test
-
-# for each group, restructure dataset and save out
-print(data_orig.keys())
-print(data_orig['annotations'][0])
-
-# create training dataset
-data_train = {}
-data_train['categories'] = data_orig['categories'].copy()
-data_train['images'] = data_orig['images'].copy()
-data_train['annotations'] = []
-for name in zebra_train:
-    # append all images this zebra appears in
-    [data_train['annotations'].append(ann) for ann in data_orig['annotations'] if ann['name'] == name]
-
-# create validation dataset
-data_val = {}
-data_val['categories'] = data_orig['categories'].copy()
-data_val['images'] = data_orig['images'].copy()
-data_val['annotations'] = []
-for name in zebra_val:
-    # append all images this zebra appears in
-    [data_val['annotations'].append(ann) for ann in data_orig['annotations'] if ann['name'] == name]
-
-# create test dataset
-data_test = {}
-data_test['categories'] = data_orig['categories'].copy()
-data_test['images'] = data_orig['images'].copy()
-data_test['annotations'] = []
-for name in zebra_test:
-    # append all images this zebra appears in
-    [data_test['annotations'].append(ann) for ann in data_orig['annotations'] if ann['name'] == name]
-
-# end up with 4328 training annotations, 677 validation annotations, and 1681 testing annotations (total 6304 annotations)
-totalAnns = len(data_test['annotations']) + len(data_val['annotations']) + len(data_train['annotations'])
-print(len(data_train['annotations']))
-print(len(data_val['annotations']))
-print(len(data_test['annotations']))
-print(totalAnns)
-
-# save out the new jsons
-new_data_path = '../gzgc.coco/annotations/'
-os.makedirs(new_data_path, exist_ok=True) # create directory if needed
-
-with open(new_data_path + 'customSplit_train.json', 'w') as outfile:
-    json.dump(data_train, outfile, indent = 4, ensure_ascii = False)
-
-with open(new_data_path + 'customSplit_val.json', 'w') as outfile:
-    json.dump(data_val, outfile, indent = 4, ensure_ascii = False)
-
-with open(new_data_path + 'customSplit_test.json', 'w') as outfile:
-    json.dump(data_test, outfile, indent = 4, ensure_ascii = False)
-
-#6286
-# targ train = 4400
-# targ val = 628
-# targ test = 1258
-# so pretty close
\ No newline at end of file
+if __name__ == '__main__':
+    main()
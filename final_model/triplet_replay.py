@@ -0,0 +1,252 @@
+"""Loss-aware triplet replay.
+
+Once the triplet margin is satisfied a triplet contributes zero loss, yet it
+still costs three image decodes and forwards every time it is drawn. train()
+records the loss of every triplet in a ReplayBuffer, which keeps
+
+    - a bounded set of the highest-loss triplets (priority = loss), and
+    - the triplets whose loss was zero, so they can be skipped,
+
+and forgets both after max_age_steps optimizer steps (the model has moved on
+by then). ReplayBatchSampler fills replay_fraction of every batch with
+buffered triplets, drawn with probability proportional to their loss, and
+the rest with fresh triplets of the epoch, skipping recently satisfied ones.
+
+Running this module trains the same model with random and with replayed
+batches under the same wall-clock budget and prints validation triplet
+accuracy against training seconds.
+
+Usage:
+    python denseNet201_v6_augs.py --replay-fraction 0.25 --replay-capacity 2000 ...
+    python triplet_replay.py --data-folder images/ --train-json customSplit_train.json \
+        --val-json customSplit_val.json --seconds 1800 --eval-every 120
+"""
+
+import argparse
+import heapq
+import math
+import time
+
+import numpy as np
+import torch
+
+
+class ReplayBuffer:
+    """Per-triplet losses from training: high-loss triplets to replay, zero-loss ones to skip.
+
+    Args:
+        capacity: number of high-loss triplets kept.
+        max_age_steps: optimizer steps after which a recorded loss is forgotten.
+    """
+    def __init__(self, capacity=2000, max_age_steps=500):
+        self.capacity = capacity
+        self.max_age_steps = max_age_steps
+        self.entries = {}  # triplet -> (loss, step)
+        self.satisfied = {}  # triplet -> step its loss was zero
+        self.step = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def record(self, triplets, losses):
+        """Records the losses of one optimizer step's triplets ([N, 3] annotation ids, [N])."""
+        self.step += 1
+        for triplet, loss in zip(map(tuple, np.asarray(triplets).tolist()), np.asarray(losses).tolist()):
+            if loss > 0:
+                self.entries[triplet] = (loss, self.step)
+                self.satisfied.pop(triplet, None)
+            else:
+                self.entries.pop(triplet, None)
+                self.satisfied[triplet] = self.step
+        oldest = self.step - self.max_age_steps
+        if len(self.entries) > self.capacity or any(step < oldest for _, step in self.entries.values()):
+            kept = [(triplet, entry) for triplet, entry in self.entries.items() if entry[1] >= oldest]
+            self.entries = dict(heapq.nlargest(self.capacity, kept, key=lambda item: item[1][0]))
+
+    def is_satisfied(self, triplet):
+        """True if the triplet had zero loss within the last max_age_steps steps."""
+        step = self.satisfied.get(triplet)
+        if step is None:
+            return False
+        if step < self.step - self.max_age_steps:
+            del self.satisfied[triplet]
+            return False
+        return True
+
+    def sample(self, n, rng):
+        """Up to n distinct buffered triplets, drawn with probability proportional to their loss."""
+        if not self.entries or n <= 0:
+            return []
+        triplets = list(self.entries)
+        losses = np.array([self.entries[triplet][0] for triplet in triplets])
+        picks = rng.choice(len(triplets), size=min(n, len(triplets)), replace=False, p=losses / losses.sum())
+        return [triplets[i] for i in picks]
+
+
+class ReplayBatchSampler(torch.utils.data.Sampler):
+    """Batches of (anchor, positive, negative) id triplets: replayed high-loss ones plus fresh ones.
+
+    The epoch ends when sampler runs out of fresh triplets; skipped (recently
+    satisfied) triplets make it shorter than len(sampler) / fresh per batch.
+
+    Args:
+        dataset: TripletZebras (its __getitem__ accepts a triplet).
+        buffer: ReplayBuffer filled by train().
+        sampler: fresh triplets, as dataset indices or id triplets (e.g. HardNegativeSampler).
+        batch_size: triplets per batch.
+        replay_fraction: share of every batch taken from the buffer.
+        seed: seed of the replay draws.
+    """
+    def __init__(self, dataset, buffer, sampler, batch_size, replay_fraction=0.25, seed=0):
+        self.dataset = dataset
+        self.buffer = buffer
+        self.sampler = sampler
+        self.batch_size = batch_size
+        self.num_replay = min(int(round(replay_fraction * batch_size)), batch_size - 1)
+        self.seed = seed
+        self.rng = np.random.RandomState(seed)
+        self.skipped = 0
+        self.replayed = 0
+
+    def __iter__(self):
+        batch = []
+        for item in self.sampler:
+            triplet = item if isinstance(item, tuple) else tuple(self.dataset.triplets[item])
+            if self.buffer.is_satisfied(triplet):
+                self.skipped += 1
+                continue
+            if not batch:
+                batch = self.buffer.sample(self.num_replay, self.rng)
+                self.replayed += len(batch)
+            if triplet not in batch:
+                batch.append(triplet)
+            if len(batch) == self.batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+    def __len__(self):
+        return math.ceil(len(self.sampler) / (self.batch_size - self.num_replay))
+
+    def set_epoch(self, epoch):
+        self.rng = np.random.RandomState([self.seed, epoch])
+        if hasattr(self.sampler, 'set_epoch'):
+            self.sampler.set_epoch(epoch)
+
+
+def val_accuracy(model, loader, device):
+    """Fraction of triplets whose anchor is closer to the positive than to the negative."""
+    model.eval()
+    correct = 0
+    total = 0
+    with torch.no_grad():
+        for (anchor, positive, negative), _ in loader:
+            anchor, positive, negative = (model(x.to(device)) for x in (anchor, positive, negative))
+            correct += int((torch.linalg.norm(anchor - positive, dim=-1)
+                            < torch.linalg.norm(anchor - negative, dim=-1)).sum())
+            total += len(anchor)
+    return correct / total
+
+
+def train_for(model, loader, buffer, device, args, val_loader):
+    """Trains for args.seconds (data loading included); returns [(seconds, triplets, val accuracy)]."""
+    optimizer = torch.optim.Adam(model.parameters(), lr=args.lr)
+    curve = [(0.0, 0, val_accuracy(model, val_loader, device))]
+    seconds = 0.0
+    triplets = 0
+    next_eval = args.eval_every
+    while seconds < args.seconds:
+        model.train()
+        start = time.perf_counter()
+        batches = iter(loader)
+        seconds += time.perf_counter() - start
+        while seconds < args.seconds:
+            start = time.perf_counter()
+            batch = next(batches, None)
+            if batch is None:
+                break
+            (anchor, positive, negative), anns = batch
+            optimizer.zero_grad()
+            embeddings = [model(x.to(device)) for x in (anchor, positive, negative)]
+            losses = torch.nn.functional.triplet_margin_loss(*embeddings, margin=args.margin, reduction='none')
+            losses.mean().backward()
+            optimizer.step()
+            if buffer is not None:
+                buffer.record(torch.stack(anns, 1).numpy(), losses.detach().cpu().numpy())
+            seconds += time.perf_counter() - start
+            triplets += len(anchor)
+            if seconds >= min(next_eval, args.seconds):
+                curve.append((seconds, triplets, val_accuracy(model, val_loader, device)))
+                print({'mode': 'random' if buffer is None else 'replay', 'train_seconds': seconds,
+                       'triplets': triplets, 'val_accuracy': curve[-1][2]})
+                next_eval += args.eval_every
+                model.train()
+    return curve
+
+
+def main():
+    import torchvision
+
+    import data_loader_triplet_v2 as data_loader
+    from denseNet201_v6_augs import initialize_model
+
+    parser = argparse.ArgumentParser(description='Validation accuracy per training second, random vs replayed triplets')
+    parser.add_argument('--data-folder', type=str, required=True, help='folder containing data images')
+    parser.add_argument('--train-json', type=str, required=True)
+    parser.add_argument('--val-json', type=str, required=True)
+    parser.add_argument('--image-size', type=int, default=224)
+    parser.add_argument('--batch-size', type=int, default=32)
+    parser.add_argument('--num-train-triplets', type=int, default=10*1000)
+    parser.add_argument('--num-val-triplets', type=int, default=1500)
+    parser.add_argument('--replay-fraction', type=float, default=0.25)
+    parser.add_argument('--replay-capacity', type=int, default=2000)
+    parser.add_argument('--replay-max-age', type=int, default=500, help='in optimizer steps')
+    parser.add_argument('--margin', type=float, default=1.0)
+    parser.add_argument('--lr', type=float, default=1e-3)
+    parser.add_argument('--seconds', type=float, default=600, help='training time budget per mode')
+    parser.add_argument('--eval-every', type=float, default=60, help='training seconds between evaluations')
+    parser.add_argument('--target-accuracy', type=float, default=None,
+                        help='also report the training seconds each mode needs to reach it')
+    parser.add_argument('--num-workers', type=int, default=4)
+    args = parser.parse_args()
+
+    device = torch.device('cpu')
+    transforms = torchvision.transforms.Compose([
+        torchvision.transforms.Resize(args.image_size),
+        torchvision.transforms.CenterCrop(args.image_size),
+        torchvision.transforms.ToTensor(),
+        torchvision.transforms.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225]),
+    ])
+    np.random.seed(2021)
+    val_dataset = data_loader.TripletZebras(args.data_folder, args.val_json, transforms,
+                                            num_triplets=args.num_val_triplets)
+    val_loader = torch.utils.data.DataLoader(val_dataset, batch_size=args.batch_size, num_workers=args.num_workers)
+
+    curves = {}
+    for mode in ('random', 'replay'):
+        np.random.seed(2021)
+        torch.manual_seed(0)
+        dataset = data_loader.TripletZebras(args.data_folder, args.train_json, transforms,
+                                            num_triplets=args.num_train_triplets)
+        buffer = None
+        if mode == 'replay':
+            buffer = ReplayBuffer(args.replay_capacity, args.replay_max_age)
+            batch_sampler = ReplayBatchSampler(dataset, buffer, torch.utils.data.RandomSampler(dataset),
+                                               args.batch_size, args.replay_fraction)
+        else:
+            batch_sampler = torch.utils.data.BatchSampler(torch.utils.data.RandomSampler(dataset),
+                                                          args.batch_size, drop_last=False)
+        loader = torch.utils.data.DataLoader(dataset, batch_sampler=batch_sampler, num_workers=args.num_workers)
+        curves[mode] = train_for(initialize_model().to(device), loader, buffer, device, args, val_loader)
+
+    for mode, curve in curves.items():
+        summary = {'mode': mode, 'final_val_accuracy': curve[-1][2], 'triplets': curve[-1][1]}
+        if args.target_accuracy is not None:
+            reached = [seconds for seconds, _, accuracy in curve if accuracy >= args.target_accuracy]
+            summary['seconds_to_target'] = reached[0] if reached else None
+        print(summary)
+
+
+if __name__ == '__main__':
+    main()
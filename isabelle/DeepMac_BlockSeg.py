@@ -23,6 +23,9 @@ from skimage.color import rgb_colors
 import tensorflow as tf
 from matplotlib.patches import Rectangle
 
+from deepmac_utils import box_masks_from_predictions, convert_boxes
+from detection_index import DetectionIndex
+
 COLORS = ([rgb_colors.cyan, rgb_colors.orange, rgb_colors.pink,
            rgb_colors.purple, rgb_colors.limegreen, rgb_colors.crimson] +
           [(color) for (name, color) in color.color_dict.items()])
@@ -44,26 +47,8 @@ def read_json(path):
 
 
 def create_detection_map(annotations):
-    """Creates a dict mapping IDs to detections."""
-
-    ann_map = {}
-    # for image in annotations['images']:
-    #   ann_map[image['id']] = image['detections']
-    # return ann_map
-
-    for image in annotations['images']:
-        # get all the detections for that image
-        image_id = image['id']
-        detections = []
-        for a in annotations['annotations']:
-            if a['image_id'] == image_id:
-                a['float_bbox'] = a['bbox'].copy()
-                bbox = a['segmentation_bbox'].copy()
-                # swap the bounding box dimensions to be [x y width height]
-                a['bbox'] = [float(bbox[0]), float(bbox[1]), float(bbox[2]), float(bbox[3])]
-                detections.append(a)
-        ann_map[str(image_id)] = detections
-    return ann_map
+    """Creates an index mapping image IDs to detection boxes [x, y, width, height]."""
+    return DetectionIndex(annotations)
 
 
 def get_mask_prediction_function(model):
@@ -71,95 +56,18 @@ def get_mask_prediction_function(model):
 
     @tf.function
     def predict_masks(image, boxes):
-        height, width, _ = image.shape.as_list()
         batch = image[tf.newaxis]
         boxes = boxes[tf.newaxis]
 
         detections = model(batch, boxes)
         masks = detections['detection_masks']
 
-        return reframe_box_masks_to_image_masks(masks[0], boxes[0],
-                                                height, width)
+        # Box-resolution masks [num_boxes, mask_height, mask_width]; see BoxMask
+        return masks[0]
 
     return predict_masks
 
 
-def convert_boxes(boxes, imH, imW):
-    xmin, ymin, width, height = boxes[:, 0], boxes[:, 1], boxes[:, 2], boxes[:, 3]
-    ymax = ymin + height
-    xmax = xmin + width
-    print([xmin, xmax, ymin, ymax])
-    imH = float(imH)
-    imW = float(imW)
-    ymin = ymin / imH
-    ymax = ymax / imH
-    xmin = xmin / imW
-    xmax = xmax / imW
-    return np.stack([ymin, xmin, ymax, xmax], axis=1).astype(np.float32)
-
-
-# Copied from tensorflow/models
-def reframe_box_masks_to_image_masks(box_masks, boxes, image_height,
-                                     image_width, resize_method='bilinear'):
-    """Transforms the box masks back to full image masks.
-  Embeds masks in bounding boxes of larger masks whose shapes correspond to
-  image shape.
-  Args:
-    box_masks: A tensor of size [num_masks, mask_height, mask_width].
-    boxes: A tf.float32 tensor of size [num_masks, 4] containing the box
-           corners. Row i contains [ymin, xmin, ymax, xmax] of the box
-           corresponding to mask i. Note that the box corners are in
-           normalized coordinates.
-    image_height: Image height. The output mask will have the same height as
-                  the image height.
-    image_width: Image width. The output mask will have the same width as the
-                 image width.
-    resize_method: The resize method, either 'bilinear' or 'nearest'. Note that
-      'bilinear' is only respected if box_masks is a float.
-  Returns:
-    A tensor of size [num_masks, image_height, image_width] with the same dtype
-    as `box_masks`.
-  """
-    resize_method = 'nearest' if box_masks.dtype == tf.uint8 else resize_method
-
-    # TODO(rathodv): Make this a public function.
-    def reframe_box_masks_to_image_masks_default():
-        """The default function when there are more than 0 box masks."""
-
-        def transform_boxes_relative_to_boxes(boxes, reference_boxes):
-            boxes = tf.reshape(boxes, [-1, 2, 2])
-            min_corner = tf.expand_dims(reference_boxes[:, 0:2], 1)
-            max_corner = tf.expand_dims(reference_boxes[:, 2:4], 1)
-            denom = max_corner - min_corner
-            # Prevent a divide by zero.
-            denom = tf.math.maximum(denom, 1e-4)
-            transformed_boxes = (boxes - min_corner) / denom
-            return tf.reshape(transformed_boxes, [-1, 4])
-
-        box_masks_expanded = tf.expand_dims(box_masks, axis=3)
-        num_boxes = tf.shape(box_masks_expanded)[0]
-        unit_boxes = tf.concat(
-            [tf.zeros([num_boxes, 2]), tf.ones([num_boxes, 2])], axis=1)
-        reverse_boxes = transform_boxes_relative_to_boxes(unit_boxes, boxes)
-
-        # TODO(vighneshb) Use matmul_crop_and_resize so that the output shape
-        # is static. This will help us run and test on TPUs.
-        resized_crops = tf.image.crop_and_resize(
-            image=box_masks_expanded,
-            boxes=reverse_boxes,
-            box_indices=tf.range(num_boxes),
-            crop_size=[image_height, image_width],
-            method=resize_method,
-            extrapolation_value=0)
-        return tf.cast(resized_crops, box_masks.dtype)
-
-    image_masks = tf.cond(
-        tf.shape(box_masks)[0] > 0,
-        reframe_box_masks_to_image_masks_default,
-        lambda: tf.zeros([0, image_height, image_width, 1], box_masks.dtype))
-    return tf.squeeze(image_masks, axis=3)
-
-
 def plot_image_annotations(image, boxes, masks, darken_image=0.5):
     fig, ax = plt.subplots(figsize=(16, 12))
     ax.set_axis_off()
@@ -183,13 +91,14 @@ def plot_image_annotations(image, boxes, masks, darken_image=0.5):
         rect = patches.Rectangle((xmin, ymin), xmax - xmin, ymax - ymin,
                                  linewidth=2.5, edgecolor=color, facecolor='none')
         ax.add_patch(rect)
-        mask = (mask > 0.5).astype(np.float32)
-        color_image = np.ones_like(image) * color[np.newaxis, np.newaxis, :]
+        # Composite only over the box, not a full-frame RGBA buffer per mask
+        local = mask.local().astype(np.float32)
+        color_image = np.ones(local.shape + (3,)) * color[np.newaxis, np.newaxis, :]
         color_and_mask = np.concatenate(
-            [color_image, mask[:, :, np.newaxis]], axis=2)
-        print('imageSHAPE')
-        print(color_and_mask.shape)
-        ax.imshow(color_and_mask, alpha=0.5)
+            [color_image, local[:, :, np.newaxis]], axis=2)
+        ax.imshow(color_and_mask, alpha=0.5, extent=(mask.x0, mask.x1, mask.y1, mask.y0))
+        ax.set_xlim(0, width)
+        ax.set_ylim(height, 0)
 
         color_index = (color_index + 1) % num_colors
 
@@ -217,9 +126,8 @@ if image_id not in detection_map:
 elif len(detection_map[image_id]) == 0:
     print(f'There are no detected objects in the image {image_path}.')
 else:
-    detections = detection_map[image_id]
     image = read_image(image_path)
-    bboxes = np.array([det['bbox'] for det in detections])  # [x, y, width, height]
+    bboxes = detection_map[image_id]  # [x, y, width, height]
     print("BBOXES")
     print(bboxes)
     # f = plt.figure(figsize=(6, 5))
@@ -235,17 +143,16 @@ else:
     print(image.shape)
     masks = prediction_function(tf.convert_to_tensor(image),
                                 tf.convert_to_tensor(bboxes, dtype=tf.float32))
-    ax = plot_image_annotations(image, bboxes, masks.numpy(), darken_image=0.75)
+    masks = box_masks_from_predictions(masks.numpy(), bboxes, image.shape[0], image.shape[1])
+    ax = plot_image_annotations(image, bboxes, masks, darken_image=0.75)
     ax.set_title("Image ID: " + image_id)
     plt.show()
 
     # now for each segmentation in the image, black out every pixel that is not a segmentation part
-    for mask in masks.numpy():
-        segImage = image.copy()
-        binaryMask = (mask > 0.5).astype(np.float32)
+    for mask in masks:
         print('BINARY SHAPE')
-        print(binaryMask.shape)
-        print(np.unique(binaryMask))
-        segImage[np.where(binaryMask == 0.0)] = 0
+        print(mask.local().shape)
+        print(np.unique(mask.local()))
+        segImage = mask.apply(image)
         plt.imshow(segImage)
         plt.show()
@@ -0,0 +1,433 @@
+"""Resumable batch DeepMAC mask generation for a whole COCO annotation file.
+
+Produces the maskrcnn-style annotation file the training code expects
+(e.g. instances_train2020_maskrcnn.json): every annotation with a box gains
+'maskrcnn_mask_rle' (compressed COCO RLE) and 'maskrcnn_bbox'
+([x_left, y_top, x_right, y_bottom] of the predicted mask).
+
+Images are grouped by size so that each model call runs a batch of same-size
+images with all of their boxes. Masks are kept at box resolution (see
+deepmac_utils.BoxMask), RLE-encoded straight from the box-local mask and
+written to chunk files in --work-dir; each chunk lists the images it
+completed, so a rerun after a crash skips them and resumes where it stopped.
+Once every image is done the chunks are merged into --output.
+
+With --num-workers N the images are dealt round-robin to N spawned worker
+processes, each loading its own model, capped to --threads-per-worker CPU
+threads and writing its own shard_XXX/ folder of chunks. The merge reads every
+shard and orders results by the source annotation file, so the output is the
+same however the work was sharded.
+
+With --mask-cache, masks are looked up by image content hash, rounded box,
+model id and box-extension settings (see mask_cache.py) and only the misses
+are predicted; throughput reports include the cache hit rate.
+
+Usage:
+    # if you haven't already, download the DeepMAC checkpoint (see DeepMAC_firstPass.py)
+    python deepmac_batch.py --json ../../Data/gzgc.coco/annotations/instances_train2020.json \
+        --images ../../Data/gzgc.coco/images/train2020 \
+        --model ../../deepMAC/deepmac_1024x1024_coco17/saved_model \
+        --work-dir ../../Data/gzgc.coco/masks/deepmac_work \
+        --output ../../Data/gzgc.coco/masks/instances_train2020_maskrcnn.json --extend \
+        --num-workers 8 --threads-per-worker 4
+"""
+
+import argparse
+import io
+import json
+import os
+import pathlib
+import time
+
+import numpy as np
+from PIL import Image
+import pycocotools.mask as mask_util
+
+from detection_index import DetectionIndex
+from mask_cache import MaskCache, content_hash, model_id_for
+
+CHUNK_GLOB = 'chunk_*.json'
+
+
+def read_json(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+def image_sizes(annotations, root, image_ids):
+    """(height, width) per image id, from the COCO record or the image header."""
+    records = {img['id']: img for img in annotations['images']}
+    sizes = {}
+    for image_id in image_ids:
+        img = records[image_id]
+        if 'height' in img and 'width' in img:
+            sizes[image_id] = (int(img['height']), int(img['width']))
+        else:
+            with Image.open(os.path.join(root, img['file_name'])) as im:
+                sizes[image_id] = (im.height, im.width)
+    return sizes
+
+
+def plan_batches(image_ids, sizes, batch_size):
+    """Groups images of the same size into batches of at most batch_size."""
+    by_size = {}
+    for image_id in sorted(image_ids):
+        by_size.setdefault(sizes[image_id], []).append(image_id)
+    batches = []
+    for size in sorted(by_size):
+        ids = by_size[size]
+        batches.extend(ids[i:i + batch_size] for i in range(0, len(ids), batch_size))
+    return batches
+
+
+def padded_box_count(num_boxes):
+    """Round up to a power of two so the model is traced for few box counts."""
+    return 1 << max(int(num_boxes) - 1, 0).bit_length()
+
+
+def mask_record(box_mask, fallback_box):
+    """BoxMask -> (maskrcnn_mask_rle, maskrcnn_bbox), encoded from the box-local mask."""
+    bbox = box_mask.bbox()
+    if bbox is None:
+        # Empty mask; keep the input box so crops still work
+        x, y, w, h = [float(v) for v in fallback_box]
+        bbox = [x, y, x + w, y + h]
+    return box_mask.to_rle(), bbox
+
+
+def load_checkpoint(work_dir, done_root=None):
+    """Image ids already completed, and the next free chunk number in work_dir.
+
+    Completed images are collected from every chunk under done_root (default
+    work_dir), so shards never redo images finished by a different sharding.
+    """
+    done = set()
+    for path in sorted(pathlib.Path(done_root or work_dir).rglob(CHUNK_GLOB)):
+        with open(path) as f:
+            done.update(json.load(f)['image_ids'])
+    chunk_paths = pathlib.Path(work_dir).glob(CHUNK_GLOB)
+    next_chunk = 1 + max((int(p.stem.split('_')[-1]) for p in chunk_paths), default=-1)
+    return done, next_chunk
+
+
+class ChunkWriter:
+    """Buffers per-annotation results and writes them atomically in chunks."""
+    def __init__(self, work_dir, next_chunk, chunk_size, prefix='chunk'):
+        self.work_dir = pathlib.Path(work_dir)
+        self.next_chunk = next_chunk
+        self.chunk_size = chunk_size
+        self.prefix = prefix
+        self.image_ids = []
+        self.records = []
+
+    def add(self, image_id, records):
+        self.image_ids.append(int(image_id))
+        self.records.extend(records)
+        if len(self.image_ids) >= self.chunk_size:
+            self.flush()
+
+    def flush(self):
+        if not self.image_ids:
+            return
+        path = self.work_dir / '{}_{:06d}.json'.format(self.prefix, self.next_chunk)
+        tmp_path = path.with_suffix('.tmp')
+        with open(tmp_path, 'w') as f:
+            json.dump({'image_ids': self.image_ids, 'annotations': self.records}, f, separators=(',', ':'))
+        os.replace(tmp_path, path)
+        self.next_chunk += 1
+        self.image_ids = []
+        self.records = []
+
+
+class MaskGenerator:
+    """Runs the box-conditioned mask model over batches of same-size images."""
+    def __init__(self, model_path, extend=False, threshold=0.5, extend_side=0.05, extend_up=0.05, extend_down=0.15):
+        # TensorFlow is only needed when actually predicting
+        import tensorflow as tf
+        from deepmac_utils import get_batch_mask_prediction_function
+
+        self.tf = tf
+        self.model = tf.keras.models.load_model(str(model_path))
+        self.model_id = model_id_for(model_path)
+        self.predict_box_masks = get_batch_mask_prediction_function(self.model)
+        self.extend_params = {'extend': extend, 'extend_side': extend_side,
+                              'extend_up': extend_up, 'extend_down': extend_down}
+        self.threshold = threshold
+
+    @property
+    def cache_params(self):
+        """Everything besides image, box and model that changes the predicted mask."""
+        params = dict(self.extend_params, threshold=self.threshold)
+        if not self.extend_params['extend']:
+            # The extension sizes are unused without extend
+            for name in ('extend_side', 'extend_up', 'extend_down'):
+                del params[name]
+        return params
+
+    def predict_batch(self, images, boxes_xywh):
+        """Masks for every box of every image in the batch.
+
+        Args:
+            images: list of uint8 arrays [height, width, 3], all the same size.
+            boxes_xywh: list (per image) of [num_boxes, 4] pixel boxes.
+        Returns:
+            list (per image) of lists of (maskrcnn_mask_rle, maskrcnn_bbox)
+        """
+        from deepmac_utils import box_masks_from_predictions, convert_boxes
+
+        tf = self.tf
+        height, width, _ = images[0].shape
+        max_boxes = padded_box_count(max(len(b) for b in boxes_xywh))
+        # Pad with dummy full-image boxes; their masks are discarded
+        boxes = np.tile(np.array([0, 0, 1, 1], dtype=np.float32), (len(images), max_boxes, 1))
+        for i, image_boxes in enumerate(boxes_xywh):
+            boxes[i, :len(image_boxes)] = convert_boxes(image_boxes, height, width, **self.extend_params)
+
+        box_masks = self.predict_box_masks(tf.convert_to_tensor(np.stack(images)),
+                                           tf.convert_to_tensor(boxes))
+        results = []
+        for i, image_boxes in enumerate(boxes_xywh):
+            n = len(image_boxes)
+            # Masks stay at box resolution; no full-frame buffers per box
+            image_masks = box_masks_from_predictions(box_masks[i, :n].numpy(), boxes[i, :n],
+                                                     height, width, self.threshold)
+            results.append([mask_record(mask, box) for mask, box in zip(image_masks, image_boxes)])
+        return results
+
+
+def run(generator, annotations, detections, root, image_ids, work_dir,
+        batch_size=4, chunk_size=64, log_interval=50, label='', done_root=None, cache=None):
+    """Generates masks for image_ids, skipping images already done.
+
+    With a MaskCache, only boxes that miss the cache are sent to the model.
+
+    Returns:
+        (number of images processed, seconds spent)
+    """
+    os.makedirs(work_dir, exist_ok=True)
+    done, next_chunk = load_checkpoint(work_dir, done_root)
+    pending = [image_id for image_id in image_ids if image_id not in done]
+    print('{}{} images, {} already done, {} to go'.format(label, len(image_ids), len(image_ids) - len(pending), len(pending)),
+          flush=True)
+    if not pending:
+        return 0, 0.0
+
+    file_names = {img['id']: img['file_name'] for img in annotations['images']}
+    sizes = image_sizes(annotations, root, pending)
+    writer = ChunkWriter(work_dir, next_chunk, chunk_size)
+    start = time.perf_counter()
+    processed = 0
+    next_log = log_interval
+    for batch in plan_batches(pending, sizes, batch_size):
+        images, boxes_to_run, batch_records = [], [], []
+        for image_id in batch:
+            with open(os.path.join(root, file_names[image_id]), 'rb') as f:
+                data = f.read()
+            boxes = detections[image_id]
+            records = [None] * len(boxes)
+            keys = []
+            if cache is not None:
+                image_hash = content_hash(data)
+                keys = [cache.key(image_hash, box, generator.model_id, generator.cache_params) for box in boxes]
+                cached = cache.get_many(keys)
+                records = [cached.get(key) for key in keys]
+            missing = [i for i, record in enumerate(records) if record is None]
+            if missing:
+                # Only decode images that have at least one box to predict
+                with Image.open(io.BytesIO(data)) as im:
+                    images.append(np.array(im.convert('RGB'), dtype=np.uint8))
+                boxes_to_run.append(boxes[missing])
+            batch_records.append((image_id, records, keys, missing))
+
+        results = iter(generator.predict_batch(images, boxes_to_run) if images else [])
+        for image_id, records, keys, missing in batch_records:
+            if missing:
+                new_results = next(results)
+                for i, result in zip(missing, new_results):
+                    records[i] = result
+                if cache is not None:
+                    cache.put_many(generator.model_id, [(keys[i], rle, bbox) for i, (rle, bbox) in zip(missing, new_results)])
+            ann_ids = detections.annotation_ids_for(image_id)
+            writer.add(image_id, [
+                {'id': int(ann_id), 'maskrcnn_mask_rle': rle, 'maskrcnn_bbox': bbox}
+                for ann_id, (rle, bbox) in zip(ann_ids, records)
+            ])
+        processed += len(batch)
+        if processed >= next_log or processed == len(pending):
+            elapsed = time.perf_counter() - start
+            cache_report = '' if cache is None else ', mask cache hit rate {:.1%} ({} hits, {} misses)'.format(
+                cache.hit_rate(), cache.hits, cache.misses)
+            print('{}[{}/{}] {:.2f} images/sec{}'.format(label, processed, len(pending), processed / elapsed,
+                                                         cache_report), flush=True)
+            next_log += log_interval
+    writer.flush()
+    return processed, time.perf_counter() - start
+
+
+def limit_threads(num_threads):
+    """Cap this process's CPU threads; call before TensorFlow is initialized."""
+    for var in ['OMP_NUM_THREADS', 'MKL_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'TF_NUM_INTRAOP_THREADS']:
+        os.environ[var] = str(num_threads)
+    os.environ['TF_NUM_INTEROP_THREADS'] = '1'
+    import tensorflow as tf
+    tf.config.threading.set_intra_op_parallelism_threads(num_threads)
+    tf.config.threading.set_inter_op_parallelism_threads(1)
+
+
+def open_cache(args):
+    return MaskCache(args.mask_cache, box_tolerance=args.box_tolerance) if args.mask_cache else None
+
+
+def shard_image_ids(image_ids, shard, num_shards):
+    """Deterministic round-robin shard of the sorted image ids.
+
+    Striding keeps each shard's mix of image sizes (and so batch shapes) similar.
+    """
+    return sorted(image_ids)[shard::num_shards]
+
+
+def shard_worker(shard, num_shards, args):
+    """Runs one shard in its own process, with its own model and thread budget."""
+    limit_threads(args.threads_per_worker)
+    annotations = read_json(args.json)
+    detections = DetectionIndex(annotations)
+    generator = MaskGenerator(args.model, extend=args.extend)
+    image_ids = shard_image_ids([int(i) for i in detections.image_ids], shard, num_shards)
+    work_dir = pathlib.Path(args.work_dir) / 'shard_{:03d}'.format(shard)
+    processed, elapsed = run(generator, annotations, detections, args.images, image_ids, work_dir,
+                             batch_size=args.batch_size, chunk_size=args.chunk_size,
+                             log_interval=args.log_interval, label='[shard {}/{}] '.format(shard, num_shards),
+                             done_root=args.work_dir, cache=open_cache(args))
+    return processed, elapsed
+
+
+def run_sharded(args):
+    """Splits the images across worker processes, each writing its own shard of chunks."""
+    import concurrent.futures
+    import multiprocessing
+
+    # TensorFlow is not fork-safe; every worker starts fresh and loads its own model
+    context = multiprocessing.get_context('spawn')
+    start = time.perf_counter()
+    with concurrent.futures.ProcessPoolExecutor(max_workers=args.num_workers, mp_context=context) as pool:
+        futures = [pool.submit(shard_worker, shard, args.num_workers, args) for shard in range(args.num_workers)]
+        totals = [future.result() for future in futures]
+    elapsed = time.perf_counter() - start
+    processed = sum(p for p, _ in totals)
+    for shard, (p, t) in enumerate(totals):
+        print('shard {}: {} images in {:.1f}s ({:.2f} images/sec)'.format(shard, p, t, p / t if t else 0.0))
+    print('all shards: {} images in {:.1f}s ({:.2f} images/sec)'.format(
+        processed, elapsed, processed / elapsed if elapsed else 0.0))
+
+
+def read_chunk_results(work_dir):
+    """annotation id -> mask record, over every chunk (and shard) in work_dir."""
+    results = {}
+    for path in sorted(pathlib.Path(work_dir).rglob(CHUNK_GLOB)):
+        with open(path) as f:
+            for record in json.load(f)['annotations']:
+                results[record['id']] = record
+    return results
+
+
+def merge(annotations, work_dir, output_path):
+    """Writes the annotation file with mask results merged into each annotation."""
+    results = read_chunk_results(work_dir)
+    missing = 0
+
+    def augmented():
+        nonlocal missing
+        for ann in annotations['annotations']:
+            record = results.get(ann['id'])
+            if record is None:
+                missing += 1
+                yield ann
+                continue
+            ann = dict(ann)
+            ann['maskrcnn_bbox'] = record['maskrcnn_bbox']
+            ann['maskrcnn_mask_rle'] = record['maskrcnn_mask_rle']
+            yield ann
+
+    def write_list(f, records):
+        f.write('[')
+        for i, record in enumerate(records):
+            if i:
+                f.write(',')
+            f.write(json.dumps(record, ensure_ascii=False, separators=(',', ':')))
+        f.write(']')
+
+    tmp_path = str(output_path) + '.tmp'
+    with open(tmp_path, 'w') as f:
+        f.write('{')
+        for key in annotations:
+            if key == 'annotations':
+                continue
+            f.write('{}:{},'.format(json.dumps(key), json.dumps(annotations[key], ensure_ascii=False)))
+        f.write('"annotations":')
+        write_list(f, augmented())
+        f.write('}')
+    os.replace(tmp_path, output_path)
+    print('Merged {} mask results into {} ({} annotations without a mask)'.format(
+        len(results), output_path, missing))
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Batch DeepMAC mask generation')
+    parser.add_argument('-j', '--json', type=pathlib.Path, required=True,
+                        help='Annotations JSON file in COCO-format')
+    parser.add_argument('-i', '--images', type=pathlib.Path, required=True,
+                        help='folder with images')
+    parser.add_argument('-m', '--model', type=pathlib.Path,
+                        default='../../deepMAC/deepmac_1024x1024_coco17/saved_model',
+                        help='DeepMAC saved_model directory')
+    parser.add_argument('-w', '--work-dir', type=pathlib.Path, required=True,
+                        help='folder for checkpointed chunk files')
+    parser.add_argument('-o', '--output', type=pathlib.Path, required=True,
+                        help='augmented annotation JSON to write')
+    parser.add_argument('--extend', action='store_true', default=False,
+                        help='making the bounding boxes slightly bigger before predicting masks')
+    parser.add_argument('--batch-size', type=int, default=4,
+                        help='images (of the same size) per model call')
+    parser.add_argument('--chunk-size', type=int, default=64,
+                        help='images per checkpoint chunk')
+    parser.add_argument('--log-interval', type=int, default=50,
+                        help='images between throughput reports')
+    parser.add_argument('--mask-cache', type=pathlib.Path, default=None,
+                        help='persistent mask cache (SQLite file); only cache misses are predicted')
+    parser.add_argument('--box-tolerance', type=float, default=1.0,
+                        help='pixels; box coordinates are rounded to a grid of this spacing before the '
+                             'cache lookup, so boxes that round to the same grid point share a mask')
+    parser.add_argument('--num-workers', type=int, default=1,
+                        help='worker processes, each with its own model and shard of the images')
+    parser.add_argument('--threads-per-worker', type=int, default=None,
+                        help='CPU threads per worker process (default: all cores / num workers)')
+    parser.add_argument('--merge-only', action='store_true', default=False,
+                        help='only merge existing chunks into --output')
+    args = parser.parse_args()
+    if args.threads_per_worker is None:
+        args.threads_per_worker = max(1, (os.cpu_count() or 1) // args.num_workers)
+    return args
+
+
+def main():
+    args = parse_args()
+
+    if not args.merge_only and args.num_workers > 1:
+        run_sharded(args)
+    elif not args.merge_only:
+        limit_threads(args.threads_per_worker)
+        annotations = read_json(args.json)
+        detections = DetectionIndex(annotations)
+        generator = MaskGenerator(args.model, extend=args.extend)
+        image_ids = [int(image_id) for image_id in detections.image_ids]
+        run(generator, annotations, detections, args.images, image_ids, args.work_dir,
+            batch_size=args.batch_size, chunk_size=args.chunk_size, log_interval=args.log_interval,
+            cache=open_cache(args))
+
+    # Results are keyed by annotation id and written in the source annotation
+    # order, so the merged file doesn't depend on how the work was sharded
+    merge(read_json(args.json), args.work_dir, args.output)
+
+
+if __name__ == '__main__':
+    main()
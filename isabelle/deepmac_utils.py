@@ -0,0 +1,150 @@
+"""Model-side helpers shared by the DeepMAC scripts and the batch mask pipeline."""
+
+import json
+
+import numpy as np
+from PIL import Image
+import pycocotools.mask as mask_util
+import tensorflow as tf
+
+
+def read_image(path):
+    """Read an image as an RGB uint8 array."""
+    with open(path, 'rb') as f:
+        img = Image.open(f)
+        return np.array(img.convert('RGB'), dtype=np.uint8)
+
+
+def read_json(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+def convert_boxes(boxes, imH, imW, extend=False, extend_side=0.05, extend_up=0.05, extend_down=0.15):
+    """[x, y, width, height] pixel boxes -> normalized [ymin, xmin, ymax, xmax].
+
+    With extend, each box grows by extend_side of its width on both sides,
+    extend_up of its height above and extend_down below (clipped to the image).
+    """
+    boxes = np.asarray(boxes, dtype=np.float64).reshape(-1, 4)
+    xmin, ymin, width, height = boxes[:, 0], boxes[:, 1], boxes[:, 2], boxes[:, 3]
+    xmax = xmin + width
+    ymax = ymin + height
+    if extend:
+        xmin = np.maximum(xmin - width * extend_side, 0)
+        xmax = np.minimum(xmax + width * extend_side, imW)
+        ymin = np.maximum(ymin - height * extend_up, 0)
+        ymax = np.minimum(ymax + height * extend_down, imH)
+    imH = float(imH)
+    imW = float(imW)
+    return np.stack([ymin / imH, xmin / imW, ymax / imH, xmax / imW], axis=1).astype(np.float32)
+
+
+def get_batch_mask_prediction_function(model):
+    """Get a batched box-conditioned mask prediction function.
+
+    The returned function takes images [batch, height, width, 3] (all the same
+    size) and normalized boxes [batch, num_boxes, 4] and returns box-resolution
+    masks [batch, num_boxes, mask_height, mask_width]; see BoxMask.
+    """
+
+    @tf.function(reduce_retracing=True)
+    def predict_box_masks(images, boxes):
+        detections = model(images, boxes)
+        return detections['detection_masks']
+
+    return predict_box_masks
+
+
+def encode_box_mask(local_mask, y0, x0, image_height, image_width):
+    """COCO RLE of a full-frame mask that is zero outside a box, from the box-local mask.
+
+    RLE runs are column-major over the full image, so the foreground pixels'
+    full-frame positions are (x0 + col) * image_height + (y0 + row); runs are
+    read off those positions without ever building the full-frame mask.
+    """
+    cols, rows = np.nonzero(np.asarray(local_mask).T)  # column-major order
+    positions = (x0 + cols).astype(np.int64) * image_height + (y0 + rows)
+    total = image_height * image_width
+    if len(positions) == 0:
+        counts = [total]
+    else:
+        breaks = np.flatnonzero(np.diff(positions) != 1) + 1
+        starts = positions[np.r_[0, breaks]]
+        ends = positions[np.r_[breaks - 1, len(positions) - 1]] + 1
+        counts = np.empty(2 * len(starts) + 1, dtype=np.int64)
+        counts[0:-1:2] = starts - np.r_[0, ends[:-1]]  # background before each run
+        counts[1::2] = ends - starts
+        counts[-1] = total - ends[-1]
+        counts = counts.tolist() if counts[-1] else counts[:-1].tolist()
+    rle = mask_util.frPyObjects({'size': [image_height, image_width], 'counts': counts},
+                                image_height, image_width)
+    rle['counts'] = rle['counts'].decode('utf-8')
+    return rle
+
+
+class BoxMask:
+    """A predicted mask kept at box resolution, plus the box geometry.
+
+    The full-frame mask is only materialized by to_full(), for consumers that
+    really need it; RLE encoding and the mask bbox work on the box-local mask.
+
+    Args:
+        box_mask: [mask_height, mask_width] mask probabilities from the model.
+        box: normalized [ymin, xmin, ymax, xmax] the mask was predicted for.
+        image_height, image_width: size of the full frame.
+    """
+    def __init__(self, box_mask, box, image_height, image_width, threshold=0.5):
+        self.box_mask = np.asarray(box_mask, dtype=np.float32)
+        self.image_height = int(image_height)
+        self.image_width = int(image_width)
+        self.threshold = threshold
+        ymin, xmin, ymax, xmax = np.asarray(box, dtype=np.float64)
+        self.y0 = int(np.clip(np.floor(ymin * image_height), 0, image_height))
+        self.x0 = int(np.clip(np.floor(xmin * image_width), 0, image_width))
+        self.y1 = int(np.clip(np.ceil(ymax * image_height), self.y0, image_height))
+        self.x1 = int(np.clip(np.ceil(xmax * image_width), self.x0, image_width))
+        self._local = None
+
+    def local(self):
+        """Binary mask over the box's pixels, [y1 - y0, x1 - x0]."""
+        if self._local is None:
+            height, width = self.y1 - self.y0, self.x1 - self.x0
+            if height == 0 or width == 0:
+                self._local = np.zeros((height, width), dtype=bool)
+            else:
+                resized = Image.fromarray(self.box_mask, mode='F').resize((width, height), Image.BILINEAR)
+                self._local = np.asarray(resized) > self.threshold
+        return self._local
+
+    def to_full(self):
+        """Full-frame binary mask [image_height, image_width]."""
+        full = np.zeros((self.image_height, self.image_width), dtype=bool)
+        full[self.y0:self.y1, self.x0:self.x1] = self.local()
+        return full
+
+    def bbox(self):
+        """[x_left, y_top, x_right, y_bottom] of the mask pixels, or None if empty."""
+        rows = np.flatnonzero(self.local().any(axis=1))
+        cols = np.flatnonzero(self.local().any(axis=0))
+        if len(rows) == 0:
+            return None
+        return [float(self.x0 + cols[0]), float(self.y0 + rows[0]),
+                float(self.x0 + cols[-1] + 1), float(self.y0 + rows[-1] + 1)]
+
+    def to_rle(self):
+        return encode_box_mask(self.local(), self.y0, self.x0, self.image_height, self.image_width)
+
+    def apply(self, image):
+        """Copy of image with every pixel outside the mask blacked out."""
+        segmented = np.zeros_like(image)
+        box = (slice(self.y0, self.y1), slice(self.x0, self.x1))
+        segmented[box][self.local()] = image[box][self.local()]
+        return segmented
+
+
+def box_masks_from_predictions(box_masks, boxes, image_height, image_width, threshold=0.5):
+    """Wraps the model's per-box masks [num_boxes, mask_height, mask_width] as BoxMasks."""
+    box_masks = np.asarray(box_masks)
+    return [BoxMask(mask, box, image_height, image_width, threshold)
+            for mask, box in zip(box_masks, np.asarray(boxes))]
@@ -0,0 +1,60 @@
+import numpy as np
+
+
+class DetectionIndex:
+    """Detections grouped by image, built in one pass over the annotations.
+
+    Replaces the dict of per-image annotation lists: annotations are sorted by
+    image id once and each image owns a contiguous slice of the box array, so
+    looking up an image is a binary search instead of a scan over every
+    annotation. The source annotation dicts are never modified.
+
+    Boxes are [x, y, width, height] floats taken from 'segmentation_bbox'
+    (falling back to 'bbox' when an annotation has none).
+    """
+    def __init__(self, annotations, box_key='segmentation_bbox'):
+        anns = annotations['annotations']
+        image_ids = np.fromiter((a['image_id'] for a in anns), dtype=np.int64, count=len(anns))
+        annotation_ids = np.fromiter((a['id'] for a in anns), dtype=np.int64, count=len(anns))
+        boxes = np.array([a[box_key] if box_key in a else a['bbox'] for a in anns], dtype=np.float32).reshape(-1, 4)
+
+        order = np.argsort(image_ids, kind='stable')
+        self.image_ids, starts = np.unique(image_ids[order], return_index=True)
+        self.offsets = np.append(starts, len(order)).astype(np.int64)
+        self.annotation_ids = annotation_ids[order]
+        self.boxes = boxes[order]
+        # order[i] is the position in annotations['annotations'] of sorted row i
+        self.annotation_positions = order
+        # Images without any detection are still known (empty slice), as before
+        self.known_image_ids = np.unique(np.fromiter(
+            (img['id'] for img in annotations['images']), dtype=np.int64, count=len(annotations['images'])))
+
+    def _slice(self, image_id):
+        image_id = int(image_id)
+        g = np.searchsorted(self.image_ids, image_id)
+        if g < len(self.image_ids) and self.image_ids[g] == image_id:
+            return slice(self.offsets[g], self.offsets[g + 1])
+        if image_id in self:
+            return slice(0, 0)
+        raise KeyError(image_id)
+
+    def __contains__(self, image_id):
+        image_id = int(image_id)
+        g = np.searchsorted(self.known_image_ids, image_id)
+        return bool(g < len(self.known_image_ids) and self.known_image_ids[g] == image_id)
+
+    def __getitem__(self, image_id):
+        """Box array [num_detections, 4] for an image id (int or str)."""
+        return self.boxes[self._slice(image_id)]
+
+    def __len__(self):
+        return len(self.known_image_ids)
+
+    def annotation_ids_for(self, image_id):
+        return self.annotation_ids[self._slice(image_id)]
+
+    def groups(self):
+        """Yields (image_id, annotation_ids, boxes) for every image with detections."""
+        for g, image_id in enumerate(self.image_ids):
+            s = slice(self.offsets[g], self.offsets[g + 1])
+            yield int(image_id), self.annotation_ids[s], self.boxes[s]
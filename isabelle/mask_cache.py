@@ -0,0 +1,150 @@
+"""Persistent, content-addressed cache of predicted segmentation masks.
+
+Entries are keyed by (sha1 of the image bytes, box rounded to a pixel
+tolerance, model id, box-extension parameters) and store the RLE mask and mask
+bbox, so rerunning the DeepMAC pipeline after changing the box padding or
+adding annotations only runs inference for boxes that miss the cache.
+
+The cache is a single SQLite file (WAL mode, so the sharded workers of
+deepmac_batch.py can share it).
+
+Usage:
+    python mask_cache.py --cache masks.sqlite stats
+    python mask_cache.py --cache masks.sqlite gc --keep-model-id <id> [<id> ...]
+    python mask_cache.py --cache masks.sqlite gc --older-than-days 90
+"""
+
+import argparse
+import hashlib
+import json
+import pathlib
+import sqlite3
+import time
+
+import numpy as np
+
+
+def content_hash(data):
+    """sha1 hex digest of raw bytes (e.g. an encoded JPEG)."""
+    return hashlib.sha1(data).hexdigest()
+
+
+def model_id_for(model_path):
+    """Stable id of a saved_model: hash of its graph and variable index."""
+    model_path = pathlib.Path(model_path)
+    sha1 = hashlib.sha1()
+    for name in ['saved_model.pb', 'variables/variables.index']:
+        path = model_path / name
+        if path.exists():
+            sha1.update(path.read_bytes())
+    return sha1.hexdigest()[:16]
+
+
+class MaskCache:
+    """SQLite-backed mask cache.
+
+    Args:
+        path: cache file.
+        box_tolerance: box coordinates (pixels) are rounded to a grid of this
+            spacing, so boxes that round to the same grid point share an entry.
+    """
+    def __init__(self, path, box_tolerance=1.0):
+        self.path = pathlib.Path(path)
+        self.box_tolerance = box_tolerance
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.db = sqlite3.connect(str(self.path), timeout=60)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('''CREATE TABLE IF NOT EXISTS masks (
+            key TEXT PRIMARY KEY,
+            model_id TEXT NOT NULL,
+            record TEXT NOT NULL,
+            last_used REAL NOT NULL)''')
+        self.db.execute('CREATE INDEX IF NOT EXISTS masks_model_id ON masks (model_id)')
+        self.db.commit()
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, image_hash, box, model_id, extend_params):
+        """Cache key for one box ([x, y, width, height] pixels) of one image."""
+        rounded = np.round(np.asarray(box, dtype=np.float64) / self.box_tolerance).astype(np.int64)
+        parts = [image_hash, ','.join(map(str, rounded.tolist())), str(self.box_tolerance),
+                 model_id, json.dumps(extend_params, sort_keys=True)]
+        return hashlib.sha1('|'.join(parts).encode('utf-8')).hexdigest()
+
+    def get_many(self, keys):
+        """dict key -> (maskrcnn_mask_rle, maskrcnn_bbox) for the keys that hit."""
+        found = {}
+        if keys:
+            placeholders = ','.join('?' * len(keys))
+            rows = self.db.execute('SELECT key, record FROM masks WHERE key IN ({})'.format(placeholders),
+                                   list(keys)).fetchall()
+            for key, record in rows:
+                record = json.loads(record)
+                found[key] = (record['maskrcnn_mask_rle'], record['maskrcnn_bbox'])
+            if found:
+                self.db.execute('UPDATE masks SET last_used = ? WHERE key IN ({})'.format(
+                    ','.join('?' * len(found))), [time.time()] + list(found))
+                self.db.commit()
+        self.hits += len(found)
+        self.misses += len(keys) - len(found)
+        return found
+
+    def put_many(self, model_id, entries):
+        """Stores entries: iterable of (key, maskrcnn_mask_rle, maskrcnn_bbox)."""
+        now = time.time()
+        self.db.executemany(
+            'INSERT OR REPLACE INTO masks (key, model_id, record, last_used) VALUES (?, ?, ?, ?)',
+            [(key, model_id, json.dumps({'maskrcnn_mask_rle': rle, 'maskrcnn_bbox': bbox},
+                                        separators=(',', ':')), now)
+             for key, rle, bbox in entries])
+        self.db.commit()
+
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def stats(self):
+        """Entries per model id."""
+        return dict(self.db.execute('SELECT model_id, COUNT(*) FROM masks GROUP BY model_id').fetchall())
+
+    def gc(self, keep_model_ids=None, older_than_days=None):
+        """Deletes entries of models not in keep_model_ids and/or unused for a while."""
+        deleted = 0
+        if keep_model_ids:
+            placeholders = ','.join('?' * len(keep_model_ids))
+            deleted += self.db.execute('DELETE FROM masks WHERE model_id NOT IN ({})'.format(placeholders),
+                                       list(keep_model_ids)).rowcount
+        if older_than_days is not None:
+            cutoff = time.time() - older_than_days * 24 * 3600
+            deleted += self.db.execute('DELETE FROM masks WHERE last_used < ?', (cutoff,)).rowcount
+        self.db.commit()
+        self.db.execute('VACUUM')
+        return deleted
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Inspect or garbage-collect the mask cache')
+    parser.add_argument('--cache', type=pathlib.Path, required=True,
+                        help='mask cache file')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    subparsers.add_parser('stats', help='entries per model id')
+    gc_parser = subparsers.add_parser('gc', help='delete entries of unused models')
+    gc_parser.add_argument('--keep-model-id', nargs='+', default=None,
+                           help='model ids to keep; everything else is deleted')
+    gc_parser.add_argument('--keep-model', type=pathlib.Path, nargs='+', default=[],
+                           help='saved_model directories whose ids to keep')
+    gc_parser.add_argument('--older-than-days', type=float, default=None,
+                           help='also delete entries not used for this many days')
+    args = parser.parse_args()
+
+    cache = MaskCache(args.cache)
+    if args.command == 'gc':
+        keep = list(args.keep_model_id or []) + [model_id_for(path) for path in args.keep_model]
+        deleted = cache.gc(keep or None, args.older_than_days)
+        print('deleted {} entries'.format(deleted))
+    for model_id, count in cache.stats().items():
+        print('{}: {} entries'.format(model_id, count))
+
+
+if __name__ == '__main__':
+    main()